@@ -7,9 +7,13 @@
 # SNMP Snapshot Data Recorder
 #
 import argparse
+import collections
 import functools
 import os
+import pickle
+import shutil
 import sys
+import tempfile
 import time
 import traceback
 
@@ -21,6 +25,7 @@ from pysnmp.carrier.asyncore.dgram import udp6
 from pysnmp.entity import engine, config
 from pysnmp.entity.rfc3413 import cmdgen
 from pysnmp.error import PySnmpError
+from pysnmp.proto import errind
 from pysnmp.proto import rfc1902
 from pysnmp.proto import rfc1905
 from pysnmp.smi import compiler
@@ -33,6 +38,7 @@ from snmpsim import log
 from snmpsim import utils
 from snmpsim import variation
 from snmpsim import endpoints
+from snmpsim.record import snmprec
 
 AUTH_PROTOCOLS = {
     'MD5': config.usmHMACMD5AuthProtocol,
@@ -65,6 +71,88 @@ VERSION_MAP = {
 DESCRIPTION = ('SNMP simulation data recorder. Pull simulation data from '
                'SNMP agent')
 
+# well-known subtrees to split SNMP walk at
+MIB2_SUBTREES = tuple(
+    univ.ObjectIdentifier(x) for x in (
+        '1.3.6.1.2.1.1',  # system
+        '1.3.6.1.2.1.2',  # interfaces
+        '1.3.6.1.2.1.3',  # at
+        '1.3.6.1.2.1.4',  # ip
+        '1.3.6.1.2.1.4.20',  # ipAddrTable
+        '1.3.6.1.2.1.4.21',  # ipRouteTable
+        '1.3.6.1.2.1.4.22',  # ipNetToMediaTable
+        '1.3.6.1.2.1.4.24',  # ipForward
+        '1.3.6.1.2.1.4.34',  # ipAddressTable
+        '1.3.6.1.2.1.4.35',  # ipNetToPhysicalTable
+        '1.3.6.1.2.1.5',  # icmp
+        '1.3.6.1.2.1.6',  # tcp
+        '1.3.6.1.2.1.7',  # udp
+        '1.3.6.1.2.1.10',  # transmission
+        '1.3.6.1.2.1.11',  # snmp
+        '1.3.6.1.2.1.17',  # dot1dBridge
+        '1.3.6.1.2.1.25',  # host
+        '1.3.6.1.2.1.31',  # ifMIB
+        '1.3.6.1.2.1.47',  # entityMIB
+        '1.3.6.1.3',  # experimental
+        '1.3.6.1.4',  # private
+        '1.3.6.1.6',  # snmpV2
+    )
+)
+
+
+class GetBulkWindow(object):
+    """Adapt GETBULK max-repetitions to SNMP agent capacity.
+
+    Much like TCP congestion window, max-repetitions doubles on every
+    response up to a threshold and grows by 10% past it. Truncated
+    responses bring it and the threshold down to the number of var-binds
+    agent fits into a response. Slow responses (approaching the timeout
+    or taking twice as much time per var-bind than usual), tooBig errors
+    and timeouts halve it.
+    """
+    def __init__(self, initial, maximum, timeout):
+        self.repetitions = max(1, min(initial, maximum))
+        self._threshold = self._maximum = maximum
+        self._timeout = timeout
+        self._latency = None
+
+    def update(self, rtt, requested, received):
+        latency = rtt / max(1, received)
+
+        if self._latency is None:
+            self._latency = latency
+
+        # agent won't fit more var-binds into response, at least this time
+        if received < requested:
+            self.repetitions = self._threshold = max(1, received)
+
+        elif rtt > self._timeout / 2.0 or latency > self._latency * 2:
+            self.shrink(requested)
+
+        elif requested >= self.repetitions:
+            if self.repetitions < self._threshold:
+                self.repetitions = min(self.repetitions * 2, self._threshold)
+
+            else:
+                self.repetitions = min(
+                    self.repetitions + max(1, self.repetitions // 10),
+                    self._maximum)
+
+        # smoothed per var-bind latency
+        self._latency += (latency - self._latency) / 8
+
+    def shrink(self, requested):
+        """Halve max-repetitions, return `False` if it can't get any lower"""
+        if requested > self.repetitions:
+            return True  # already shrunk since the request
+
+        if self.repetitions == 1:
+            return False
+
+        self.repetitions = self._threshold = self.repetitions // 2
+
+        return True
+
 
 def _parse_mib_object(arg, last=False):
     if '::' in arg:
@@ -82,6 +170,122 @@ def _parse_sized_string(arg, min_length=8):
     return arg
 
 
+def _split_walk(start_oid, stop_oid, subtrees):
+    """Split OID range into consecutive ranges at subtrees beginning.
+
+    Returns list of (`start`, `stop`) OID tuples, where `stop` of the
+    last range is `stop_oid`.
+    """
+    boundaries = sorted(
+        set(oid for oid in subtrees
+            if oid > start_oid and (not stop_oid or oid < stop_oid)))
+
+    return list(zip([start_oid] + boundaries, boundaries + [stop_oid]))
+
+
+def _pick_subtrees(regions, count):
+    """Pick subtrees to split SNMP walk at.
+
+    Takes OID-ordered list of sampled subtrees as (`oid`, (`weight`,
+    `splittable`)) tuples, where `weight` is the (estimated) number of
+    managed objects in the subtree. Returns up to `count` - 1 subtrees,
+    each beginning a run of subtrees of roughly equal total weight.
+    """
+    share = sum(weight for _, (weight, _) in regions) / float(count)
+
+    subtrees = []
+
+    run = 0
+
+    for oid, (weight, splittable) in regions:
+        if (splittable and run and run + weight > share and
+                len(subtrees) < count - 1):
+            subtrees.append(oid)
+            run = 0
+
+        run += weight
+
+    return subtrees
+
+
+def _parse_agent_list(path, community):
+    """Read SNMP agents to record simulation data from.
+
+    Each line of the file holds agent UDP endpoint (IPv6 address
+    enclosed in square brackets), optionally followed by SNMP community
+    name and output file name. Everything past `#` is ignored e.g.
+
+        127.0.0.1:1161 public router-1
+        [::1]:161 private
+    """
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+
+    except IOError as exc:
+        raise error.SnmpsimError(
+            'Failed to read agents list file %s: %s' % (path, exc))
+
+    agents = []
+
+    for lineno, line in enumerate(lines):
+        fields = line.split('#', 1)[0].split()
+
+        if not fields:
+            continue
+
+        if len(fields) > 3:
+            raise error.SnmpsimError(
+                'Malformed agent entry at %s:%d' % (path, lineno + 1))
+
+        ipv6 = fields[0].startswith('[')
+
+        endpoint = endpoints.parse_endpoint(fields[0], ipv6=ipv6)
+
+        if len(fields) > 2:
+            output = fields[2]
+
+        else:
+            output = '%s_%s' % (endpoint[0].replace(':', '-'), endpoint[1])
+
+        agents.append(
+            {'endpoint': endpoint,
+             'domain': ipv6 and udp6.domainName or udp.domainName,
+             'community': len(fields) > 1 and fields[1] or community,
+             'output': output})
+
+    return agents
+
+
+def _save_checkpoint(path, state):
+    """Replace recording checkpoint file in one go"""
+    tmp_path = path + os.path.extsep + 'tmp'
+
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+
+        # can't rename over existing file on Windows
+        if sys.platform == 'win32' and os.path.exists(path):
+            os.remove(path)
+
+        os.rename(tmp_path, path)
+
+    except (IOError, OSError) as exc:
+        raise error.SnmpsimError(
+            'Failed to save checkpoint file %s: %s' % (path, exc))
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    except (IOError, OSError, EOFError, pickle.UnpicklingError) as exc:
+        raise error.SnmpsimError(
+            'Failed to load checkpoint file %s: %s' % (path, exc))
+
+
 def main():
     variation_module = None
 
@@ -164,7 +368,16 @@ def main():
 
     parser.add_argument(
         '--getbulk-repetitions', type=int, default=25,
-        help='Use SNMP GETBULK PDU for mass SNMP managed objects retrieval')
+        help='SNMP GETBULK PDU max-repetitions value')
+
+    parser.add_argument(
+        '--adaptive-getbulk', action='store_true',
+        help='Use SNMP GETBULK PDU tuning its max-repetitions value to '
+             'agent capacity, starting from --getbulk-repetitions')
+
+    parser.add_argument(
+        '--max-getbulk-repetitions', type=int, default=500,
+        help='Upper limit of adaptive SNMP GETBULK max-repetitions value')
 
     endpoint_group = parser.add_mutually_exclusive_group(required=True)
 
@@ -181,6 +394,29 @@ def main():
         help='SNMP agent UDP/IPv6 address to pull simulation data '
              'from ([name]:port)')
 
+    endpoint_group.add_argument(
+        '--agent-list-file', metavar='<FILE>', type=str,
+        help='File listing SNMP agents to pull simulation data from, '
+             'one "<endpoint> [community] [output-file]" per line')
+
+    parser.add_argument(
+        '--split-walk', choices=('mib-2', 'sample'),
+        help='Split SNMP walk into subtrees and walk them concurrently. '
+             'Subtrees are either well-known MIB-2 branches or learned by '
+             'sampling agent\'s OID space')
+
+    parser.add_argument(
+        '--max-subtrees', type=int, default=16,
+        help='Maximum number of subtrees to split sampled SNMP walk into')
+
+    parser.add_argument(
+        '--max-requests', type=int, default=32,
+        help='Maximum number of outstanding SNMP requests to all agents')
+
+    parser.add_argument(
+        '--max-requests-per-agent', type=int, default=1,
+        help='Maximum number of outstanding SNMP requests to any one agent')
+
     parser.add_argument(
         '--timeout', type=int, default=3,
         help='SNMP command response timeout (in seconds)')
@@ -218,6 +454,21 @@ def main():
         '--output-file', metavar='<FILE>', type=str,
         help='SNMP simulation data file to write records to')
 
+    parser.add_argument(
+        '--output-dir', metavar='<DIR>', type=str, default='.',
+        help='Directory to write simulation data files to, one file '
+             'per agent listed in --agent-list-file')
+
+    parser.add_argument(
+        '--checkpoint-interval', metavar='<SECONDS>', type=int, default=0,
+        help='Save recording progress next to the output file this often '
+             '(in seconds) so that interrupted recording can be resumed')
+
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Resume interrupted recording from its checkpoint, appending '
+             'to the output file(s)')
+
     parser.add_argument(
         '--continue-on-errors', metavar='<tolerance-level>',
         type=int, default=0,
@@ -246,28 +497,6 @@ def main():
     if args.debug_asn1:
         pyasn1_debug.setLogger(pyasn1_debug.Debug(*args.debug_asn1))
 
-    if args.output_file:
-        ext = os.path.extsep
-        ext += variation.RECORD_TYPES[args.destination_record_type].ext
-
-        if not args.output_file.endswith(ext):
-            args.output_file += ext
-
-        record = variation.RECORD_TYPES[args.destination_record_type]
-        args.output_file = record.open(args.output_file, 'wb')
-
-    else:
-        args.output_file = sys.stdout
-
-        if sys.version_info >= (3, 0, 0):
-            # binary mode write
-            args.output_file = sys.stdout.buffer
-
-        elif sys.platform == "win32":
-            import msvcrt
-
-            msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
-
     # Catch missing params
 
     if args.protocol_version == '3':
@@ -314,10 +543,84 @@ def main():
         parser.print_usage(sys.stderr)
         return 1
 
+    if args.agent_list_file:
+        if args.variation_module:
+            log.error('Variation module can not be used with multiple agents')
+            return 1
+
+        if args.output_file:
+            log.error('Use --output-dir for recording multiple agents')
+            return 1
+
+        try:
+            agents = _parse_agent_list(args.agent_list_file, args.community)
+
+        except error.SnmpsimError as exc:
+            log.error(exc)
+            return 1
+
+        for agent in agents:
+            agent['output'] = os.path.join(args.output_dir, agent['output'])
+
+    else:
+        agents = [
+            {'endpoint': args.agent_udpv6_endpoint or args.agent_udpv4_endpoint,
+             'domain': (args.agent_udpv6_endpoint and udp6.domainName or
+                        udp.domainName),
+             'community': args.community,
+             'output': args.output_file}
+        ]
+
+    data_file_handler = variation.RECORD_TYPES[args.destination_record_type]
+
+    ext = os.path.extsep + data_file_handler.ext
+
+    outputs = set()
+
+    for agent in agents:
+        if not agent['output']:
+            continue
+
+        if not agent['output'].endswith(ext):
+            agent['output'] += ext
+
+        if agent['output'] in outputs:
+            log.error('Duplicate output file %s, give agents distinct '
+                      'names' % agent['output'])
+            return 1
+
+        outputs.add(agent['output'])
+
+    if args.resume and not args.checkpoint_interval:
+        args.checkpoint_interval = 60
+
+    if args.checkpoint_interval:
+        if not args.output_file and not args.agent_list_file:
+            log.error('Recording to standard output can not be resumed, '
+                      'use --output-file')
+            return 1
+
+        if isinstance(data_file_handler, snmprec.CompressedSnmprecRecord):
+            log.error('Compressed recording can not be resumed')
+            return 1
+
+    if args.adaptive_getbulk:
+        args.use_getbulk = True
+
     if args.use_getbulk and args.protocol_version == '1':
         log.info('will be using GETNEXT with SNMPv1!')
         args.use_getbulk = False
 
+    if args.split_walk:
+        if args.variation_module:
+            log.error('Variation module can not be used with split walk')
+            return 1
+
+        if args.split_walk == 'sample' and args.protocol_version == '1':
+            log.info('can not sample OID space with SNMPv1, splitting '
+                     'walk at MIB-2 subtrees')
+            args.split_walk = 'mib-2'
+
     # Load variation module
 
     if args.variation_module:
@@ -340,8 +643,8 @@ def main():
             ctx = {'path': mod, 'moduleContext': {}}
 
             try:
-                with open(mod) as fl:
-                    exec (compile(fl.read(), mod, 'exec'), ctx)
+                ctx = variation.import_variation_module(
+                    mod, args.variation_module, ctx)
 
             except Exception as exc:
                 log.error('Variation module "%s" execution failure: '
@@ -376,6 +679,10 @@ def main():
             AUTH_PROTOCOLS[args.v3_auth_proto], args.v3_auth_key,
             PRIV_PROTOCOLS[args.v3_priv_proto], args.v3_priv_key)
 
+        config.addTargetParams(
+            snmp_engine, 'pms', args.v3_user, secLevel,
+            VERSION_MAP[args.protocol_version])
+
         log.info(
             'SNMP version 3, Context EngineID: %s Context name: %s, SecurityName: %s, '
             'SecurityLevel: %s, Authentication key/protocol: %s/%s, Encryption '
@@ -388,41 +695,49 @@ def main():
                 args.v3_priv_key is None and '<NONE>' or args.v3_priv_key, args.v3_priv_proto))
 
     else:
-
-        args.v3_user = 'agt'
         secLevel = 'noAuthNoPriv'
 
-        config.addV1System(snmp_engine, args.v3_user, args.community)
-
         log.info(
             'SNMP version %s, Community name: '
             '%s' % (args.protocol_version, args.community))
 
-    config.addTargetParams(
-        snmp_engine, 'pms', args.v3_user, secLevel, VERSION_MAP[args.protocol_version])
+    # one set of target parameters per distinct SNMP community
+    communities = {}
 
-    if args.agent_udpv6_endpoint:
-        config.addSocketTransport(
-            snmp_engine, udp6.domainName,
-            udp6.Udp6SocketTransport().openClientMode())
+    for idx, agent in enumerate(agents):
+        if args.protocol_version == '3':
+            params = 'pms'
+
+        else:
+            params = communities.get(agent['community'])
+
+            if not params:
+                params = communities[agent['community']] = (
+                    'pms-%d' % len(communities))
+
+                config.addV1System(
+                    snmp_engine, params, agent['community'])
+
+                config.addTargetParams(
+                    snmp_engine, params, params, secLevel,
+                    VERSION_MAP[args.protocol_version])
+
+        agent['target'] = 'tgt-%d' % idx
 
         config.addTargetAddr(
-            snmp_engine, 'tgt', udp6.domainName, args.agent_udpv6_endpoint, 'pms',
-            args.timeout * 100, args.retries)
+            snmp_engine, agent['target'], agent['domain'], agent['endpoint'],
+            params, args.timeout * 100, args.retries)
 
-        log.info('Querying UDP/IPv6 agent at [%s]:%s' % args.agent_udpv6_endpoint)
+    if [agent for agent in agents if agent['domain'] == udp6.domainName]:
+        config.addSocketTransport(
+            snmp_engine, udp6.domainName,
+            udp6.Udp6SocketTransport().openClientMode())
 
-    elif args.agent_udpv4_endpoint:
+    if [agent for agent in agents if agent['domain'] == udp.domainName]:
         config.addSocketTransport(
             snmp_engine, udp.domainName,
             udp.UdpSocketTransport().openClientMode())
 
-        config.addTargetAddr(
-            snmp_engine, 'tgt', udp.domainName, args.agent_udpv4_endpoint, 'pms',
-            args.timeout * 100, args.retries)
-
-        log.info('Querying UDP/IPv4 agent at %s:%s' % args.agent_udpv4_endpoint)
-
     log.info('Agent response timeout: %d secs, retries: '
              '%s' % (args.timeout, args.retries))
 
@@ -446,6 +761,59 @@ def main():
             sys.stderr.write('ERROR: %s\r\n' % exc)
             return 1
 
+    start_oid, stop_oid = args.start_object, args.stop_object
+
+    if isinstance(start_oid, ObjectIdentity):
+        start_oid = start_oid.getOid()
+
+    if isinstance(stop_oid, ObjectIdentity):
+        stop_oid = stop_oid.getOid()
+
+    # Recording checkpoints
+
+    for agent in agents:
+        agent['checkpoint'] = agent['state'] = None
+        agent['recorded'] = False
+
+        if not args.checkpoint_interval:
+            continue
+
+        agent['checkpoint'] = agent['output'] + os.path.extsep + 'checkpoint'
+
+        if not args.resume:
+            continue
+
+        if os.path.exists(agent['checkpoint']):
+            try:
+                state = _load_checkpoint(agent['checkpoint'])
+
+            except error.SnmpsimError as exc:
+                log.error(exc)
+                return 1
+
+            if ((state['startOID'], state['stopOID'], state['recordType']) !=
+                    (tuple(start_oid), stop_oid and tuple(stop_oid) or None,
+                     args.destination_record_type)):
+                log.error(
+                    'Checkpoint file %s is made with different '
+                    '--start-object, --stop-object or '
+                    '--destination-record-type' % agent['checkpoint'])
+                return 1
+
+            # checkpoint outlives complete recording to tell so
+            if state.get('complete'):
+                agent['recorded'] = True
+
+            else:
+                agent['state'] = state
+
+        elif os.path.exists(agent['output']):
+            log.error(
+                'Output file %s exists, but there is no checkpoint telling '
+                'whether its recording is complete. Remove the file to '
+                'record it anew' % agent['output'])
+            return 1
+
     # Variation module initialization
 
     if variation_module:
@@ -473,16 +841,167 @@ def main():
             log.info(
                 'Variation module "%s" initialization OK' % args.variation_module)
 
-    data_file_handler = variation.RECORD_TYPES[args.destination_record_type]
+        state = agents[0]['state']
+
+        # carry on with recording state as of the checkpoint
+        if state and 'moduleContext' in state:
+            for item in state['moduleContext']:
+                key, value = pickle.loads(item)
+                variation_module['moduleContext'][key] = value
+
+    def open_output_file(path, size=None):
+        if not path:
+            if sys.version_info >= (3, 0, 0):
+                # binary mode write
+                return sys.stdout.buffer
+
+            elif sys.platform == "win32":
+                import msvcrt
+
+                msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+
+            return sys.stdout
+
+        if size is None:
+            return data_file_handler.open(path, 'wb')
+
+        # records past the checkpoint get recorded again
+        output = data_file_handler.open(path, 'r+b')
+        output.truncate(size)
+        output.seek(size)
+
+        return output
+
+    def part_file(agent, idx):
+        return '%s%spart%d' % (agent['output'], os.path.extsep, idx)
 
+    def save_checkpoint(agent, complete=False):
+        walks_state = []
+
+        for cb_ctx in agent['walks']:
+            size = cb_ctx['size']
+
+            if cb_ctx['output']:
+                cb_ctx['output'].flush()
+                size = cb_ctx['output'].tell()
+
+            walks_state.append(
+                {'startOID': tuple(cb_ctx['startOID']),
+                 'stopOID': cb_ctx['stopOID'] and tuple(cb_ctx['stopOID']) or None,
+                 'lastOID': tuple(cb_ctx['lastOID']),
+                 'total': cb_ctx['total'],
+                 'count': cb_ctx['count'],
+                 'iteration': cb_ctx['iteration'],
+                 'errors': cb_ctx['errors'],
+                 'size': size,
+                 'done': bool(cb_ctx.get('done') and not cb_ctx.get('failed'))})
+
+        state = {
+            'startOID': tuple(start_oid),
+            'stopOID': stop_oid and tuple(stop_oid) or None,
+            'recordType': args.destination_record_type,
+            'walks': walks_state,
+            'complete': complete
+        }
+
+        if variation_module:
+            state['moduleContext'] = []
+
+            # live objects such as open files can't be saved
+            for item in variation_module['moduleContext'].items():
+                try:
+                    state['moduleContext'].append(
+                        pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+
+                except Exception:
+                    continue
+
+        try:
+            _save_checkpoint(agent['checkpoint'], state)
+
+        except error.SnmpsimError as exc:
+            log.error(exc)
+
+        agent['checkpointTime'] = time.time()
 
     # SNMP worker
 
+    def send_request(snmp_engine, cb_ctx, oid, value=None):
+        cb_ctx['resent'] = True
+
+        if args.use_getbulk:
+            window = cb_ctx['window']
+
+            cb_ctx['repetitions'] = (
+                window and window.repetitions or args.getbulk_repetitions)
+
+            cb_ctx['sentTime'] = time.time()
+
+            cmd_gen.sendVarBinds(
+                snmp_engine,
+                cb_ctx['agent']['target'],
+                args.v3_context_engine_id, args.v3_context_name,
+                0, cb_ctx['repetitions'],
+                [(oid, value)],
+                cbFun, cb_ctx)
+
+        else:
+            cmd_gen.sendVarBinds(
+                snmp_engine,
+                cb_ctx['agent']['target'],
+                args.v3_context_engine_id, args.v3_context_name,
+                [(oid, value)],
+                cbFun, cb_ctx)
+
     def cbFun(snmp_engine, send_request_handle, error_indication,
               error_status, error_index, var_bind_table, cb_ctx):
 
+        cb_ctx['resent'] = False
+
+        agent = cb_ctx['agent']
+
+        window = cb_ctx['window']
+
+        # agent may choke on too many repetitions, retry with fewer
+        if (window and (error_status == 1 or isinstance(
+                error_indication, errind.RequestTimedOut)) and
+                window.shrink(cb_ctx['repetitions'])):
+            log.info(
+                'Agent %s:%s overloaded, GETBULK max-repetitions reduced '
+                'to %d' % (agent['endpoint'][0], agent['endpoint'][1],
+                           window.repetitions))
+
+            send_request(snmp_engine, cb_ctx, cb_ctx['lastOID'])
+            return
+
+        if walk_step(snmp_engine, error_indication, error_status,
+                     var_bind_table, cb_ctx):
+            if (agent['checkpoint'] and
+                    time.time() - agent['checkpointTime'] >=
+                    args.checkpoint_interval):
+                save_checkpoint(agent)
+
+            if not window:
+                return True
+
+            window.update(
+                time.time() - cb_ctx['sentTime'], cb_ctx['repetitions'],
+                sum(len(var_bind_row) for var_bind_row in var_bind_table))
+
+            # carry on with possibly different max-repetitions
+            send_request(snmp_engine, cb_ctx, cb_ctx['lastOID'])
+            return
+
+        # walk is over unless another request is on its way
+        if not cb_ctx['resent']:
+            finish_walk(cb_ctx)
+
+    def walk_step(snmp_engine, error_indication, error_status,
+                  var_bind_table, cb_ctx):
+
         if error_indication and not cb_ctx['retries']:
             cb_ctx['errors'] += 1
+            cb_ctx['failed'] = True
             log.error('SNMP Engine error: %s' % error_indication)
             return
 
@@ -524,22 +1043,10 @@ def main():
                     '...' % (next_oid, cb_ctx['retries']))
 
                 # initiate another SNMP walk iteration
-                if args.use_getbulk:
-                    cmd_gen.sendVarBinds(
-                        snmp_engine,
-                        'tgt',
-                        args.v3_context_engine_id, args.v3_context_name,
-                        0, args.getbulk_repetitions,
-                        [(next_oid, None)],
-                        cbFun, cb_ctx)
+                send_request(snmp_engine, cb_ctx, next_oid)
 
-                else:
-                    cmd_gen.sendVarBinds(
-                        snmp_engine,
-                        'tgt',
-                        args.v3_context_engine_id, args.v3_context_name,
-                        [(next_oid, None)],
-                        cbFun, cb_ctx)
+            else:
+                cb_ctx['failed'] = True
 
             cb_ctx['errors'] += 1
 
@@ -558,7 +1065,7 @@ def main():
             for oid, value in var_bind_row:
 
                 # EOM
-                if args.stop_object and oid >= args.stop_object:
+                if cb_ctx['stopOID'] and oid >= cb_ctx['stopOID']:
                     stop_flag = True  # stop on out of range condition
 
                 elif (value is None or
@@ -586,7 +1093,7 @@ def main():
                     'total': cb_ctx['total'],
                     'iteration': cb_ctx['iteration'],
                     'reqTime': cb_ctx['reqTime'],
-                    'args.start_object': args.start_object,
+                    'startOID': args.start_object,
                     'stopOID': args.stop_object,
                     'stopFlag': stop_flag,
                     'variationModule': variation_module
@@ -598,6 +1105,7 @@ def main():
                 except error.MoreDataNotification as exc:
                     cb_ctx['count'] = 0
                     cb_ctx['iteration'] += 1
+                    cb_ctx['lastOID'] = cb_ctx['startOID']
 
                     more_data_notification = exc
 
@@ -610,22 +1118,7 @@ def main():
                         time.sleep(more_data_notification['period'])
 
                     # initiate another SNMP walk iteration
-                    if args.use_getbulk:
-                        cmd_gen.sendVarBinds(
-                            snmp_engine,
-                            'tgt',
-                            args.v3_context_engine_id, args.v3_context_name,
-                            0, args.getbulk_repetitions,
-                            [(args.start_object, None)],
-                            cbFun, cb_ctx)
-
-                    else:
-                        cmd_gen.sendVarBinds(
-                            snmp_engine,
-                            'tgt',
-                            args.v3_context_engine_id, args.v3_context_name,
-                            [(args.start_object, None)],
-                            cbFun, cb_ctx)
+                    send_request(snmp_engine, cb_ctx, cb_ctx['startOID'])
 
                     stop_flag = True  # stop current iteration
 
@@ -637,7 +1130,7 @@ def main():
                     continue
 
                 else:
-                    args.output_file.write(line)
+                    cb_ctx['output'].write(line)
 
                     cb_ctx['count'] += 1
                     cb_ctx['total'] += 1
@@ -652,37 +1145,393 @@ def main():
         # Continue walking
         return not stop_flag
 
-    cb_ctx = {
-        'total': 0,
-        'count': 0,
-        'errors': 0,
-        'iteration': 0,
-        'reqTime': time.time(),
-        'retries': args.continue_on_errors,
-        'lastOID': args.start_object
-    }
+    # OID space sampling
 
-    if args.use_getbulk:
-        cmd_gen = cmdgen.BulkCommandGenerator()
+    def probe_subtree(snmp_engine, cb_ctx):
+        cb_ctx['probes'] += 1
 
-        cmd_gen.sendVarBinds(
+        probe_gen.sendVarBinds(
             snmp_engine,
-            'tgt',
+            cb_ctx['agent']['target'],
             args.v3_context_engine_id, args.v3_context_name,
             0, args.getbulk_repetitions,
-            [(args.start_object, rfc1902.Null(''))],
-            cbFun, cb_ctx)
+            [(cb_ctx['probe'], None)],
+            probe_cbFun, cb_ctx)
+
+    def probe_cbFun(snmp_engine, send_request_handle, error_indication,
+                    error_status, error_index, var_bind_table, cb_ctx):
+
+        if error_indication:
+            log.error('SNMP Engine error: %s' % error_indication)
+
+            # agent is not worth walking
+            agent = cb_ctx['agent']
+            agent['errors'] += 1
+
+            release(agent)
+            finish_agent(agent)
+            start_walks()
+            return
+
+        if error_status and error_status != 2:
+            log.error(
+                'OID space sampling failed at %s: %s' % (
+                    cb_ctx['probe'], error_status.prettyPrint()))
+
+            finish_sampling(cb_ctx)
+            return
+
+        node = cb_ctx['node']
+
+        oids = [oid for var_bind_row in var_bind_table
+                for oid, value in var_bind_row
+                if value is not None and value.tagSet not in (
+                    rfc1905.NoSuchObject.tagSet,
+                    rfc1905.NoSuchInstance.tagSet,
+                    rfc1905.EndOfMibView.tagSet)]
+
+        # managed objects under the node being enumerated
+        inside = [oid for oid in oids
+                  if oid[:len(node)] == node and len(oid) > len(node) and
+                  (not stop_oid or oid < stop_oid)]
+
+        # node children as seen in response
+        children = []
+
+        for oid in inside:
+            child = oid[:len(node) + 1]
+
+            if children and children[-1][0] == child:
+                children[-1][1] += 1
+
+            else:
+                # walk can not begin at managed object instance
+                children.append([child, 1, len(oid) > len(child)])
+
+        for child, count, splittable in children:
+            cb_ctx['regions'][child] = count, splittable
+
+        cb_ctx['children'] += len(children)
+
+        # response did not reach past the node
+        if (children and len(inside) == len(oids) and
+                cb_ctx['children'] < args.max_subtrees * 4):
+
+            child, count, splittable = children[-1]
+
+            # subtree not fitting a single response gets refined
+            if len(children) == 1 and splittable:
+                cb_ctx['nodes'].append(child)
+                cb_ctx['probe'] = child[:-1] + (child[-1] + 1,)
+
+            # the last child may continue past the response
+            else:
+                cb_ctx['probe'] = child
+
+            probe_subtree(snmp_engine, cb_ctx)
+            return
+
+        # node is now covered by its children
+        if cb_ctx['children']:
+            cb_ctx['regions'].pop(node, None)
+
+        if cb_ctx['nodes'] and cb_ctx['probes'] < args.max_subtrees * 2:
+            sample_node(snmp_engine, cb_ctx)
+            return
+
+        finish_sampling(cb_ctx)
+
+    def sample_node(snmp_engine, cb_ctx):
+        cb_ctx['node'] = cb_ctx['probe'] = cb_ctx['nodes'].popleft()
+        cb_ctx['children'] = 0
+
+        probe_subtree(snmp_engine, cb_ctx)
+
+    def begin_sampling(cb_ctx):
+        sample_node(snmp_engine, cb_ctx)
+
+    def finish_sampling(cb_ctx):
+        agent = cb_ctx['agent']
+
+        release(agent)
+
+        subtrees = _pick_subtrees(
+            sorted(cb_ctx['regions'].items()), args.max_subtrees)
+
+        agent['walks'] = [
+            new_walk(agent, start, stop)
+            for start, stop in _split_walk(start_oid, stop_oid, subtrees)]
+
+        log.info(
+            'Agent %s:%s OID space sampled with %d requests, walking %d '
+            'subtrees' % (agent['endpoint'][0], agent['endpoint'][1],
+                          cb_ctx['probes'], len(agent['walks'])))
+
+        # let agent recording complete before starting others
+        waiting_walks.extendleft(reversed(agent['walks']))
+
+        start_walks()
+
+    # Walks scheduling
+
+    def new_walk(agent, start, stop):
+        cb_ctx = {
+            'agent': agent,
+            'begin': begin_walk,
+            'output': None,
+            'startOID': start,
+            'stopOID': stop,
+            'total': 0,
+            'count': 0,
+            'errors': 0,
+            'iteration': 0,
+            'reqTime': time.time(),
+            'retries': args.continue_on_errors,
+            'lastOID': start,
+            'window': None,
+            'size': None
+        }
+
+        walks.append(cb_ctx)
+
+        return cb_ctx
+
+    def restore_walk(agent, walk_state):
+        cb_ctx = new_walk(
+            agent, univ.ObjectIdentifier(walk_state['startOID']),
+            walk_state['stopOID'] and univ.ObjectIdentifier(
+                walk_state['stopOID']))
+
+        for key in 'total', 'count', 'iteration', 'errors', 'size':
+            cb_ctx[key] = walk_state[key]
+
+        cb_ctx['lastOID'] = univ.ObjectIdentifier(walk_state['lastOID'])
+        cb_ctx['resumed'] = cb_ctx['total']
+
+        if walk_state['done']:
+            cb_ctx['done'] = True
+
+        return cb_ctx
+
+    # outstanding requests by agent endpoint, idle agents dropped
+    outstanding = {}
+
+    def start_walks():
+        skipped = collections.deque()
+
+        while (waiting_walks and
+               sum(outstanding.values()) < args.max_requests):
+
+            cb_ctx = waiting_walks.popleft()
+
+            agent = cb_ctx['agent']
+
+            if (outstanding.get(agent['endpoint'], 0) >=
+                    args.max_requests_per_agent):
+                skipped.append(cb_ctx)
+                continue
+
+            if agent['file'] is None:
+                try:
+                    agent['file'] = open_output_file(
+                        agent['output'],
+                        agent['walks'] and agent['walks'][0]['size'] or None)
+
+                except (IOError, OSError) as exc:
+                    log.error('Failed to open output file %s: '
+                              '%s' % (agent['output'], exc))
+
+                    agent['errors'] += 1
+
+                    for queue in waiting_walks, skipped:
+                        for x in [x for x in queue if x['agent'] is agent]:
+                            queue.remove(x)
+
+                    continue
+
+                log.info('Querying %s agent at %s:%s' % (
+                    agent['domain'] == udp6.domainName and 'UDP/IPv6' or 'UDP/IPv4',
+                    agent['endpoint'][0], agent['endpoint'][1]))
+
+                if agent['checkpoint']:
+                    save_checkpoint(agent)
+
+            outstanding[agent['endpoint']] = (
+                outstanding.get(agent['endpoint'], 0) + 1)
+
+            cb_ctx['begin'](cb_ctx)
+
+        waiting_walks.extendleft(reversed(skipped))
+
+    def release(agent):
+        outstanding[agent['endpoint']] -= 1
+
+        if not outstanding[agent['endpoint']]:
+            del outstanding[agent['endpoint']]
+
+    def begin_walk(cb_ctx):
+        agent = cb_ctx['agent']
+
+        # subtrees past the first one are merged in once all are walked
+        if cb_ctx is agent['walks'][0]:
+            cb_ctx['output'] = agent['file']
+
+        # resumable subtree walk outlives the process
+        elif agent['checkpoint']:
+            path = part_file(agent, agent['walks'].index(cb_ctx))
+
+            if cb_ctx['size'] is None:
+                cb_ctx['output'] = open(path, 'w+b')
+
+            else:
+                cb_ctx['output'] = open_output_file(path, cb_ctx['size'])
+
+        else:
+            cb_ctx['output'] = tempfile.TemporaryFile()
+
+        # subtrees may differ in how many var-binds fit into a response
+        if args.adaptive_getbulk and args.use_getbulk:
+            cb_ctx['window'] = GetBulkWindow(
+                args.getbulk_repetitions, args.max_getbulk_repetitions,
+                args.timeout)
+
+        else:
+            cb_ctx['window'] = None
+
+        cb_ctx['reqTime'] = time.time()
+
+        send_request(
+            snmp_engine, cb_ctx, cb_ctx['lastOID'], rfc1902.Null(''))
+
+    def finish_walk(cb_ctx):
+        agent = cb_ctx['agent']
+
+        release(agent)
+
+        cb_ctx['done'] = True
+
+        if cb_ctx['window']:
+            log.info(
+                'Agent %s:%s GETBULK max-repetitions settled at %d for '
+                'subtree %s' % (agent['endpoint'][0], agent['endpoint'][1],
+                                cb_ctx['window'].repetitions,
+                                cb_ctx['startOID']))
+
+        if all(x.get('done') for x in agent['walks']):
+            finish_agent(agent)
+
+        start_walks()
+
+    def finish_agent(agent):
+        # failed walks are to be resumed before merging subtrees
+        if agent['checkpoint'] and (
+                not agent['walks'] or
+                [x for x in agent['walks'] if x.get('failed')]):
+            save_checkpoint(agent)
+
+            for cb_ctx in agent['walks'][1:]:
+                if cb_ctx['output']:
+                    cb_ctx['output'].close()
+
+            log.info(
+                'Agent %s:%s recording incomplete, run with --resume to '
+                'carry on' % (agent['endpoint'][0], agent['endpoint'][1]))
+
+        else:
+            for idx, cb_ctx in enumerate(agent['walks'][1:], 1):
+                # subtree walked before resuming
+                if not cb_ctx['output']:
+                    cb_ctx['output'] = open_output_file(
+                        part_file(agent, idx), cb_ctx['size'])
+
+                cb_ctx['output'].seek(0)
+                shutil.copyfileobj(cb_ctx['output'], agent['file'])
+                cb_ctx['output'].close()
+                cb_ctx['output'] = None
+
+            agent['file'].flush()
+
+            if agent['checkpoint']:
+                try:
+                    for idx in range(1, len(agent['walks'])):
+                        os.remove(part_file(agent, idx))
+
+                except OSError as exc:
+                    log.error('Failed to remove checkpoint files: %s' % exc)
+
+                save_checkpoint(agent, complete=True)
+
+        agent['file'].flush()
+        agent['file'].close()
+        agent['file'] = None
+
+        if len(agents) > 1:
+            log.info(
+                'Agent %s:%s done, OIDs dumped: %s, errors: %d' % (
+                    agent['endpoint'][0], agent['endpoint'][1],
+                    sum(x['total'] for x in agent['walks']),
+                    agent['errors'] + sum(x['errors'] for x in agent['walks'])))
+
+    walks = []
+
+    waiting_walks = collections.deque()
+
+    for agent in agents:
+        agent['file'] = None
+        agent['errors'] = 0
+        agent['checkpointTime'] = time.time()
+
+        state = agent['state']
+
+        if agent['recorded']:
+            agent['walks'] = []
+
+            log.info('Agent %s:%s already recorded to %s, skipping' % (
+                agent['endpoint'][0], agent['endpoint'][1], agent['output']))
+
+        elif state and state['walks']:
+            agent['walks'] = [
+                restore_walk(agent, walk_state)
+                for walk_state in state['walks']]
+
+            waiting_walks.extend(
+                x for x in agent['walks'] if not x.get('done'))
+
+            log.info(
+                'Agent %s:%s recording resumed from checkpoint, OIDs '
+                'recorded earlier: %d' % (
+                    agent['endpoint'][0], agent['endpoint'][1],
+                    sum(x['total'] for x in agent['walks'])))
+
+        elif args.split_walk == 'sample':
+            agent['walks'] = []
+
+            waiting_walks.append(
+                {'agent': agent,
+                 'begin': begin_sampling,
+                 'nodes': collections.deque([start_oid]),
+                 'regions': {},
+                 'probes': 0})
+
+        else:
+            agent['walks'] = [
+                new_walk(agent, start, stop)
+                for start, stop in _split_walk(
+                    start_oid, stop_oid,
+                    args.split_walk and MIB2_SUBTREES or ())]
+
+            waiting_walks.extend(agent['walks'])
+
+    if args.split_walk == 'sample':
+        probe_gen = cmdgen.BulkCommandGenerator()
+
+
+    if args.use_getbulk:
+        cmd_gen = cmdgen.BulkCommandGenerator()
 
     else:
         cmd_gen = cmdgen.NextCommandGenerator()
 
-        cmd_gen.sendVarBinds(
-            snmp_engine,
-            'tgt',
-            args.v3_context_engine_id, args.v3_context_name,
-            [(args.start_object, rfc1902.Null(''))],
-            cbFun, cb_ctx)
-
     log.info(
         'Sending initial %s request for %s (stop at %s)'
         '....' % (args.use_getbulk and 'GETBULK' or 'GETNEXT',
@@ -691,6 +1540,8 @@ def main():
     started = time.time()
 
     try:
+        start_walks()
+
         snmp_engine.transportDispatcher.runDispatcher()
 
     except KeyboardInterrupt:
@@ -721,18 +1572,35 @@ def main():
 
         started = time.time() - started
 
-        cb_ctx['total'] += cb_ctx['count']
+        total = sum(cb_ctx['total'] for cb_ctx in walks)
+        errors = sum(cb_ctx['errors'] for cb_ctx in walks)
+        errors += sum(agent['errors'] for agent in agents)
+
+        # OIDs recorded prior to resuming do not count towards the rate
+        fresh = total - sum(cb_ctx.get('resumed', 0) for cb_ctx in walks)
 
         log.info(
             'OIDs dumped: %s, elapsed: %.2f sec, rate: %.2f OIDs/sec, errors: '
-            '%d' % (cb_ctx['total'], started,
-                    started and cb_ctx['count'] // started or 0,
-                    cb_ctx['errors']))
-
-        args.output_file.flush()
-        args.output_file.close()
-
-        return cb_ctx.get('errors', 0) and 1 or 0
+            '%d' % (total, started, started and fresh // started or 0, errors))
+
+        # walks interrupted half way
+        for agent in agents:
+            if agent['file']:
+                agent['file'].flush()
+                agent['file'].close()
+
+                if agent['checkpoint']:
+                    log.info(
+                        'Agent %s:%s recording interrupted, run with '
+                        '--resume to carry on from the last '
+                        'checkpoint' % (agent['endpoint'][0],
+                                        agent['endpoint'][1]))
+
+            for cb_ctx in agent['walks'][1:]:
+                if cb_ctx['output']:
+                    cb_ctx['output'].close()
+
+        return errors and 1 or 0
 
 
 if __name__ == '__main__':
@@ -38,6 +38,7 @@ from snmpsim import confdir
 from snmpsim import error
 from snmpsim import log
 from snmpsim import utils
+from snmpsim import variation
 from snmpsim.record import dump
 from snmpsim.record import mvc
 from snmpsim.record import sap
@@ -289,8 +290,8 @@ def main():
             ctx = {'path': mod, 'moduleContext': {}}
 
             try:
-                with open(mod) as fl:
-                    exec (compile(fl.read(), mod, 'exec'), ctx)
+                ctx = variation.import_variation_module(
+                    mod, args.variation_module, ctx)
 
             except Exception as exc:
                 log.error('Variation module "%s" execution '
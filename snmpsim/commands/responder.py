@@ -20,22 +20,24 @@ from pysnmp import debug as pysnmp_debug
 from pysnmp import error
 from pysnmp.carrier.asyncore.dgram import udp
 from pysnmp.carrier.asyncore.dgram import udp6
-from pysnmp.carrier.asyncore.dispatch import AsyncoreDispatcher
 from pysnmp.entity import config
 from pysnmp.entity import engine
 from pysnmp.entity.rfc3413 import cmdrsp
 from pysnmp.entity.rfc3413 import context
+from pysnmp.proto.error import StatusInformation
 
 from snmpsim import confdir
 from snmpsim import controller
 from snmpsim import daemon
 from snmpsim import datafile
+from snmpsim import deferred
 from snmpsim import endpoints
 from snmpsim import log
 from snmpsim import utils
 from snmpsim import variation
 from snmpsim.error import NoDataNotification
 from snmpsim.error import SnmpsimError
+from snmpsim.reporting import metrics
 from snmpsim.reporting.manager import ReportingManager
 
 AUTH_PROTOCOLS = {
@@ -68,8 +70,14 @@ DESCRIPTION = (
 V3_OPTIONS = ('SNMPv3 options')
 
 
+CONTEXT_CACHE = datafile.ContextCache()
+
+
 def probe_hash_context(responder, snmp_engine):
     """v3arch SNMP context name searcher"""
+    if ReportingManager.stage_timing:
+        stage_started = metrics.clock()
+
     execCtx = snmp_engine.observer.getExecutionContext(
         'rfc3412.receiveMessage:request')
 
@@ -89,41 +97,57 @@ def probe_hash_context(responder, snmp_engine):
     else:
         context_engine_id = context_engine_id.prettyPrint()
 
-    for candidate in datafile.probe_context(
-            transport_domain, transport_address,
-            context_engine_id, context_name):
+    cache_key = responder.snmpContext, datafile.probe_context_key(
+        transport_domain, transport_address, context_engine_id, context_name)
 
-        if len(candidate) > 32:
-            probed_context_name = md5(candidate).hexdigest()
+    if cache_key in CONTEXT_CACHE:
+        context_name, mib_instrum = CONTEXT_CACHE[cache_key]
 
-        else:
-            probed_context_name = candidate
+        if log.is_enabled(log.LOG_INFO):
+            log.info(
+                'Using %s selected by cached contextName "%s", transport ID '
+                '%s, source address %s', mib_instrum, context_name,
+                univ.ObjectIdentifier(transport_domain), transport_address[0])
 
-        try:
-            mib_instrum = responder.snmpContext.getMibInstrum(
-                probed_context_name)
+    else:
+        for candidate in datafile.probe_context(
+                transport_domain, transport_address,
+                context_engine_id, context_name):
 
-        except error.PySnmpError:
-            pass
+            if len(candidate) > 32:
+                probed_context_name = md5(candidate).hexdigest()
 
+            else:
+                probed_context_name = candidate
+
+            try:
+                mib_instrum = responder.snmpContext.getMibInstrum(
+                    probed_context_name)
+
+            except error.PySnmpError:
+                pass
+
+            else:
+                if log.is_enabled(log.LOG_INFO):
+                    log.info(
+                        'Using %s selected by candidate %s; transport ID %s, '
+                        'source address %s, context engine ID %s, '
+                        'community name "%s"', mib_instrum, candidate,
+                        univ.ObjectIdentifier(transport_domain),
+                        transport_address[0], context_engine_id,
+                        probed_context_name)
+                context_name = probed_context_name
+                break
         else:
-            log.info(
-                'Using %s selected by candidate %s; transport ID %s, '
-                'source address %s, context engine ID %s, '
-                'community name '
-                '"%s"' % (mib_instrum, candidate,
-                          univ.ObjectIdentifier(transport_domain),
-                          transport_address[0], context_engine_id,
-                          probed_context_name))
-            context_name = probed_context_name
-            break
-    else:
-        mib_instrum = responder.snmpContext.getMibInstrum(context_name)
-        log.info(
-            'Using %s selected by contextName "%s", transport ID %s, '
-            'source address %s' % (mib_instrum, context_name,
-                                   univ.ObjectIdentifier(transport_domain),
-                                   transport_address[0]))
+            mib_instrum = responder.snmpContext.getMibInstrum(context_name)
+            if log.is_enabled(log.LOG_INFO):
+                log.info(
+                    'Using %s selected by contextName "%s", transport ID %s, '
+                    'source address %s', mib_instrum, context_name,
+                    univ.ObjectIdentifier(transport_domain),
+                    transport_address[0])
+
+        CONTEXT_CACHE[cache_key] = context_name, mib_instrum
 
     if not isinstance(mib_instrum, (
             controller.MibInstrumController,
@@ -132,14 +156,89 @@ def probe_hash_context(responder, snmp_engine):
             'LCD access denied (contextName does not match any data file)')
         raise NoDataNotification()
 
+    if ReportingManager.stage_timing:
+        ReportingManager.update_metrics(
+            data_file=mib_instrum.data_file,
+            pduType=execCtx['pdu'].__class__.__name__,
+            stage_context_latency=metrics.clock() - stage_started)
+
     return context_name
 
 
-class GetCommandResponder(cmdrsp.GetCommandResponder):
+class DeferredResponseMixIn(object):
+    """Hold back SNMP responses deferred by variation modules.
+
+    Response gets deferred when variation module delays it or returns
+    a value which is not yet known.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DeferredResponseMixIn, self).__init__(*args, **kwargs)
+        self._deferred_responses = set()
+
+    def sendVarBinds(self, snmp_engine, state_reference,
+                     error_status, error_index, var_binds):
+        response = deferred.current_response()
+
+        if response is None:
+            super(DeferredResponseMixIn, self).sendVarBinds(
+                snmp_engine, state_reference, error_status, error_index,
+                var_binds)
+            return
+
+        if not response.deferred:
+            # held values might have been resolved already
+            super(DeferredResponseMixIn, self).sendVarBinds(
+                snmp_engine, state_reference, error_status, error_index,
+                response.resolve(var_binds))
+            return
+
+        self._deferred_responses.add(state_reference)
+
+        response.complete(
+            self._send_deferred_var_binds, response, snmp_engine,
+            state_reference, error_status, error_index, var_binds)
+
+    def _send_deferred_var_binds(self, response, snmp_engine,
+                                 state_reference, error_status, error_index,
+                                 var_binds):
+        self._deferred_responses.discard(state_reference)
+
+        try:
+            var_binds = response.resolve(var_binds)
+
+            super(DeferredResponseMixIn, self).sendVarBinds(
+                snmp_engine, state_reference, error_status, error_index,
+                var_binds)
+
+        # pysnmp retries GETNEXT past values SNMPv1 can't carry, but
+        # deferred response is sent once its handler is gone
+        except StatusInformation:
+            self._skip_var_bind(
+                snmp_engine, state_reference, var_binds,
+                sys.exc_info()[1]['idx'])
+
+        finally:
+            self.releaseStateInformation(state_reference)
+
+    def _skip_var_bind(self, snmp_engine, state_reference, var_binds, idx):
+        raise StatusInformation(idx=idx)
+
+    def releaseStateInformation(self, state_reference):
+        # deferred response still needs its request state
+        if state_reference not in self._deferred_responses:
+            super(DeferredResponseMixIn, self).releaseStateInformation(
+                state_reference)
+
+
+class GetCommandResponder(DeferredResponseMixIn,
+                          cmdrsp.GetCommandResponder):
     """v3arch GET command handler"""
 
     def handleMgmtOperation(
             self, snmp_engine, state_reference, context_name, pdu, ac_info):
+        deferred.begin_response()
+
         try:
             cmdrsp.GetCommandResponder.handleMgmtOperation(
                 self, snmp_engine, state_reference,
@@ -150,12 +249,18 @@ class GetCommandResponder(cmdrsp.GetCommandResponder):
         except NoDataNotification:
             self.releaseStateInformation(state_reference)
 
+        finally:
+            deferred.end_response()
+
 
-class SetCommandResponder(cmdrsp.SetCommandResponder):
+class SetCommandResponder(DeferredResponseMixIn,
+                          cmdrsp.SetCommandResponder):
     """v3arch SET command handler"""
 
     def handleMgmtOperation(
             self, snmp_engine, state_reference, context_name, pdu, ac_info):
+        deferred.begin_response()
+
         try:
             cmdrsp.SetCommandResponder.handleMgmtOperation(
                 self, snmp_engine, state_reference,
@@ -166,28 +271,93 @@ class SetCommandResponder(cmdrsp.SetCommandResponder):
         except NoDataNotification:
             self.releaseStateInformation(state_reference)
 
+        finally:
+            deferred.end_response()
+
 
-class NextCommandResponder(cmdrsp.NextCommandResponder):
+class NextCommandResponder(DeferredResponseMixIn,
+                           cmdrsp.NextCommandResponder):
     """v3arch GETNEXT command handler"""
 
+    def __init__(self, *args, **kwargs):
+        super(NextCommandResponder, self).__init__(*args, **kwargs)
+        self._requests = {}
+
     def handleMgmtOperation(
             self, snmp_engine, state_reference, context_name, pdu, ac_info):
+        deferred.begin_response()
+
         try:
+            context_name = probe_hash_context(self, snmp_engine)
+
+            # deferred response may need to walk on past the request
+            self._requests[state_reference] = (
+                context_name, snmp_engine.observer.getExecutionContext(
+                    'rfc3412.receiveMessage:request'))
+
             cmdrsp.NextCommandResponder.handleMgmtOperation(
-                self, snmp_engine, state_reference,
-                probe_hash_context(self, snmp_engine),
+                self, snmp_engine, state_reference, context_name,
                 pdu, (None, snmp_engine)  # custom acInfo
             )
 
         except NoDataNotification:
             self.releaseStateInformation(state_reference)
 
+        finally:
+            deferred.end_response()
+
+    def releaseStateInformation(self, state_reference):
+        super(NextCommandResponder, self).releaseStateInformation(
+            state_reference)
+
+        if state_reference not in self._deferred_responses:
+            self._requests.pop(state_reference, None)
+
+    def _skip_var_bind(self, snmp_engine, state_reference, var_binds, idx):
+        context_name, exec_ctx = self._requests[state_reference]
+
+        mib_instrum = self.snmpContext.getMibInstrum(context_name)
+
+        var_binds = list(var_binds)
+
+        # variation modules look up request details there
+        snmp_engine.observer.storeExecutionContext(
+            snmp_engine, 'rfc3412.receiveMessage:request', exec_ctx)
+
+        try:
+            while True:
+                deferred.begin_response()
+
+                try:
+                    var_binds[idx:idx + 1] = mib_instrum.readNextVars(
+                        [(var_binds[idx][0], univ.Null(''))],
+                        (None, snmp_engine))
+
+                    self.sendVarBinds(
+                        snmp_engine, state_reference, 0, 0, var_binds)
 
-class BulkCommandResponder(cmdrsp.BulkCommandResponder):
+                except StatusInformation:
+                    idx = sys.exc_info()[1]['idx']
+
+                else:
+                    break
+
+                finally:
+                    deferred.end_response()
+
+        finally:
+            snmp_engine.observer.clearExecutionContext(
+                snmp_engine, 'rfc3412.receiveMessage:request')
+
+
+class BulkCommandResponder(DeferredResponseMixIn,
+                           cmdrsp.BulkCommandResponder):
     """v3arch GETBULK command handler"""
 
     def handleMgmtOperation(
             self, snmp_engine, state_reference, context_name, pdu, ac_info):
+        deferred.begin_response()
+
         try:
             cmdrsp.BulkCommandResponder.handleMgmtOperation(
                 self, snmp_engine, state_reference,
@@ -198,6 +368,23 @@ class BulkCommandResponder(cmdrsp.BulkCommandResponder):
         except NoDataNotification:
             self.releaseStateInformation(state_reference)
 
+        finally:
+            deferred.end_response()
+
+
+def _parse_positive_int(arg):
+    try:
+        value = int(arg)
+
+    except ValueError:
+        value = 0
+
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            'Value "%s" must be a positive integer' % arg)
+
+    return value
+
 
 def _parse_sized_string(arg, min_length=8):
     if len(arg) < min_length:
@@ -246,11 +433,21 @@ def main():
         '--log-level', choices=log.LEVELS_MAP,
         type=str, default='info', help='Logging level.')
 
+    parser.add_argument(
+        '--logging-queue-size', metavar='<NUMBER>', type=_parse_positive_int,
+        help='Write log messages from a background thread buffering up '
+             'to this many of them, drop messages on buffer overflow '
+             '(file and syslog logging methods only)')
+
     parser.add_argument(
         '--reporting-method', type=lambda x: x.split(':'),
         metavar='=<%s[:args]>]' % '|'.join(ReportingManager.REPORTERS),
         default='null', help='Activity metrics reporting method.')
 
+    parser.add_argument(
+        '--reporting-stage-timing', action='store_true',
+        help='Time SNMP request processing stages for activity reporting')
+
     parser.add_argument(
         '--daemonize', action='store_true',
         help='Disengage from controlling terminal and become a daemon')
@@ -479,6 +676,8 @@ configured automatically based on simulation data file paths relative to
             snmp_helper.print_usage(sys.stderr)
             return 1
 
+        ReportingManager.stage_timing = args.reporting_stage_timing
+
     if args.daemonize:
         try:
             daemon.daemonize(args.pid_file)
@@ -489,6 +688,19 @@ configured automatically based on simulation data file paths relative to
             snmp_helper.print_usage(sys.stderr)
             return 1
 
+    if args.logging_queue_size:
+        try:
+            log.set_async(args.logging_queue_size)
+
+        except SnmpsimError as exc:
+            sys.stderr.write('%s\r\n' % exc)
+            snmp_helper.print_usage(sys.stderr)
+            return 1
+
+    ReportingManager.start()
+
+    ReportingManager.add_probe('context_cache', CONTEXT_CACHE.stats)
+
     if not os.path.exists(confdir.cache):
         try:
             with daemon.PrivilegesOf(args.process_user, args.process_group):
@@ -514,6 +726,9 @@ configured automatically based on simulation data file paths relative to
             snmp_context=None):
         """Build pysnmp Managed Objects base from data files information"""
 
+        # agents set is about to change, forget previous selections
+        CONTEXT_CACHE.clear()
+
         _mib_instrums = {}
         _data_files = {}
 
@@ -601,7 +816,7 @@ configured automatically based on simulation data file paths relative to
 
     # Start configuring SNMP engine(s)
 
-    transport_dispatcher = AsyncoreDispatcher()
+    transport_dispatcher = deferred.AsyncoreDispatcher()
 
     transport_dispatcher.registerRoutingCbFun(lambda td, t, d: td)
 
@@ -924,6 +1139,10 @@ configured automatically based on simulation data file paths relative to
 
                 for name, contexts in variation_modules.items():
                     body = contexts[0]
+
+                    if body['executor']:
+                        body['executor'].shutdown()
+
                     try:
                         body['shutdown'](options=body['args'], mode='variation')
 
@@ -937,6 +1156,8 @@ configured automatically based on simulation data file paths relative to
 
             transport_dispatcher.closeDispatcher()
 
+            ReportingManager.close()
+
             log.info('Process terminated')
 
     return 0
@@ -18,7 +18,6 @@ from pyasn1.type import univ
 from pysnmp import debug as pysnmp_debug
 from pysnmp.carrier.asyncore.dgram import udp
 from pysnmp.carrier.asyncore.dgram import udp6
-from pysnmp.carrier.asyncore.dispatch import AsyncoreDispatcher
 from pysnmp.proto import api
 from pysnmp.proto import rfc1902
 from pysnmp.proto import rfc1905
@@ -27,12 +26,14 @@ from snmpsim import confdir
 from snmpsim import controller
 from snmpsim import daemon
 from snmpsim import datafile
+from snmpsim import deferred
 from snmpsim import endpoints
 from snmpsim import log
 from snmpsim import utils
 from snmpsim import variation
 from snmpsim.error import NoDataNotification
 from snmpsim.error import SnmpsimError
+from snmpsim.reporting import metrics
 from snmpsim.reporting.manager import ReportingManager
 
 SNMP_2TO1_ERROR_MAP = {
@@ -48,6 +49,20 @@ DESCRIPTION = (
     'or via variation modules.')
 
 
+def _parse_positive_int(arg):
+    try:
+        value = int(arg)
+
+    except ValueError:
+        value = 0
+
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            'Value "%s" must be a positive integer' % arg)
+
+    return value
+
+
 def main():
 
     parser = argparse.ArgumentParser(description=DESCRIPTION)
@@ -79,11 +94,21 @@ def main():
         '--log-level', choices=log.LEVELS_MAP,
         type=str, default='info', help='Logging level.')
 
+    parser.add_argument(
+        '--logging-queue-size', metavar='<NUMBER>', type=_parse_positive_int,
+        help='Write log messages from a background thread buffering up '
+             'to this many of them, drop messages on buffer overflow '
+             '(file and syslog logging methods only)')
+
     parser.add_argument(
         '--reporting-method', type=lambda x: x.split(':'),
         metavar='=<%s[:args]>]' % '|'.join(ReportingManager.REPORTERS),
         default='null', help='Activity metrics reporting method.')
 
+    parser.add_argument(
+        '--reporting-stage-timing', action='store_true',
+        help='Time SNMP request processing stages for activity reporting')
+
     parser.add_argument(
         '--daemonize', action='store_true',
         help='Disengage from controlling terminal and become a daemon')
@@ -199,6 +224,8 @@ def main():
             parser.print_usage(sys.stderr)
             return 1
 
+        ReportingManager.stage_timing = args.reporting_stage_timing
+
     if args.daemonize:
         try:
             daemon.daemonize(args.pid_file)
@@ -209,6 +236,17 @@ def main():
             parser.print_usage(sys.stderr)
             return 1
 
+    if args.logging_queue_size:
+        try:
+            log.set_async(args.logging_queue_size)
+
+        except SnmpsimError as exc:
+            sys.stderr.write('%s\r\n' % exc)
+            parser.print_usage(sys.stderr)
+            return 1
+
+    ReportingManager.start()
+
     if not os.path.exists(confdir.cache):
         try:
             with daemon.PrivilegesOf(args.process_user, args.process_group):
@@ -229,11 +267,18 @@ def main():
         variation.initialize_variation_modules(
             variation_modules, mode='variating')
 
+    context_cache = datafile.ContextCache()
+
+    ReportingManager.add_probe('context_cache', context_cache.stats)
+
     def configure_managed_objects(
             data_dirs, data_index_instrum_controller, snmp_engine=None,
             snmp_context=None):
         """Build pysnmp Managed Objects base from data files information"""
 
+        # agents set is about to change, forget previous selections
+        context_cache.clear()
+
         _mib_instrums = {}
         _data_files = {}
 
@@ -316,11 +361,45 @@ def main():
 
         return rsp_var_binds
 
+    def send_response(
+            response, transport_domain, transport_address, msg_ver, p_mod,
+            req_pdu, rsp_msg, var_binds):
+        """Put (possibly deferred) var-binds into SNMP response, send it"""
+        rsp_pdu = p_mod.apiMessage.getPDU(rsp_msg)
+
+        var_binds = response.resolve(var_binds)
+
+        if not msg_ver:
+
+            for idx in range(len(var_binds)):
+
+                oid, val = var_binds[idx]
+
+                if val.tagSet in SNMP_2TO1_ERROR_MAP:
+                    var_binds = p_mod.apiPDU.getVarBinds(req_pdu)
+
+                    p_mod.apiPDU.setErrorStatus(
+                        rsp_pdu, SNMP_2TO1_ERROR_MAP[val.tagSet])
+                    p_mod.apiPDU.setErrorIndex(
+                        rsp_pdu, idx + 1)
+
+                    break
+
+        p_mod.apiPDU.setVarBinds(rsp_pdu, var_binds)
+
+        transport_dispatcher.sendMessage(
+            encoder.encode(rsp_msg), transport_domain, transport_address)
+
     def commandResponderCbFun(
             transport_dispatcher, transport_domain, transport_address,
             whole_msg):
         """v2c arch command responder request handling callback"""
+        timing = ReportingManager.stage_timing
+
         while whole_msg:
+            if timing:
+                stage_started = metrics.clock()
+
             msg_ver = api.decodeMessageVersion(whole_msg)
 
             if msg_ver in api.protoModules:
@@ -332,24 +411,34 @@ def main():
 
             req_msg, whole_msg = decoder.decode(whole_msg, asn1Spec=p_mod.Message())
 
+            if timing:
+                now = metrics.clock()
+                decode_time = now - stage_started
+                stage_started = now
+
             community_name = req_msg.getComponentByPosition(1)
 
-            for candidate in datafile.probe_context(
-                    transport_domain, transport_address,
-                    context_engine_id=datafile.SELF_LABEL,
-                    context_name=community_name):
-                if candidate in contexts:
-                    log.info(
-                        'Using %s selected by candidate %s; transport ID %s, '
-                        'source address %s, context engine ID <empty>, '
-                        'community name '
-                        '"%s"' % (contexts[candidate], candidate,
-                                  univ.ObjectIdentifier(transport_domain),
-                                  transport_address[0], community_name))
-                    community_name = candidate
-                    break
+            cache_key = datafile.probe_context_key(
+                transport_domain, transport_address,
+                datafile.SELF_LABEL, community_name)
+
+            if cache_key in context_cache:
+                candidate = context_cache[cache_key]
 
             else:
+                for candidate in datafile.probe_context(
+                        transport_domain, transport_address,
+                        context_engine_id=datafile.SELF_LABEL,
+                        context_name=community_name):
+                    if candidate in contexts:
+                        break
+
+                else:
+                    candidate = None
+
+                context_cache[cache_key] = candidate
+
+            if candidate is None:
                 log.error(
                     'No data file selected for transport ID %s, source '
                     'address %s, community name '
@@ -357,8 +446,20 @@ def main():
                               transport_address[0], community_name))
                 return whole_msg
 
+            if log.is_enabled(log.LOG_INFO):
+                log.info(
+                    'Using %s selected by candidate %s; transport ID %s, '
+                    'source address %s, context engine ID <empty>, '
+                    'community name "%s"', contexts[candidate], candidate,
+                    univ.ObjectIdentifier(transport_domain),
+                    transport_address[0], community_name)
+
+            community_name = candidate
+
+            if timing:
+                context_time = metrics.clock() - stage_started
+
             rsp_msg = p_mod.apiMessage.getResponse(req_msg)
-            rsp_pdu = p_mod.apiMessage.getPDU(rsp_msg)
             req_pdu = p_mod.apiMessage.getPDU(req_msg)
 
             if req_pdu.isSameTypeWith(p_mod.GetRequestPDU()):
@@ -393,6 +494,8 @@ def main():
                                transport_address))
                 return whole_msg
 
+            deferred.begin_response()
+
             try:
                 var_binds = backend_fun(p_mod.apiPDU.getVarBinds(req_pdu))
 
@@ -403,26 +506,23 @@ def main():
                 log.error('Ignoring SNMP engine failure: %s' % exc)
                 return whole_msg
 
-            if not msg_ver:
-
-                for idx in range(len(var_binds)):
+            finally:
+                response = deferred.end_response()
 
-                    oid, val = var_binds[idx]
+            if timing:
+                stage_started = metrics.clock()
 
-                    if val.tagSet in SNMP_2TO1_ERROR_MAP:
-                        var_binds = p_mod.apiPDU.getVarBinds(req_pdu)
+            response.complete(
+                send_response, response, transport_domain, transport_address,
+                msg_ver, p_mod, req_pdu, rsp_msg, var_binds)
 
-                        p_mod.apiPDU.setErrorStatus(
-                            rsp_pdu, SNMP_2TO1_ERROR_MAP[val.tagSet])
-                        p_mod.apiPDU.setErrorIndex(
-                            rsp_pdu, idx + 1)
-
-                        break
-
-            p_mod.apiPDU.setVarBinds(rsp_pdu, var_binds)
-
-            transport_dispatcher.sendMessage(
-                encoder.encode(rsp_msg), transport_domain, transport_address)
+            if timing:
+                ReportingManager.update_metrics(
+                    data_file=contexts[community_name].data_file,
+                    pduType=req_pdu.__class__.__name__,
+                    stage_decode_latency=decode_time,
+                    stage_context_latency=context_time,
+                    stage_encode_latency=metrics.clock() - stage_started)
 
         return whole_msg
 
@@ -442,7 +542,7 @@ def main():
     contexts['index'] = data_index_instrum_controller
 
     # Configure socket server
-    transport_dispatcher = AsyncoreDispatcher()
+    transport_dispatcher = deferred.AsyncoreDispatcher()
 
     transport_index = args.transport_id_offset
     for agent_udpv4_endpoint in args.agent_udpv4_endpoints:
@@ -493,6 +593,10 @@ def main():
 
                 for name, contexts in variation_modules.items():
                     body = contexts[0]
+
+                    if body['executor']:
+                        body['executor'].shutdown()
+
                     try:
                         body['shutdown'](options=body['args'], mode='variation')
 
@@ -506,6 +610,8 @@ def main():
 
             transport_dispatcher.closeDispatcher()
 
+            ReportingManager.close()
+
             log.info('Process terminated')
 
     return 0
@@ -25,6 +25,10 @@ class MibInstrumController(object):
     def __str__(self):
         return str(self._data_file)
 
+    @property
+    def data_file(self):
+        return self._data_file.text_file
+
     def _get_call_context(self, ac_info, next_flag=False, set_flag=False):
         if ac_info is None:
             return {'nextFlag': next_flag,
@@ -61,13 +65,14 @@ class MibInstrumController(object):
         else:
             transport_protocol = 'unknown'
 
-        log.info(
-            'SNMP EngineID %s, transportDomain %s, transportAddress %s, '
-            'securityModel %s, securityName %s, securityLevel '
-            '%s' % (hasattr(snmp_engine, 'snmpEngineID') and
-                    snmp_engine.snmpEngineID.prettyPrint() or '<unknown>',
-                    transport_domain, transport_address, security_model,
-                    security_name, security_level))
+        if log.is_enabled(log.LOG_INFO):
+            log.info(
+                'SNMP EngineID %s, transportDomain %s, transportAddress %s, '
+                'securityModel %s, securityName %s, securityLevel %s',
+                hasattr(snmp_engine, 'snmpEngineID') and
+                snmp_engine.snmpEngineID.prettyPrint() or '<unknown>',
+                transport_domain, transport_address, security_model,
+                security_name, security_level)
 
         return {'snmpEngine': snmp_engine,
                 'transportDomain': rfc1902.ObjectIdentifier(transport_domain),
@@ -109,6 +114,10 @@ class DataIndexInstrumController(object):
     def __str__(self):
         return '<index> controller'
 
+    @property
+    def data_file(self):
+        return None
+
     def readVars(self, var_binds, acInfo=None):
         return [(vb[0], self._db.get(vb[0], exval.noSuchInstance))
                 for vb in var_binds]
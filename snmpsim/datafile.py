@@ -6,6 +6,7 @@
 #
 # Simulation data file management tools
 #
+import collections
 import os
 import stat
 
@@ -18,6 +19,7 @@ from pysnmp.proto import rfc1902
 from pysnmp.smi import exval
 from pysnmp.smi.error import MibOperationError
 
+from snmpsim import deferred
 from snmpsim import log
 from snmpsim import variation
 from snmpsim.error import NoDataNotification
@@ -25,6 +27,7 @@ from snmpsim.error import SnmpsimError
 from snmpsim.record.search.database import RecordIndex
 from snmpsim.record.search.file import get_record
 from snmpsim.record.search.file import search_record_by_oid
+from snmpsim.reporting import metrics
 from snmpsim.reporting.manager import ReportingManager
 
 SELF_LABEL = 'self'
@@ -40,11 +43,16 @@ class DataFile(AbstractLayout):
     max_queue_entries = 31  # max number of open text and index files
 
     def __init__(self, textFile, textParser, variationModules):
-        self._record_index = RecordIndex(textFile, textParser)
+        self._record_index = RecordIndex(
+            textFile, textParser, variationModules)
         self._text_parser = textParser
         self._text_file = textFile
         self._variation_modules = variationModules
 
+    @property
+    def text_file(self):
+        return self._text_file
+
     def index_text(self, forceIndexBuild=False, validateData=False):
         self._record_index.create(forceIndexBuild, validateData)
         return self
@@ -90,124 +98,72 @@ class DataFile(AbstractLayout):
         vars_remaining = vars_total = len(var_binds)
         err_total = 0
 
-        log.info(
-            'Request var-binds: %s, flags: %s, '
-            '%s' % (', '.join(['%s=<%s>' % (vb[0], vb[1].prettyPrint())
-                               for vb in var_binds]),
-                    context.get('nextFlag') and 'NEXT' or 'EXACT',
-                    context.get('setFlag') and 'SET' or 'GET'))
-
-        for oid, val in var_binds:
-            text_oid = str(univ.OctetString('.'.join(['%s' % x for x in oid])))
-
-            try:
-                line = self._record_index.lookup(
-                    str(univ.OctetString('.'.join(['%s' % x for x in oid]))))
+        # lookup, read and variation stages latencies
+        timings = ReportingManager.stage_timing and [0, 0, 0]
 
-            except KeyError:
-                offset = search_record_by_oid(oid, text, self._text_parser)
-                subtree_flag = exact_match = False
+        if log.is_enabled(log.LOG_INFO):
+            log.info(
+                'Request var-binds: %s, flags: %s, %s',
+                ', '.join(['%s=<%s>' % (vb[0], vb[1].prettyPrint())
+                           for vb in var_binds]),
+                context.get('nextFlag') and 'NEXT' or 'EXACT',
+                context.get('setFlag') and 'SET' or 'GET')
 
-            else:
-                offset, subtree_flag, prev_offset = line.split(str2octs(','), 2)
-                subtree_flag, exact_match = int(subtree_flag), True
+        # var-binds routed to modules implementing variate_many()
+        batch = variation.VariationBatch(
+            self._variation_modules, dataFile=self._text_file,
+            errorStatus=error_status, varsTotal=vars_total, **context)
 
-            offset = int(offset)
+        batched = []
 
-            text.seek(offset)
+        for oid, val in var_binds:
+            # GETBULK repetitions come with values of the previous ones
+            if isinstance(val, deferred.Pending):
+                val = univ.Null('')
 
             vars_remaining -= 1
 
-            line, _, _ = get_record(text)  # matched line
-
-            while True:
-                if exact_match:
-                    if context.get('nextFlag') and not subtree_flag:
-
-                        _next_line, _, _ = get_record(text)  # next line
-
-                        if _next_line:
-                            _next_oid, _ = self._text_parser.evaluate(
-                                _next_line, oidOnly=True)
-
-                            try:
-                                _, subtree_flag, _ = self._record_index.lookup(
-                                    str(_next_oid)).split(str2octs(','), 2)
-
-                            except KeyError:
-                                log.error(
-                                    'data error for %s at %s, index '
-                                    'broken?' % (self, _next_oid))
-                                line = ''  # fatal error
+            _oid, _val, failed = self._process_var_bind(
+                text, oid, val, timings, errorStatus=error_status,
+                varsTotal=vars_total, varsRemaining=vars_remaining,
+                variationBatch=batch, **context)
 
-                            else:
-                                subtree_flag = int(subtree_flag)
-                                line = _next_line
+            if isinstance(_val, variation.BatchedValue):
+                batched.append((len(rsp_var_binds), oid, val, vars_remaining))
 
-                        else:
-                            line = _next_line
-
-                else:  # search function above always rounds up to the next OID
-                    if line:
-                        _oid, _ = self._text_parser.evaluate(
-                            line, oidOnly=True
-                        )
+            err_total += failed
 
-                    else:  # eom
-                        _oid = 'last'
-
-                    try:
-                        _, _, _prev_offset = self._record_index.lookup(
-                            str(_oid)).split(str2octs(','), 2)
-
-                    except KeyError:
-                        log.error(
-                            'data error for %s at %s, index '
-                            'broken?' % (self, _oid))
-                        line = ''  # fatal error
+            rsp_var_binds.append((_oid, _val))
 
-                    else:
-                        _prev_offset = int(_prev_offset)
+        # records walked on to may get batched again
+        while batched:
+            if timings:
+                stage_started = metrics.clock()
 
-                        # previous line serves a subtree?
-                        if _prev_offset >= 0:
-                            text.seek(_prev_offset)
-                            _prev_line, _, _ = get_record(text)
-                            _prev_oid, _ = self._text_parser.evaluate(
-                                _prev_line, oidOnly=True)
+            batch.run()
 
-                            if _prev_oid.isPrefixOf(oid):
-                                # use previous line to the matched one
-                                line = _prev_line
-                                subtree_flag = True
+            if timings:
+                timings[2] += metrics.clock() - stage_started
 
-                if not line:
-                    _oid = oid
-                    _val = error_status
-                    break
-
-                call_context = context.copy()
-                call_context.update(
-                    (),
-                    origOid=oid,
-                    origValue=val,
-                    dataFile=self._text_file,
-                    subtreeFlag=subtree_flag,
-                    exactMatch=exact_match,
-                    errorStatus=error_status,
-                    varsTotal=vars_total,
-                    varsRemaining=vars_remaining,
-                    variationModules=self._variation_modules
-                )
+            rebatched = []
 
+            for idx, oid, val, vars_remaining in batched:
                 try:
-                    _oid, _val = self._text_parser.evaluate(
-                        line, **call_context)
+                    _oid, _val = rsp_var_binds[idx][1].result()
 
+                    failed = False
+
+                    # variation module skipped the record, walk on by one
                     if _val is exval.endOfMib:
-                        exact_match = True
-                        subtree_flag = False
-                        continue
+                        _oid, _val, failed = self._process_var_bind(
+                            text, oid, val, timings,
+                            skipped_oid=rsp_var_binds[idx][0],
+                            errorStatus=error_status,
+                            varsTotal=vars_total, varsRemaining=vars_remaining,
+                            variationBatch=batch, **context)
+
+                        if isinstance(_val, variation.BatchedValue):
+                            rebatched.append((idx, oid, val, vars_remaining))
 
                 except NoDataNotification:
                     raise
@@ -218,18 +174,20 @@ class DataFile(AbstractLayout):
                 except Exception as exc:
                     _oid = oid
                     _val = error_status
-                    err_total += 1
-                    log.error(
-                        'data error at %s for %s: %s' % (self, text_oid, exc))
+                    failed = True
+                    log.error('data error at %s for %s: %s', self, oid, exc)
 
-                break
+                err_total += failed
 
-            rsp_var_binds.append((_oid, _val))
+                rsp_var_binds[idx] = _oid, _val
+
+            batched = rebatched
 
-        log.info(
-            'Response var-binds: %s' % (
-                ', '.join(['%s=<%s>' % (
-                    vb[0], vb[1].prettyPrint()) for vb in rsp_var_binds])))
+        if log.is_enabled(log.LOG_INFO):
+            log.info(
+                'Response var-binds: %s',
+                ', '.join(['%s=<%s>' % (vb[0], vb[1].prettyPrint())
+                           for vb in rsp_var_binds]))
 
         ReportingManager.update_metrics(
             data_file=self._text_file, varbind_count=vars_total,
@@ -237,8 +195,176 @@ class DataFile(AbstractLayout):
             transport_call_count=1,
             **context)
 
+        if timings:
+            ReportingManager.update_metrics(
+                data_file=self._text_file,
+                stage_lookup_latency=timings[0],
+                stage_read_latency=timings[1],
+                stage_variation_latency=timings[2],
+                **context)
+
         return rsp_var_binds
 
+    def _process_var_bind(self, text, oid, val, timings, skipped_oid=None,
+                          **context):
+        """Look up simulation data record and evaluate response var-bind.
+
+        With `skipped_oid` given, GETNEXT lookup resumes with the record
+        following the one at `skipped_oid`, as if variation module serving
+        it has just answered with *endOfMib*.
+
+        Returns
+        -------
+        : :py:class:`tuple`
+            response OID, value and data error flag. The value may be
+            :py:class:`variation.BatchedValue` if `variationBatch` is
+            present in `context`.
+        """
+        error_status = context['errorStatus']
+
+        if timings:
+            stage_started = metrics.clock()
+
+        text_oid = str(univ.OctetString('.'.join(['%s' % x for x in oid])))
+
+        try:
+            if skipped_oid is None:
+                line = self._record_index.lookup(text_oid)
+
+            else:
+                line = self._record_index.lookup(str(skipped_oid))
+
+        except KeyError:
+            offset = search_record_by_oid(oid, text, self._text_parser)
+            subtree_flag = exact_match = False
+
+        else:
+            offset, subtree_flag, prev_offset = line.split(str2octs(','), 2)
+            subtree_flag, exact_match = int(subtree_flag), True
+
+            if skipped_oid is not None:
+                subtree_flag = False
+
+        offset = int(offset)
+
+        if timings:
+            now = metrics.clock()
+            timings[0] += now - stage_started
+            stage_started = now
+
+        text.seek(offset)
+
+        line, _, _ = get_record(text)  # matched line
+
+        while True:
+            if exact_match:
+                if context.get('nextFlag') and not subtree_flag:
+
+                    _next_line, _, _ = get_record(text)  # next line
+
+                    if _next_line:
+                        _next_oid, _ = self._text_parser.evaluate(
+                            _next_line, oidOnly=True)
+
+                        try:
+                            _, subtree_flag, _ = self._record_index.lookup(
+                                str(_next_oid)).split(str2octs(','), 2)
+
+                        except KeyError:
+                            log.error(
+                                'data error for %s at %s, index '
+                                'broken?' % (self, _next_oid))
+                            line = ''  # fatal error
+
+                        else:
+                            subtree_flag = int(subtree_flag)
+                            line = _next_line
+
+                    else:
+                        line = _next_line
+
+            else:  # search function above always rounds up to the next OID
+                if line:
+                    _oid, _ = self._text_parser.evaluate(
+                        line, oidOnly=True
+                    )
+
+                else:  # eom
+                    _oid = 'last'
+
+                try:
+                    _, _, _prev_offset = self._record_index.lookup(
+                        str(_oid)).split(str2octs(','), 2)
+
+                except KeyError:
+                    log.error(
+                        'data error for %s at %s, index '
+                        'broken?' % (self, _oid))
+                    line = ''  # fatal error
+
+                else:
+                    _prev_offset = int(_prev_offset)
+
+                    # previous line serves a subtree?
+                    if _prev_offset >= 0:
+                        text.seek(_prev_offset)
+                        _prev_line, _, _ = get_record(text)
+                        _prev_oid, _ = self._text_parser.evaluate(
+                            _prev_line, oidOnly=True)
+
+                        if _prev_oid.isPrefixOf(oid):
+                            # use previous line to the matched one
+                            line = _prev_line
+                            subtree_flag = True
+
+            if not line:
+                return oid, error_status, False
+
+            call_context = context.copy()
+            call_context.update(
+                (),
+                origOid=oid,
+                origValue=val,
+                dataFile=self._text_file,
+                subtreeFlag=subtree_flag,
+                exactMatch=exact_match,
+                variationModules=self._variation_modules,
+                recordIndex=self._record_index
+            )
+
+            if timings:
+                now = metrics.clock()
+                timings[1] += now - stage_started
+                stage_started = now
+
+            try:
+                _oid, _val = self._text_parser.evaluate(
+                    line, **call_context)
+
+                if timings:
+                    now = metrics.clock()
+                    timings[2] += now - stage_started
+                    stage_started = now
+
+                if _val is exval.endOfMib:
+                    exact_match = True
+                    subtree_flag = False
+                    continue
+
+            except NoDataNotification:
+                raise
+
+            except MibOperationError:
+                raise
+
+            except Exception as exc:
+                log.error(
+                    'data error at %s for %s: %s', self, text_oid, exc)
+
+                return oid, error_status, True
+
+            return _oid, _val, False
+
     def __str__(self):
         return '%s controller' % self._text_file
 
@@ -337,3 +463,69 @@ def probe_context(transport_domain, transport_address,
         for candidate in probe_context(
                 transport_domain, transport_address, None, context_name):
             yield candidate
+
+
+def probe_context_key(transport_domain, transport_address,
+                      context_engine_id, context_name):
+    """Build a hashable key fully determining `probe_context` outcome
+    """
+    if transport_domain[:len(udp.domainName)] == udp.domainName:
+        transport_address = transport_address[0]
+
+    elif udp6 and transport_domain[:len(udp6.domainName)] == udp6.domainName:
+        transport_address = transport_address[0]
+
+    return (tuple(transport_domain), transport_address,
+            context_engine_id, context_name)
+
+
+class ContextCache(object):
+    """Bounded memo of simulation data selection outcomes.
+
+    With a fixed set of simulated agents, the data file serving a request
+    depends only on request transport domain, source address, context
+    engine ID and context (community) name. Once resolved, the choice is
+    remembered here so that subsequent requests need just a dict lookup
+    instead of probing all candidates over again.
+
+    The cache must be cleared whenever simulation data directories get
+    (re)scanned.
+
+    Cache hits and misses are counted and can be reported along with
+    other activity metrics by way of `stats()`.
+    """
+    MAX_ENTRIES = 4096
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self._max_entries = max_entries
+        self._cache = collections.OrderedDict()
+        self._hits = self._misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        if key in self._cache:
+            self._hits += 1
+            return True
+
+        self._misses += 1
+        return False
+
+    def __getitem__(self, key):
+        return self._cache[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._cache:
+            while len(self._cache) >= self._max_entries:
+                self._cache.popitem(last=False)
+
+        self._cache[key] = value
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return {'hits_total': self._hits,
+                'misses_total': self._misses,
+                'entries': len(self._cache)}
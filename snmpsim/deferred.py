@@ -0,0 +1,530 @@
+#
+# This file is part of snmpsim software.
+#
+# Copyright (c) 2010-2019, Ilya Etingof <etingof@gmail.com>
+# License: http://snmplabs.com/snmpsim/license.html
+#
+# SNMP Agent Simulator: deferred SNMP responses support
+#
+import asyncore
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import fcntl
+
+except ImportError:
+    fcntl = None
+
+try:
+    import queue
+
+except ImportError:
+    import Queue as queue
+
+from pysnmp.carrier.asyncore import dispatch
+from pysnmp.error import PySnmpError
+
+from snmpsim import error
+from snmpsim import log
+
+
+class TimerHandle(object):
+    """Scheduled call which can be called off before it is due"""
+    __slots__ = ('cb_fun', 'args', 'cancelled', '_queue')
+
+    def __init__(self, queue, cb_fun, args):
+        self._queue = queue
+        self.cb_fun = cb_fun
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self._queue._cancel(self)
+
+
+class TimerQueue(object):
+    """Run callables once their deadlines expire.
+
+    Deadlines are kept in a heap, so the nearest one is always
+    readily known to the I/O loop.
+
+    Scheduled calls can be cancelled through the handle returned by
+    `call_at()`/`call_later()`. Cancelled calls are skipped when due and
+    swept out of the heap once they make up most of it.
+
+    Other threads can hand their calls over to the I/O loop thread
+    with `call_soon_threadsafe()`.
+    """
+    # do not bother sweeping out cancelled calls from a heap smaller than this
+    SWEEP_THRESHOLD = 256
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._cancelled = 0
+        self.waker = None
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_at(self, deadline, cb_fun, *args):
+        handle = TimerHandle(self, cb_fun, args)
+
+        with self._lock:
+            heapq.heappush(
+                self._heap, (deadline, next(self._seq), handle))
+
+        return handle
+
+    def call_later(self, delay, cb_fun, *args):
+        return self.call_at(time.time() + delay, cb_fun, *args)
+
+    def call_soon_threadsafe(self, cb_fun, *args):
+        handle = self.call_at(0, cb_fun, *args)
+
+        if self.waker:
+            self.waker.wake()
+
+        return handle
+
+    def _cancel(self, handle):
+        with self._lock:
+            if handle.cancelled:
+                return
+
+            handle.cancelled = True
+            handle.cb_fun = handle.args = None
+
+            self._cancelled += 1
+
+            if (self._cancelled > self.SWEEP_THRESHOLD and
+                    self._cancelled * 2 > len(self._heap)):
+                self._heap = [x for x in self._heap if not x[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def get_timeout(self, timeout):
+        """Time to wait for I/O not to miss the nearest deadline"""
+        heap = self._heap
+
+        if heap:
+            return max(0, min(timeout, heap[0][0] - time.time()))
+
+        return timeout
+
+    def run(self, now=None):
+        """Invoke all callables which deadlines have expired"""
+        if now is None:
+            now = time.time()
+
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    break
+
+                _, _, handle = heapq.heappop(self._heap)
+
+                if handle.cancelled:
+                    self._cancelled -= 1
+                    continue
+
+                # due call can no longer be cancelled
+                cb_fun, args = handle.cb_fun, handle.args
+                handle.cancelled = True
+
+            try:
+                cb_fun(*args)
+
+            except Exception:
+                log.error(
+                    'Deferred call %s failed: %s' % (
+                        cb_fun, ';'.join(
+                            traceback.format_exception(*sys.exc_info()))))
+
+
+TIMERS = TimerQueue()
+
+
+class Pending(object):
+    """Var-bind value to become known later.
+
+    Variation module can return `Pending` object in place of the value
+    and resolve it (by calling either `set_result()` or `set_exception()`)
+    once the value is known. Command responder holds the response until
+    all its pending values are resolved.
+
+    Pending values must be resolved from within the I/O loop e.g. from
+    a `TIMERS` call or a socket handler registered with the I/O loop.
+    """
+    def __init__(self):
+        self._done = False
+        self._result = self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, cb_fun):
+        if self._done:
+            cb_fun(self)
+
+        else:
+            self._callbacks.append(cb_fun)
+
+    def set_result(self, result):
+        self._resolve(result, None)
+
+    def set_exception(self, exception):
+        self._resolve(None, exception)
+
+    def _resolve(self, result, exception):
+        if self._done:
+            return
+
+        self._done = True
+        self._result, self._exception = result, exception
+
+        callbacks, self._callbacks = self._callbacks, []
+
+        for cb_fun in callbacks:
+            cb_fun(self)
+
+    def then(self, fun):
+        """Chain up a new `Pending` resolved by `fun(result)`"""
+        pending = Pending()
+
+        def cb_fun(source):
+            try:
+                pending.set_result(fun(source.result()))
+
+            except Exception as exc:
+                pending.set_exception(exc)
+
+        self.add_done_callback(cb_fun)
+
+        return pending
+
+    def prettyPrint(self):
+        return '<pending>'
+
+
+class Response(object):
+    """SNMP response being built.
+
+    Variation modules can ask for the response to be held back for a
+    while (e.g. to simulate slow agent) by calling `delay()`, rather than
+    blocking the whole process by sleeping. Var-bind values which are
+    not yet known get registered by `hold()`.
+
+    Command responder completes the response by handing the
+    response-sending callable to `complete()`. The callable is invoked
+    right away or once the deadline expires and all held values are
+    resolved, whichever comes last. The callable is expected to substitute
+    held values in var-binds by way of `resolve()`.
+    """
+    # give up on pending values after this many seconds
+    PENDING_TIMEOUT = 30
+
+    def __init__(self):
+        self._deadline = None
+        self._held = {}
+        self._outstanding = 0
+        self._completion = None
+        self._timers = ()
+
+    @property
+    def deferred(self):
+        return self._deadline is not None or self._outstanding > 0
+
+    def delay(self, seconds):
+        """Hold the response back for another `seconds`"""
+        self._deadline = max(self._deadline or 0, time.time()) + seconds
+
+    def hold(self, pending, fallback, expired=None):
+        """Hold the response until `pending` value gets resolved.
+
+        Should `pending` fail, `fallback` value is used in its place.
+        Optional `expired` callable is invoked if `pending` is given up
+        on before it gets resolved.
+        """
+        self._held[id(pending)] = pending, fallback, expired
+        self._outstanding += 1
+
+        pending.add_done_callback(self._release)
+
+    def _release(self, pending):
+        self._outstanding -= 1
+        self._finish_if_ready()
+
+    def _expire(self):
+        self._deadline = None
+        self._finish_if_ready()
+
+    def _finish_if_ready(self):
+        if (self._completion and not self._outstanding and
+                self._deadline is None):
+            self._finish()
+
+    def _give_up(self):
+        if self._completion:
+            self._finish()
+
+    def _finish(self):
+        cb_fun, args = self._completion
+        self._completion = None
+
+        for timer in self._timers:
+            timer.cancel()
+
+        self._timers = ()
+
+        cb_fun(*args)
+
+    def complete(self, cb_fun, *args):
+        if not self.deferred:
+            cb_fun(*args)
+            return
+
+        self._completion = cb_fun, args
+
+        timers = []
+
+        if self._deadline is not None:
+            timers.append(TIMERS.call_at(self._deadline, self._expire))
+
+        if self._outstanding:
+            timers.append(
+                TIMERS.call_later(self.PENDING_TIMEOUT, self._give_up))
+
+        self._timers = timers
+
+    def resolve(self, var_binds):
+        """Replace held values in `var_binds` with what they resolved to"""
+        if not self._held:
+            return var_binds
+
+        resolved = []
+
+        for oid, value in var_binds:
+            if id(value) in self._held:
+                pending, fallback, expired = self._held[id(value)]
+
+                if pending.done() and pending.exception() is None:
+                    value = pending.result()
+
+                else:
+                    if pending.done():
+                        log.error(
+                            'Pending value for %s failed: '
+                            '%s' % (oid, pending.exception()))
+
+                    else:
+                        log.error('Pending value for %s timed out' % (oid,))
+
+                        if expired:
+                            expired()
+
+                    value = fallback
+
+            resolved.append((oid, value))
+
+        return resolved
+
+
+# response being built is only visible to the I/O loop thread
+_local = threading.local()
+
+
+def begin_response():
+    """Start building SNMP response to the request being processed"""
+    _local.response = response = Response()
+
+    return response
+
+
+def end_response():
+    """Done building SNMP response, no more changes to it"""
+    response, _local.response = getattr(_local, 'response', None), None
+
+    return response
+
+
+def current_response():
+    """SNMP response being currently built or `None`"""
+    return getattr(_local, 'response', None)
+
+
+class Waker(getattr(asyncore, 'file_dispatcher', object)):
+    """Interrupt I/O loop waiting from other threads"""
+
+    def __init__(self, sock_map):
+        read_fd, self._write_fd = os.pipe()
+
+        # dispatcher makes its own non-blocking copy of read end
+        asyncore.file_dispatcher.__init__(self, read_fd, map=sock_map)
+
+        os.close(read_fd)
+
+        flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, b'x')
+
+        except OSError:
+            pass  # pipe is full, wake up is due anyway
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+
+        except OSError:
+            pass
+
+    def writable(self):
+        return False
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+
+class AsyncoreDispatcher(dispatch.AsyncoreDispatcher):
+    """I/O loop serving deferred calls along with network I/O"""
+
+    def __init__(self):
+        dispatch.AsyncoreDispatcher.__init__(self)
+
+        # asyncore can only watch pipes on POSIX
+        if fcntl and hasattr(asyncore, 'file_dispatcher'):
+            TIMERS.waker = Waker(self.getSocketMap())
+
+    def runDispatcher(self, timeout=0.0):
+        while self.jobsArePending() or self.transportsAreWorking():
+            try:
+                asyncore.loop(
+                    TIMERS.get_timeout(timeout or self.getTimerResolution()),
+                    use_poll=True, map=self.getSocketMap(), count=1)
+
+            except KeyboardInterrupt:
+                raise
+
+            except Exception:
+                raise PySnmpError('poll error: %s' % ';'.join(
+                    traceback.format_exception(*sys.exc_info())))
+
+            now = time.time()
+
+            self.handleTimerTick(now)
+
+            TIMERS.run(now)
+
+    def closeDispatcher(self):
+        if TIMERS.waker:
+            TIMERS.waker.close()
+            TIMERS.waker = None
+
+        dispatch.AsyncoreDispatcher.closeDispatcher(self)
+
+
+class ThreadPoolExecutor(object):
+    """Run blocking calls in a bounded pool of worker threads.
+
+    Each submitted call immediately yields a `Pending` object which gets
+    resolved, within the I/O loop thread, with the outcome of the call.
+    Calls not completed in `timeout` seconds fail.
+    """
+    def __init__(self, name, workers, timeout):
+        self._name = name
+        self._workers = workers
+        self._timeout = timeout
+        self._queue = queue.Queue()
+        self._threads = []
+        self._calls = self._timeouts = 0
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def submit(self, fun, *args):
+        # start threads lazily, past possible daemonization
+        if not self._threads:
+            for _ in range(self._workers):
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+        pending = Pending()
+
+        self._queue.put((pending, fun, args))
+
+        self._calls += 1
+
+        timer = TIMERS.call_later(self._timeout, self._expire, pending)
+
+        pending.add_done_callback(lambda x: timer.cancel())
+
+        return pending
+
+    def _expire(self, pending):
+        if not pending.done():
+            self._timeouts += 1
+
+            pending.set_exception(
+                error.ExecutorTimeoutError(
+                    '%s call timed out in %s seconds' % (
+                        self._name, self._timeout)))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+
+            if item is None:
+                break
+
+            pending, fun, args = item
+
+            if pending.done():  # timed out while queued
+                continue
+
+            try:
+                result = fun(*args)
+
+            except Exception as exc:
+                TIMERS.call_soon_threadsafe(pending.set_exception, exc)
+
+            else:
+                TIMERS.call_soon_threadsafe(pending.set_result, result)
+
+    def stats(self):
+        return {'queue_depth': self._queue.qsize(),
+                'threads': len(self._threads),
+                'calls_total': self._calls,
+                'timeouts_total': self._timeouts}
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
+
+        for thread in self._threads:
+            thread.join(self._timeout)
+
+        self._threads = []
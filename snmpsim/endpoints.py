@@ -71,12 +71,13 @@ class IPv6TransportEndpoints(TransportEndpointsBase):
 def parse_endpoint(arg, ipv6=False):
     address = arg
 
-    # IPv6 notation
-    if ipv6 and address.startswith('['):
-        address = address.replace('[', '').replace(']', '')
-
     try:
-        if ':' in address:
+        # IPv6 notation
+        if ipv6 and address.startswith('['):
+            address, port = address[1:].split(']', 1)
+            port = port and int(port[1:]) or 161
+
+        elif ':' in address and not ipv6:
             address, port = address.split(':', 1)
             port = int(port)
 
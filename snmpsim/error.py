@@ -14,6 +14,10 @@ class NoDataNotification(SnmpsimError):
     pass
 
 
+class ExecutorTimeoutError(SnmpsimError):
+    pass
+
+
 class MoreDataNotification(SnmpsimError):
     def __init__(self, **kwargs):
         self.__kwargs = kwargs
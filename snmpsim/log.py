@@ -4,13 +4,21 @@
 # Copyright (c) 2010-2019, Ilya Etingof <etingof@gmail.com>
 # License: http://snmplabs.com/snmpsim/license.html
 #
+import atexit
 import logging
 import os
 import socket
 import sys
+import threading
 import time
 from logging import handlers
 
+try:
+    import queue
+
+except ImportError:
+    import Queue as queue
+
 from snmpsim.error import SnmpsimError
 
 LOG_DEBUG = 0
@@ -18,7 +26,114 @@ LOG_INFO = 1
 LOG_ERROR = 2
 
 
+class AsyncHandler(logging.Handler):
+    """Hand log records over to a background writer thread.
+
+    Records are buffered in a bounded in-memory queue and written out by
+    a dedicated thread in batches. When the queue is full, records are
+    dropped and counted rather than blocking the caller. The count is
+    logged along with the next batch, once the queue drains or on close.
+    """
+    BATCH_SIZE = 256
+
+    def __init__(self, handler, queue_size):
+        logging.Handler.__init__(self)
+        self._handler = handler
+        self._queue = queue.Queue(queue_size)
+        self._dropped = self._reported = 0
+        self._name = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        atexit.register(self.close)
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(record)
+
+        except queue.Full:
+            self._dropped += 1
+
+    def _write(self, batch):
+        if batch:
+            self._name = batch[0].name
+
+        dropped = self._dropped
+
+        if dropped != self._reported:
+            batch.append(logging.makeLogRecord(
+                {'name': self._name,
+                 'msg': 'ERROR %d log message(s) dropped due to writer '
+                        'queue overflow' % (dropped - self._reported),
+                 'levelno': logging.ERROR, 'levelname': 'ERROR'}))
+            self._reported = dropped
+
+        if not batch:
+            return
+
+        self._handler.acquire()
+
+        try:
+            for record in batch:
+                try:
+                    self._handler.emit(record)
+
+                except Exception:
+                    self._handler.handleError(record)
+
+            self._handler.flush()
+
+        finally:
+            self._handler.release()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+
+            batch = []
+
+            while record is not None:
+                batch.append(record)
+
+                if len(batch) >= self.BATCH_SIZE:
+                    break
+
+                try:
+                    record = self._queue.get_nowait()
+
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write(batch)
+
+            if record is None:
+                break
+
+            # records dropped while writing would wait for the next ones
+            if self._queue.empty():
+                self._write([])
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+        self._write([])
+
+        self._handler.close()
+
+        logging.Handler.close(self)
+
+
 class AbstractLogger(object):
+    ASYNC_CAPABLE = False
+
     def __init__(self, progId, *priv):
         self._logger = logging.getLogger(progId)
         self._logger.setLevel(logging.DEBUG)
@@ -26,6 +141,26 @@ class AbstractLogger(object):
         self._ident = 0
         self.init(*priv)
 
+    def set_async(self, queue_size):
+        """Move log writing into a background thread"""
+        if not self.ASYNC_CAPABLE:
+            raise SnmpsimError(
+                'Asynchronous logging is not supported by '
+                '%s' % self.__class__.__name__)
+
+        for handler in self._logger.handlers[:]:
+            if isinstance(handler, AsyncHandler):
+                continue
+
+            self._logger.removeHandler(handler)
+            self._logger.addHandler(AsyncHandler(handler, queue_size))
+
+    @property
+    def dropped(self):
+        """Count of log messages dropped on asynchronous writer overflow"""
+        return sum([handler.dropped for handler in self._logger.handlers
+                    if isinstance(handler, AsyncHandler)])
+
     def __call__(self, s):
         self._logger.debug(' ' * self._ident + s)
 
@@ -42,6 +177,8 @@ class AbstractLogger(object):
 
 
 class SyslogLogger(AbstractLogger):
+    ASYNC_CAPABLE = True
+
     SYSLOG_SOCKET_PATHS = (
         '/dev/log',
         '/var/run/syslog'
@@ -94,6 +231,7 @@ class SyslogLogger(AbstractLogger):
 
 
 class FileLogger(AbstractLogger):
+    ASYNC_CAPABLE = True
 
     class TimedRotatingFileHandler(handlers.TimedRotatingFileHandler):
         """Store log creation time in a stand-alone file''s mtime"""
@@ -269,19 +407,34 @@ msg = lambda x: None
 log_level = LOG_INFO
 
 
-def error(message, ctx=''):
+def is_enabled(level):
+    """Tell whether messages of given severity make it into the log.
+
+    Meant to guard costly log message preparation on hot code paths.
+    """
+    return log_level <= level
+
+
+def _format(message, args):
+    if args:
+        return message % args
+
+    return message
+
+
+def error(message, *args, **kwargs):
     if log_level <= LOG_ERROR:
-        msg('ERROR %s %s' % (message, ctx))
+        msg('ERROR %s %s' % (_format(message, args), kwargs.get('ctx', '')))
 
 
-def info(message, ctx=''):
+def info(message, *args, **kwargs):
     if log_level <= LOG_INFO:
-        msg('%s %s' % (message, ctx))
+        msg('%s %s' % (_format(message, args), kwargs.get('ctx', '')))
 
 
-def debug(message, ctx=''):
+def debug(message, *args, **kwargs):
     if log_level <= LOG_DEBUG:
-        msg('DEBUG %s %s' % (message, ctx))
+        msg('DEBUG %s %s' % (_format(message, args), kwargs.get('ctx', '')))
 
 
 def set_level(level):
@@ -296,6 +449,14 @@ def set_level(level):
             '%s' % (level, ', '.join(LEVELS_MAP)))
 
 
+def set_async(queue_size):
+    try:
+        msg.set_async(queue_size)
+
+    except AttributeError:
+        raise SnmpsimError('Logging method not configured')
+
+
 def set_logger(progId, *priv, **options):
     global msg
 
@@ -6,8 +6,11 @@
 #
 
 import os
+import pickle
 import sys
 
+from pyasn1.compat.octets import octs2str
+
 from snmpsim import confdir
 from snmpsim import error
 from snmpsim import log
@@ -24,10 +27,27 @@ else:
 
 
 class RecordIndex(object):
+    """Index of records in simulation data file.
+
+    Settings of records served by variation modules implementing
+    `compile(value, **context)` hook are compiled once, while indexing,
+    and stored in a sidecar database next to the index.
+
+    Variation modules referenced by the data file are noted in the index,
+    along with modification time of the ones compiling settings, to have
+    them loaded whenever the index is used and settings recompiled once
+    module changes.
+    """
+    # index key of variation modules referenced by data file
+    MODULES_KEY = 'variation'
 
-    def __init__(self, text_file, text_parser):
+    def __init__(self, text_file, text_parser, variation_modules=None):
         self._text_file = text_file
         self._text_parser = text_parser
+        if variation_modules is None:
+            variation_modules = {}
+
+        self._variation_modules = variation_modules
 
         try:
             self._db_file = text_file[:text_file.rindex(os.path.extsep)]
@@ -41,8 +61,11 @@ class RecordIndex(object):
             confdir.cache, os.path.splitdrive(
                 self._db_file)[1].replace(os.path.sep, '_'))
 
-        self._db = self._text = None
+        self._settings_file = self._db_file + os.path.extsep + 'settings'
+
+        self._db = self._text = self._settings = None
         self._db_type = '?'
+        self._modules = ()
 
         self._text_file_time = 0
 
@@ -65,11 +88,134 @@ class RecordIndex(object):
 
         return self._text, self._db
 
+    @staticmethod
+    def _dbm_files(db_file):
+        return (db_file + os.path.extsep + 'db',
+                db_file + os.path.extsep + 'dat',
+                db_file)
+
     @property
     def _db_files(self):
-        return (self._db_file + os.path.extsep + 'db',
-                self._db_file + os.path.extsep + 'dat',
-                self._db_file)
+        return self._dbm_files(self._db_file)
+
+    def _get_compilers(self):
+        compilers = {}
+
+        for name in self._modules:
+            if name not in self._variation_modules:
+                continue
+
+            body = self._variation_modules[name][0]
+
+            if 'compile' in body:
+                compilers[name] = body['compile']
+
+        return compilers
+
+    def _get_compiler_version(self, name):
+        """Modification time of variation module compiling settings"""
+        try:
+            body = self._variation_modules[name][0]
+
+        except KeyError:
+            return ''
+
+        if 'compile' not in body:
+            return ''
+
+        try:
+            return str(os.stat(body['path'])[8])
+
+        except (KeyError, OSError):
+            return ''
+
+    def _require_modules(self, modules):
+        # variation modules may be loaded on demand
+        if hasattr(self._variation_modules, 'require'):
+            self._variation_modules.require(modules)
+
+    def _read_modules(self):
+        """Variation modules and their compiler versions noted in
+        existing index or `None`"""
+        for db_file in self._db_files:
+            if os.path.exists(db_file):
+                break
+
+        else:
+            return
+
+        try:
+            db = dbm.open(self._db_file, 'r')
+
+        except Exception as exc:
+            log.debug('DBM open failed on file %s: %s' % (self._db_file, exc))
+            return
+
+        try:
+            modules = octs2str(db[self.MODULES_KEY])
+
+        except KeyError:
+            return
+
+        finally:
+            db.close()
+
+        return tuple((x.split(':', 1) + [''])[:2]
+                     for x in modules.split(',') if x)
+
+    def _drop_index(self, db, settings):
+        db.close()
+
+        if settings is not None:
+            settings.close()
+
+        for db_file in (self._db_files +
+                        self._dbm_files(self._settings_file)):
+            try:
+                os.remove(db_file)
+
+            except OSError:
+                pass
+
+    def _create_dbm(self, db_file):
+        # these might speed-up indexing
+        open_flags = 'nfu'
+
+        errors = []
+
+        while open_flags:
+            try:
+                db = dbm.open(db_file, open_flags)
+
+            except Exception as exc:
+                log.debug('DBM open with flags "%s" failed on file '
+                          '%s: %s' % (open_flags, db_file, exc))
+                errors.append(str(exc))
+                open_flags = open_flags[:-1]
+                continue
+
+            else:
+                return db, open_flags
+
+        raise error.SnmpsimError(
+            'Failed to create %s for data file '
+            '%s: %s' % (db_file, self._text_file, '; '.join(errors)))
+
+    def _compile_settings(self, settings, compilers, oid, tag, val):
+        tag, mod_name = tag.split(':', 1)
+
+        if mod_name not in compilers:
+            return
+
+        try:
+            compiled = compilers[mod_name](
+                val, oid=oid, tag=tag, dataFile=self._text_file)
+
+            settings[oid] = pickle.dumps(compiled, pickle.HIGHEST_PROTOCOL)
+
+        except Exception as exc:
+            log.info('Settings of %s at %s not compiled by variation '
+                     'module "%s": %s' % (oid, self._text_file, mod_name, exc))
 
     def create(self, force_index_build=False, validate_data=False):
         text_file_time = os.stat(self._text_file)[8]
@@ -101,35 +247,46 @@ class RecordIndex(object):
             log.info('Index %s does not exist for data file '
                     '%s' % (self._db_file, self._text_file))
 
-        if index_needed:
-            # these might speed-up indexing
-            open_flags = 'nfu'
+        if not index_needed:
+            modules = self._read_modules()
 
-            errors = []
+            if modules is None:
+                index_needed = True
+                log.info('Index %s does not list variation modules, '
+                         'rebuilding' % self._db_file)
 
-            while open_flags:
-                try:
-                    db = dbm.open(self._db_file, open_flags)
+            else:
+                self._modules = tuple(x[0] for x in modules)
 
-                except Exception as exc:
-                    log.debug('DBM open with flags "%s" failed on file '
-                              '%s: %s' % (open_flags, self._db_file, exc))
-                    errors.append(str(exc))
-                    open_flags = open_flags[:-1]
-                    continue
+                self._require_modules(self._modules)
 
-                else:
-                    break
-            else:
-                raise error.SnmpsimError(
-                    'Failed to create %s for data file '
-                    '%s: %s' % (self._db_file, self._text_file,
-                                '; '.join(errors)))
+                if [name for name, version in modules
+                        if self._get_compiler_version(name) != version]:
+                    index_needed = True
+                    log.info('Variation modules compiling settings of data '
+                             'file %s changed' % self._text_file)
+
+                elif self._get_compilers() and not any(
+                        os.path.exists(x)
+                        for x in self._dbm_files(self._settings_file)):
+                    index_needed = True
+                    log.info('Compiled settings %s do not exist for data '
+                             'file %s' % (self._settings_file, self._text_file))
+
+        if index_needed:
+            db, open_flags = self._create_dbm(self._db_file)
+
+            settings = None
+
+            self._modules = modules = []
+            compilers = {}
 
             try:
                 text = self._text_parser.open(self._text_file)
 
             except Exception as exc:
+                self._drop_index(db, settings)
+
                 raise error.SnmpsimError(
                     'Failed to open data file %s: %s' % (self._db_file, exc))
 
@@ -149,20 +306,16 @@ class RecordIndex(object):
                 if not line:
                     # reference to last OID in data file
                     db['last'] = '%d,%d,%d' % (offset, 0, prev_offset)
+                    db[self.MODULES_KEY] = ','.join(
+                        '%s:%s' % (x, self._get_compiler_version(x))
+                        for x in modules)
                     break
 
                 try:
                     oid, tag, val = self._text_parser.grammar.parse(line)
 
                 except Exception as exc:
-                    db.close()
-
-                    for db_file in self._db_files:
-                        try:
-                            os.remove(db_file)
-
-                        except OSError:
-                            pass
+                    self._drop_index(db, settings)
 
                     raise error.SnmpsimError(
                         'Data error at %s:%d:'
@@ -173,14 +326,7 @@ class RecordIndex(object):
                         self._text_parser.evaluate_oid(oid)
 
                     except Exception as exc:
-                        db.close()
-
-                        for db_file in self._db_files:
-                            try:
-                                os.remove(db_file)
-
-                            except OSError:
-                                pass
+                        self._drop_index(db, settings)
 
                         raise error.SnmpsimError(
                             'OID error at %s:%d: %s' % (self._text_file, line_no, exc))
@@ -198,6 +344,24 @@ class RecordIndex(object):
                 # for lines serving subtrees, type is empty in tag field
                 db[oid] = '%d,%d,%d' % (offset, tag[0] == ':', prev_offset)
 
+                if ':' in tag:
+                    mod_name = tag.split(':', 1)[1]
+
+                    if mod_name not in modules:
+                        modules.append(mod_name)
+
+                        self._require_modules([mod_name])
+
+                        compilers = self._get_compilers()
+
+                        if compilers and settings is None:
+                            settings, _ = self._create_dbm(
+                                self._settings_file)
+
+                    if settings is not None:
+                        self._compile_settings(
+                            settings, compilers, oid, tag, val)
+
                 if tag[0] == ':':
                     prev_offset = offset
 
@@ -209,6 +373,9 @@ class RecordIndex(object):
             text.close()
             db.close()
 
+            if settings is not None:
+                settings.close()
+
             log.info('...%d entries indexed' % line_no)
 
         self._text_file_time = os.stat(self._text_file)[8]
@@ -220,11 +387,34 @@ class RecordIndex(object):
     def lookup(self, oid):
         return self._db[oid]
 
+    def lookup_settings(self, oid):
+        """Return compiled settings of the record or `None`"""
+        if self._settings is None:
+            return
+
+        try:
+            return pickle.loads(self._settings[oid])
+
+        except KeyError:
+            return
+
     def open(self):
         self._text = self._text_parser.open(self._text_file)
         self._db = dbm.open(self._db_file)
 
+        if self._get_compilers():
+            try:
+                self._settings = dbm.open(self._settings_file)
+
+            except Exception as exc:
+                log.info('Compiled settings %s not available: '
+                         '%s' % (self._settings_file, exc))
+
     def close(self):
         self._text.close()
         self._db.close()
-        self._db = self._text = None
+
+        if self._settings is not None:
+            self._settings.close()
+
+        self._db = self._text = self._settings = None
@@ -21,6 +21,7 @@ from pysnmp.entity import engine
 
 from snmpsim import error
 from snmpsim import log
+from snmpsim.reporting import metrics
 from snmpsim.reporting.formats import base
 
 
@@ -89,6 +90,10 @@ class NestingDict(dict):
 
 class BaseJsonReporter(base.BaseReporter):
     """Common base for JSON-backed family of reporters.
+
+    Activity updates are accumulated by a flat, scope-keyed counters
+    table. Turning these counters into a JSON document happens
+    periodically in background.
     """
 
     REPORTING_PERIOD = 300
@@ -96,6 +101,29 @@ class BaseJsonReporter(base.BaseReporter):
     REPORTING_VERSION = 1
     PRODUCER_UUID = str(uuid.uuid1())
 
+    # activity update parameters to build metrics scopes from
+    SCOPE = ()
+
+    # activity update parameters to count
+    COUNTERS = (
+        'transport_call_count',
+        'transport_failure_count',
+        'datafile_call_count',
+        'datafile_failure_count',
+        'varbind_count',
+        'variation_call_count',
+        'variation_failure_count',
+        'variation_timeout_count'
+    )
+
+    # activity update parameters to observe by latency histograms
+    HISTOGRAMS = ()
+
+    BUCKETS = metrics.LATENCY_BUCKETS
+
+    # how many slowest OIDs to report per variation module and data file
+    SLOWEST_CALLS = 0
+
     def __init__(self, *args):
         if not args:
             raise error.SnmpsimError(
@@ -121,8 +149,16 @@ class BaseJsonReporter(base.BaseReporter):
                 'Failed to create reports directory %s: '
                 '%s' % (self._reports_dir, exc))
 
-        self._metrics = NestingDict()
-        self._next_dump = time.time() + self.REPORTING_PERIOD
+        self._collector = metrics.MetricsCollector(
+            self.SCOPE, self.COUNTERS, self.HISTOGRAMS, self.BUCKETS)
+
+        self._slowest = None
+
+        if self.SLOWEST_CALLS:
+            self._slowest = metrics.SlowestCalls(self.SLOWEST_CALLS)
+
+        # started after possible daemonization
+        self._flusher = None
 
         log.debug(
             'Initialized %s metrics reporter for instance %s, metrics '
@@ -130,31 +166,62 @@ class BaseJsonReporter(base.BaseReporter):
                 self.__class__.__name__, self.PRODUCER_UUID, self._reports_dir,
                 self.REPORTING_PERIOD))
 
+    def update_metrics(self, **kwargs):
+        """Process activity update.
+
+        Parameters in `kwargs` serve two purposes: those listed in `SCOPE`
+        are used to build activity scopes, while those listed in `COUNTERS`
+        are added up to the counters of that scope.
+        """
+        self._collector.update(kwargs)
+
+        if (self._slowest and 'variation_latency' in kwargs and
+                'origOid' in kwargs):
+            self._slowest.observe(
+                (kwargs.get('data_file'), kwargs.get('variation')),
+                kwargs['variation_latency'], kwargs['origOid'])
+
+    def render_metrics(self, metrics, **kwargs):
+        """Merge counters of one activity scope into JSON document"""
+
+    def render_slowest(self, metrics, slowest):
+        """Merge the slowest variation module calls into JSON document"""
+
     def flush(self):
         """Dump accumulated metrics into a JSON file.
 
         Reset all counters upon success.
         """
-        if not self._metrics:
+        first_update, last_update, scopes = self._collector.swap()
+
+        if not scopes:
             return
 
-        now = int(time.time())
+        metrics = NestingDict()
 
-        if self._next_dump > now:
-            return
+        metrics['format'] = self.REPORTING_FORMAT
+        metrics['version'] = self.REPORTING_VERSION
+        metrics['producer'] = self.PRODUCER_UUID
+        metrics['first_update'] = int(first_update)
+        metrics['last_update'] = int(last_update)
+
+        for scope, counters in scopes:
+            kwargs = dict([(k, v) for k, v in scope.items() if v is not None])
+            kwargs.update(counters)
+
+            self.render_metrics(metrics, **kwargs)
 
-        self._next_dump = now + self.REPORTING_PERIOD
+        if self._slowest:
+            self.render_slowest(metrics, self._slowest.swap())
 
-        self._metrics['format'] = self.REPORTING_FORMAT
-        self._metrics['version'] = self.REPORTING_VERSION
-        self._metrics['producer'] = self.PRODUCER_UUID
+        now = int(time.time())
 
         dump_path = os.path.join(self._reports_dir, '%s.json' % now)
 
         log.debug('Dumping JSON metrics to %s' % dump_path)
 
         try:
-            json_doc = json.dumps(self._metrics, indent=2)
+            json_doc = json.dumps(metrics, indent=2)
 
             with tempfile.NamedTemporaryFile(delete=False) as fl:
                 fl.write(json_doc.encode('utf-8'))
@@ -166,7 +233,18 @@ class BaseJsonReporter(base.BaseReporter):
                 'Failure while dumping metrics into '
                 '%s: %s' % (dump_path, exc))
 
-        self._metrics.clear()
+    def start(self):
+        """Start background flushing"""
+        if self._flusher is None:
+            self._flusher = metrics.MetricsFlusher(
+                self.flush, self.REPORTING_PERIOD)
+            self._flusher.start()
+
+    def close(self):
+        """Stop background flushing, dump whatever is left"""
+        if self._flusher is not None:
+            self._flusher.stop()
+            self._flusher = None
 
 
 class MinimalJsonReporter(BaseJsonReporter):
@@ -209,10 +287,8 @@ class MinimalJsonReporter(BaseJsonReporter):
 
     REPORTING_FORMAT = 'minimaljson'
 
-    def update_metrics(self, **kwargs):
-        """Process activity update.
-
-        Update internal counters based on activity update information.
+    def render_metrics(self, metrics, **kwargs):
+        """Merge counters of one activity scope into JSON document.
 
         Parameters in `kwargs` serve two purposes: some are used to
         build activity scopes e.g. {transport_domain}->{snmp_engine},
@@ -220,19 +296,7 @@ class MinimalJsonReporter(BaseJsonReporter):
         activity counters that eventually will make their way to
         consumers.
         """
-
-        root_metrics = self._metrics
-
-        metrics = root_metrics
-
-        now = int(time.time())
-
-        if 'first_update' not in metrics:
-            metrics['first_update'] = now
-
-        metrics['last_update'] = now
-
-        metrics = root_metrics
+        root_metrics = metrics
 
         try:
             metrics = metrics['transports']
@@ -306,9 +370,19 @@ class FullJsonReporter(BaseJsonReporter):
                                                     'pdus': 0,
                                                     'varbinds': 0,
                                                     'failures': 0,
-                                                    '{variation_module}': {
-                                                        'calls': 0,
-                                                        'failures': 0
+                                                    'variations': {
+                                                        '{variation_module}': {
+                                                            'calls': 0,
+                                                            'failures': 0,
+                                                            'timeouts': 0,
+                                                            'latency': {
+                                                                'count': 0,
+                                                                'sum': 0.0,
+                                                                'buckets': {
+                                                                    '{le}': 0
+                                                                }
+                                                            }
+                                                        }
                                                     }
                                                 }
                                             }
@@ -320,18 +394,48 @@ class FullJsonReporter(BaseJsonReporter):
                     }
                 }
             }
+        },
+        'slowest_calls': {
+            '{data_file}': {
+                '{variation_module}': [
+                    {'oid': '{oid}', 'latency': 0.0}
+                ]
+            }
         }
     }
 
     Where `{token}` is replaced with a concrete value taken from request.
+
+    Variation modules latency is summarized by a histogram of calls
+    count per latency upper bound (`{le}`) in seconds. The slowest
+    calls by OID are reported for the dumping period.
     """
     REPORTING_FORMAT = 'fulljson'
 
-    @ensure_base_types
-    def update_metrics(self, **kwargs):
-        """Process activity update.
+    HISTOGRAMS = (
+        'variation_latency',
+    )
+
+    SLOWEST_CALLS = 10
+
+    SCOPE = (
+        'transportProtocol',
+        'transportEndpoint',
+        'transportDomain',
+        'transportAddress',
+        'snmpEngine',
+        'securityModel',
+        'securityLevel',
+        'securityName',
+        'contextEngineId',
+        'pduType',
+        'data_file',
+        'variation'
+    )
 
-        Update internal counters based on activity update information.
+    @ensure_base_types
+    def render_metrics(self, metrics, **kwargs):
+        """Merge counters of one activity scope into JSON document.
 
         Parameters in `kwargs` serve two purposes: some are used to
         build activity scopes e.g. {transport_domain}->{snmp_engine},
@@ -339,16 +443,6 @@ class FullJsonReporter(BaseJsonReporter):
         activity counters that eventually will make their way to
         consumers.
         """
-
-        metrics = self._metrics
-
-        now = int(time.time())
-
-        if 'first_update' not in metrics:
-            metrics['first_update'] = now
-
-        metrics['last_update'] = now
-
         try:
             metrics = metrics[kwargs['transport_protocol']]
             metrics = metrics['%s:%s' % kwargs['transport_endpoint']]
@@ -384,11 +478,41 @@ class FullJsonReporter(BaseJsonReporter):
             metrics = metrics['variations']
             metrics = metrics[kwargs['variation']]
             metrics['calls'] = (
-                    metrics.get('pdus', 0)
+                    metrics.get('calls', 0)
                     + kwargs.get('variation_call_count', 0))
             metrics['failures'] = (
                     metrics.get('failures', 0)
                     + kwargs.get('variation_failure_count', 0))
+            metrics['timeouts'] = (
+                    metrics.get('timeouts', 0)
+                    + kwargs.get('variation_timeout_count', 0))
+
+            buckets, total = kwargs.get('variation_latency', ((), 0))
+
+            if any(buckets):
+                metrics = metrics['latency']
+                metrics['count'] = metrics.get('count', 0) + sum(buckets)
+                metrics['sum'] = metrics.get('sum', 0) + total
+
+                metrics = metrics['buckets']
+
+                count = 0
+
+                # cumulative calls count by latency upper bound
+                for bound, value in zip(
+                        self.BUCKETS + (float('inf'),), buckets):
+                    count += value
+                    bound = bound == float('inf') and '+Inf' or str(bound)
+                    metrics[bound] = metrics.get(bound, 0) + count
 
         except KeyError:
             return
+
+    def render_slowest(self, metrics, slowest):
+        """Merge the slowest variation module calls into JSON document"""
+        metrics = metrics['slowest_calls']
+
+        for (data_file, variation), calls in slowest:
+            metrics[data_file][variation] = [
+                {'oid': str(oid), 'latency': latency}
+                for oid, latency in calls]
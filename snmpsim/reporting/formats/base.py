@@ -11,6 +11,14 @@
 class BaseReporter(object):
     """Maintain activity metrics.
     """
+    def add_probe(self, name, probe):
+        """Register a callable returning a dict of metrics.
+        """
+
+    def start(self):
+        """Start metrics processing in background.
+        """
+
     def update_metrics(self, **kwargs):
         """Process activity update.
         """
@@ -21,5 +29,9 @@ class BaseReporter(object):
         Reset all counters upon success.
         """
 
+    def close(self):
+        """Stop metrics processing, dump whatever is left.
+        """
+
     def __str__(self):
         return self.__class__.__name__
\ No newline at end of file
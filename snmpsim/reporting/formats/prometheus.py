@@ -0,0 +1,540 @@
+#
+# This file is part of snmpsim software.
+#
+# Copyright (c) 2010-2019, Ilya Etingof <etingof@gmail.com>
+# License: http://snmplabs.com/snmpsim/license.html
+#
+# SNMP Agent Simulator
+#
+import collections
+import os
+import re
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+
+try:
+    import socketserver
+
+except ImportError:
+    import SocketServer as socketserver
+
+from snmpsim import error
+from snmpsim import log
+from snmpsim.reporting import metrics
+from snmpsim.reporting.formats import base
+
+
+def escape_label_value(value):
+    return (str(value).replace('\\', r'\\').
+            replace('\n', r'\n').replace('"', r'\"'))
+
+
+def escape_metric_name(name):
+    return re.sub('[^a-zA-Z0-9_:]', '_', name)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serve current metrics to Prometheus scraper"""
+
+    def do_GET(self):
+        try:
+            body = self.server.reporter.render().encode('utf-8')
+
+        except Exception as exc:
+            log.error('Metrics rendering failure: %s' % exc)
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', PrometheusReporter.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug('Prometheus scraper request: ' + fmt, *args)
+
+
+class MetricsHTTPServer(HTTPServer):
+    pass
+
+
+class MetricsHTTP6Server(HTTPServer):
+    address_family = socket.AF_INET6
+
+
+class MetricsUnixServer(socketserver.UnixStreamServer):
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        # HTTP request handler expects peer address to be a tuple
+        return request, ('', 0)
+
+
+class PrometheusReporter(base.BaseReporter):
+    """Collect activity metrics and expose them to Prometheus.
+
+    Counters and latency histograms are accumulated in memory for the
+    whole life time of the process. Recent activity is merged into them
+    in background once in a reporting period, so rendering them into
+    Prometheus text exposition format is cheap and does not disturb
+    other readers. Rendering is done by either of:
+
+    * HTTP server listening on local TCP port
+    * HTTP server listening on UNIX domain socket
+    * periodically (and atomically) rewriting a text file, suitable for
+      node exporter *textfile* collector
+
+    Metrics are labeled by simulation data file (i.e. SNMP agent),
+    SNMP PDU type and variation module. Metrics of registered probes
+    are rendered as they are.
+
+    The OIDs served by variation modules the slowest over the last
+    `SLOWEST_WINDOW` seconds are reported by variation module and data
+    file.
+    """
+    REPORTING_FORMAT = 'prometheus'
+    REPORTING_PERIOD = 15
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    # activity update parameters and labels to build metrics scopes from
+    SCOPE = (
+        ('data_file', 'data_file'),
+        ('pduType', 'pdu_type'),
+        ('variation', 'variation')
+    )
+
+    # activity update parameters to count
+    COUNTERS = (
+        ('transport_call_count', 'snmpsim_transport_calls_total',
+         'SNMP messages processed'),
+        ('transport_failure_count', 'snmpsim_transport_failures_total',
+         'SNMP messages failed to process'),
+        ('datafile_call_count', 'snmpsim_datafile_calls_total',
+         'SNMP PDUs served from simulation data'),
+        ('datafile_failure_count', 'snmpsim_datafile_failures_total',
+         'Simulation data access failures'),
+        ('varbind_count', 'snmpsim_varbinds_total',
+         'Variable-bindings processed'),
+        ('variation_call_count', 'snmpsim_variation_calls_total',
+         'Variation module calls'),
+        ('variation_failure_count', 'snmpsim_variation_failures_total',
+         'Variation module call failures'),
+        ('variation_timeout_count', 'snmpsim_variation_timeouts_total',
+         'Variation module calls timed out'),
+    )
+
+    # activity update parameters to observe, same name histograms
+    # must go in a row
+    HISTOGRAMS = (
+        ('variation_latency', 'snmpsim_variation_latency_seconds',
+         'Variation module call latency', ()),
+        ('stage_decode_latency', 'snmpsim_pdu_stage_latency_seconds',
+         'SNMP request processing latency by stage',
+         (('stage', 'decode'),)),
+        ('stage_context_latency', 'snmpsim_pdu_stage_latency_seconds',
+         'SNMP request processing latency by stage',
+         (('stage', 'context'),)),
+        ('stage_lookup_latency', 'snmpsim_pdu_stage_latency_seconds',
+         'SNMP request processing latency by stage',
+         (('stage', 'lookup'),)),
+        ('stage_read_latency', 'snmpsim_pdu_stage_latency_seconds',
+         'SNMP request processing latency by stage',
+         (('stage', 'read'),)),
+        ('stage_variation_latency', 'snmpsim_pdu_stage_latency_seconds',
+         'SNMP request processing latency by stage',
+         (('stage', 'variation'),)),
+        ('stage_encode_latency', 'snmpsim_pdu_stage_latency_seconds',
+         'SNMP request processing latency by stage',
+         (('stage', 'encode'),)),
+    )
+
+    BUCKETS = metrics.LATENCY_BUCKETS
+
+    # how many slowest OIDs to report per variation module and data file
+    SLOWEST_CALLS = 10
+
+    # report the slowest OIDs observed over this many seconds
+    SLOWEST_WINDOW = 300
+
+    def __init__(self, *args):
+        if len(args) < 2 or args[0] not in ('http', 'unix', 'textfile'):
+            raise error.SnmpsimError(
+                'Missing or bad %s parameter(s). Expected: '
+                '<method>:http:<address>:<port>[:merging-period] or '
+                '<method>:unix:<path>[:merging-period] or '
+                '<method>:textfile:<path>[:dumping-period]' % self.__class__.__name__)
+
+        self._mode = args[0]
+        self._path = None
+        self._server = None
+        self._server_thread = None
+        self._flusher = None
+
+        self._collector = metrics.MetricsCollector(
+            [x[0] for x in self.SCOPE], [x[0] for x in self.COUNTERS],
+            [x[0] for x in self.HISTOGRAMS], self.BUCKETS)
+
+        self._slowest = metrics.SlowestCalls(self.SLOWEST_CALLS)
+
+        # cumulative metrics {labels: {counter: value}}
+        self._metrics = {}
+
+        # the slowest calls by merging period, the latest last
+        self._slowest_windows = collections.deque()
+        self._probes = {}
+        self._lock = threading.Lock()
+
+        if self._mode == 'http':
+            if len(args) < 3:
+                raise error.SnmpsimError(
+                    'Missing %s HTTP server port' % self.__class__.__name__)
+
+            endpoint = ':'.join(args[1:])
+
+            # IPv6 address goes in square brackets to be followed by period
+            if endpoint.startswith('[') and ']' in endpoint:
+                address, endpoint = endpoint[1:].split(']', 1)
+                endpoint = [address] + endpoint.split(':')[1:]
+
+            elif endpoint.count(':') < 3:
+                endpoint = endpoint.split(':')
+
+            else:
+                endpoint = endpoint.rsplit(':', 1)
+
+            if len(endpoint) > 2:
+                self._set_period(endpoint[2])
+
+            try:
+                address = endpoint[0], int(endpoint[1])
+
+                if ':' in address[0]:
+                    server_class = MetricsHTTP6Server
+
+                else:
+                    server_class = MetricsHTTPServer
+
+                self._server = server_class(address, MetricsRequestHandler)
+
+            except Exception as exc:
+                raise error.SnmpsimError(
+                    'Failed to start %s HTTP server at %s: '
+                    '%s' % (self.__class__.__name__, ':'.join(args[1:]), exc))
+
+        elif self._mode == 'unix':
+            self._path = args[1]
+
+            if len(args) > 2:
+                self._set_period(args[2])
+
+            try:
+                # clean up after previous run
+                if (os.path.exists(self._path) and
+                        stat.S_ISSOCK(os.stat(self._path).st_mode)):
+                    os.remove(self._path)
+
+                self._server = MetricsUnixServer(
+                    self._path, MetricsRequestHandler)
+
+            except Exception as exc:
+                raise error.SnmpsimError(
+                    'Failed to start %s server at UNIX socket %s: '
+                    '%s' % (self.__class__.__name__, self._path, exc))
+
+        else:
+            self._path = args[1]
+
+            if len(args) > 2:
+                self._set_period(args[2])
+
+            dump_dir = os.path.dirname(os.path.abspath(self._path))
+
+            if not os.path.isdir(dump_dir):
+                raise error.SnmpsimError(
+                    'Metrics file directory %s does not exist' % dump_dir)
+
+        if self._server:
+            self._server.reporter = self
+
+        log.debug(
+            'Initialized %s metrics reporter in %s mode' % (
+                self.__class__.__name__, self._mode))
+
+    def _set_period(self, value):
+        try:
+            self.REPORTING_PERIOD = int(value)
+
+        except Exception:
+            raise error.SnmpsimError(
+                'Malformed metrics merging period: %s' % value)
+
+        if self.REPORTING_PERIOD < 1:
+            raise error.SnmpsimError(
+                'Metrics merging period must be positive: %s' % value)
+
+    def add_probe(self, name, probe):
+        self._probes[name] = probe
+
+    def update_metrics(self, **kwargs):
+        """Process activity update.
+
+        Parameters in `kwargs` listed in `SCOPE` become metrics labels,
+        those listed in `COUNTERS` are added up to the counters and those
+        in `HISTOGRAMS` are observed by histograms of that scope.
+        """
+        self._collector.update(kwargs)
+
+        if 'variation_latency' in kwargs and 'origOid' in kwargs:
+            self._slowest.observe(
+                (kwargs.get('data_file'), kwargs.get('variation')),
+                kwargs['variation_latency'], kwargs['origOid'])
+
+    def merge(self):
+        """Fold recent activity into cumulative metrics"""
+        with self._lock:
+            self._merge()
+
+    def _merge(self):
+        _, _, scopes = self._collector.swap()
+
+        for scope, counters in scopes:
+            labels = tuple(
+                (label, scope[param]) for param, label in self.SCOPE
+                if scope[param] is not None)
+
+            try:
+                totals = self._metrics[labels]
+
+            except KeyError:
+                totals = self._metrics[labels] = {}
+
+            for name, value in counters.items():
+                if isinstance(value, tuple):
+                    buckets, total = value
+
+                    if not any(buckets):
+                        continue
+
+                    if name in totals:
+                        buckets = [x + y for x, y in zip(
+                            totals[name][0], buckets)]
+                        total += totals[name][1]
+
+                    totals[name] = buckets, total
+
+                elif value:
+                    totals[name] = totals.get(name, 0) + value
+
+        now = time.time()
+
+        slowest = self._slowest.swap()
+
+        if slowest:
+            self._slowest_windows.append((now, slowest))
+
+        while (self._slowest_windows and
+               self._slowest_windows[0][0] < now - self.SLOWEST_WINDOW):
+            self._slowest_windows.popleft()
+
+    def _slowest_calls(self):
+        """The slowest calls over all merging periods in the window"""
+        slowest = {}
+
+        for _, window in self._slowest_windows:
+            for key, calls in window:
+                worst = slowest.setdefault(key, {})
+
+                for oid, latency in calls:
+                    if latency > worst.get(oid, -1):
+                        worst[oid] = latency
+
+        return [
+            (key, sorted(worst.items(), key=lambda x: x[1],
+                         reverse=True)[:self.SLOWEST_CALLS])
+            for key, worst in slowest.items()]
+
+    def render(self):
+        """Render all metrics in Prometheus text exposition format"""
+        with self._lock:
+            lines = []
+
+            for param, name, desc in self.COUNTERS:
+                samples = [
+                    (labels, totals[param])
+                    for labels, totals in sorted(self._metrics.items())
+                    if param in totals]
+
+                if not samples:
+                    continue
+
+                lines.append('# HELP %s %s' % (name, desc))
+                lines.append('# TYPE %s counter' % name)
+
+                for labels, value in samples:
+                    lines.append(
+                        '%s%s %s' % (name, self._render_labels(labels),
+                                     format_value(value)))
+
+            rendered = set()
+
+            for param, name, desc, extra_labels in self.HISTOGRAMS:
+                samples = [
+                    (labels + extra_labels, totals[param])
+                    for labels, totals in sorted(self._metrics.items())
+                    if param in totals]
+
+                if not samples:
+                    continue
+
+                if name not in rendered:
+                    rendered.add(name)
+                    lines.append('# HELP %s %s' % (name, desc))
+                    lines.append('# TYPE %s histogram' % name)
+
+                for labels, (buckets, total) in samples:
+                    count = 0
+
+                    for bound, value in zip(
+                            self.BUCKETS + (float('inf'),), buckets):
+                        count += value
+                        lines.append(
+                            '%s_bucket%s %s' % (
+                                name, self._render_labels(
+                                    labels + (('le', format_value(bound)),)),
+                                count))
+
+                    lines.append(
+                        '%s_sum%s %s' % (name, self._render_labels(labels),
+                                         format_value(total)))
+                    lines.append(
+                        '%s_count%s %s' % (name, self._render_labels(labels),
+                                           count))
+
+            slowest = self._slowest_calls()
+
+            if slowest:
+                name = 'snmpsim_variation_slowest_latency_seconds'
+
+                lines.append(
+                    '# HELP %s Slowest variation module calls by OID' % name)
+                lines.append('# TYPE %s gauge' % name)
+
+                for (data_file, variation), calls in sorted(
+                        slowest, key=lambda x: str(x[0])):
+                    for oid, latency in calls:
+                        lines.append(
+                            '%s%s %s' % (name, self._render_labels(
+                                (('data_file', data_file),
+                                 ('variation', variation),
+                                 ('oid', oid))), format_value(latency)))
+
+            for probe_name, probe in sorted(self._probes.items()):
+                try:
+                    values = probe()
+
+                except Exception as exc:
+                    log.error(
+                        'Metrics probe %s failure: %s' % (probe_name, exc))
+                    continue
+
+                for key, value in sorted(values.items()):
+                    name = escape_metric_name(
+                        'snmpsim_%s_%s' % (probe_name, key))
+
+                    lines.append(
+                        '# HELP %s %s reported by %s probe' % (
+                            name, key, probe_name))
+                    lines.append(
+                        '# TYPE %s %s' % (
+                            name, key.endswith('_total') and 'counter' or 'gauge'))
+                    lines.append('%s %s' % (name, format_value(value)))
+
+            return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_labels(labels):
+        if not labels:
+            return ''
+
+        return '{%s}' % ','.join(
+            '%s="%s"' % (label, escape_label_value(value))
+            for label, value in labels)
+
+    def flush(self):
+        """Merge recent activity, atomically rewrite metrics text file"""
+        self.merge()
+
+        if self._mode != 'textfile':
+            return
+
+        text = self.render()
+
+        log.debug('Dumping Prometheus metrics to %s' % self._path)
+
+        try:
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(os.path.abspath(self._path)),
+                    prefix='.', suffix='.tmp', delete=False) as fl:
+                fl.write(text.encode('utf-8'))
+
+            os.chmod(fl.name, 0o644)
+            os.rename(fl.name, self._path)
+
+        except Exception as exc:
+            log.error(
+                'Failure while dumping metrics into '
+                '%s: %s' % (self._path, exc))
+
+    def start(self):
+        """Start serving or dumping metrics in background"""
+        if self._server and self._server_thread is None:
+            self._server_thread = threading.Thread(
+                target=self._server.serve_forever)
+            self._server_thread.daemon = True
+            self._server_thread.start()
+
+        if self._flusher is None:
+            self._flusher = metrics.MetricsFlusher(
+                self.flush, self.REPORTING_PERIOD)
+            self._flusher.start()
+
+    def close(self):
+        """Stop serving metrics, dump whatever is left"""
+        if self._server:
+            if self._server_thread is not None:
+                self._server.shutdown()
+                self._server_thread = None
+
+            self._server.server_close()
+            self._server = None
+
+            if self._mode == 'unix':
+                try:
+                    os.remove(self._path)
+
+                except OSError:
+                    pass
+
+        if self._flusher is not None:
+            self._flusher.stop()
+            self._flusher = None
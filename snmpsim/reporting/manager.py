@@ -9,6 +9,7 @@
 from snmpsim import error
 from snmpsim.reporting.formats import alljson
 from snmpsim.reporting.formats import null
+from snmpsim.reporting.formats import prometheus
 from snmpsim import log
 
 
@@ -21,15 +22,23 @@ class ReportingManager(object):
     These counters are accumulated in memory for some time, then get
     written down as a JSON file indexed by time. Consumers are expected
     to process each of these files and are free to remove them.
+
+    Activity updates are meant to be cheap, reporters are expected to
+    postpone any costly processing to background.
     """
 
     REPORTERS = {
         'null': null.NullReporter,
         'fulljson': alljson.FullJsonReporter,
         'minimaljson': alljson.MinimalJsonReporter,
+        'prometheus': prometheus.PrometheusReporter,
     }
 
     _reporter = null.NullReporter()
+    _probes = {}
+
+    # time SNMP request processing stages
+    stage_timing = False
 
     @classmethod
     def configure(cls, fmt, *args):
@@ -41,11 +50,31 @@ class ReportingManager(object):
 
         cls._reporter = reporter(*args)
 
+        for name, probe in cls._probes.items():
+            cls._reporter.add_probe(name, probe)
+
         log.info('Using "%s" activity reporting method with '
                  'params %s' % (cls._reporter, ', '.join(args)))
 
     @classmethod
-    def update_metrics(cls, **kwargs):
+    def add_probe(cls, name, probe):
+        """Register a source of ready-made metrics.
+
+        The `probe` callable is invoked on reporter's own schedule
+        and should return a dict of metric names and values. Names
+        ending with `_total` denote monotonically growing counters.
+        """
+        cls._probes[name] = probe
+        cls._reporter.add_probe(name, probe)
 
+    @classmethod
+    def start(cls):
+        cls._reporter.start()
+
+    @classmethod
+    def update_metrics(cls, **kwargs):
         cls._reporter.update_metrics(**kwargs)
-        cls._reporter.flush()
+
+    @classmethod
+    def close(cls):
+        cls._reporter.close()
@@ -0,0 +1,330 @@
+#
+# This file is part of snmpsim software.
+#
+# Copyright (c) 2010-2019, Ilya Etingof <etingof@gmail.com>
+# License: http://snmplabs.com/snmpsim/license.html
+#
+# SNMP Agent Simulator
+#
+import bisect
+import threading
+import time
+
+from snmpsim import log
+
+try:
+    clock = time.perf_counter
+
+except AttributeError:  # Py2
+    clock = time.time
+
+
+# latency histogram buckets upper bounds, seconds
+LATENCY_BUCKETS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+    .1, .25, .5, 1, 2.5, 5, 10
+)
+
+
+class _Shard(object):
+    """Updates made by one thread"""
+    __slots__ = ('lock', 'table', 'first_update', 'thread', 'last')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.table = {}
+        self.first_update = None
+        self.thread = threading.current_thread()
+        self.last = None
+
+
+class ShardedTable(object):
+    """Table of updates split by updating thread.
+
+    Each thread updates a table of its own, guarded by a lock that only
+    gets contended when reader detaches the table. Reader collects and
+    replaces tables of all threads.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+
+            with self._shards_lock:
+                self._shards.append(shard)
+
+            return shard
+
+    def _detach(self):
+        """Replace all threads tables with empty ones.
+
+        Returns
+        -------
+        : :py:class:`list`
+            (`first_update`, `table`) tuples, one per thread
+        """
+        with self._shards_lock:
+            shards = list(self._shards)
+
+        detached = []
+
+        for shard in shards:
+            with shard.lock:
+                table, shard.table = shard.table, {}
+                first_update, shard.first_update = shard.first_update, None
+                shard.last = None
+
+            if table:
+                detached.append((first_update, table))
+
+            # thread is gone, its last updates are collected
+            elif not shard.thread.is_alive():
+                with self._shards_lock:
+                    self._shards.remove(shard)
+
+        return detached
+
+
+class MetricsCollector(ShardedTable):
+    """Accumulate activity counters in a flat table.
+
+    Every activity update is keyed by a tuple of the `scope` parameters
+    taken from the update. ASN.1 scope values are interned by their
+    underlying Python values, which are much cheaper to hash, while
+    the original values are kept along with the counters for rendering.
+    Consecutive updates of the same scope (e.g. all var-binds of a PDU)
+    skip the lookup altogether. Counters of the same scope live in a
+    fixed-size list indexed by the position of the counter name in
+    `counters`.
+
+    Optional `histograms` name parameters carrying observed values
+    (e.g. latencies in seconds). Each observation bumps one of the fixed
+    `buckets` (by upper bound, the last one being infinity) and adds up
+    to the sum of all observations in the histogram.
+    """
+    def __init__(self, scope, counters, histograms=(), buckets=()):
+        ShardedTable.__init__(self)
+
+        self._scope = tuple(scope)
+        self._counters = tuple(counters)
+        self._histograms = tuple(histograms)
+        self._buckets = tuple(sorted(buckets))
+
+        # entry layout: scope values, counters, then per histogram
+        # bucket counts followed by observations sum
+        self._indexed_counters = tuple(
+            (idx + 1, name) for idx, name in enumerate(self._counters))
+
+        offset = len(self._counters) + 1
+        width = len(self._buckets) + 2
+
+        self._indexed_histograms = tuple(
+            (offset + idx * width, name)
+            for idx, name in enumerate(self._histograms))
+
+        self._entry_size = offset + width * len(self._histograms)
+
+        # update parameters to entry positions
+        self._slots = dict(
+            [(name, (idx, False)) for idx, name in self._indexed_counters] +
+            [(name, (idx, True)) for idx, name in self._indexed_histograms])
+
+        self._names = frozenset(self._slots)
+
+    @property
+    def scope(self):
+        return self._scope
+
+    @property
+    def counters(self):
+        return self._counters
+
+    @property
+    def histograms(self):
+        return self._histograms
+
+    @property
+    def buckets(self):
+        return self._buckets
+
+    def update(self, kwargs):
+        shard = self._shard()
+
+        scope = tuple(map(kwargs.get, self._scope))
+
+        with shard.lock:
+            last = shard.last
+
+            # same scope objects compare by identity
+            if last and last[0] is shard.table and last[1] == scope:
+                entry = last[2]
+
+            else:
+                if shard.first_update is None:
+                    shard.first_update = time.time()
+
+                key = tuple([getattr(x, '_value', x) for x in scope])
+
+                try:
+                    entry = shard.table[key]
+
+                except KeyError:
+                    entry = shard.table[key] = [0] * self._entry_size
+                    entry[0] = scope
+
+                shard.last = shard.table, scope, entry
+
+            for name in self._names.intersection(kwargs):
+                idx, histogram = self._slots[name]
+                value = kwargs[name]
+
+                if histogram:
+                    entry[idx + bisect.bisect_left(self._buckets, value)] += 1
+                    entry[idx + len(self._buckets) + 1] += value
+
+                else:
+                    entry[idx] += value
+
+    def swap(self):
+        """Detach accumulated counters.
+
+        Returns
+        -------
+        : :py:class:`tuple`
+            first and last update timestamps, and a list of
+            (`scope`, `counters`) tuples, where `scope` and `counters`
+            are dicts keyed by parameter and counter names respectively.
+            Histograms are reported among counters as a tuple of
+            per-bucket (non-cumulative) observations count list and
+            observations sum.
+        """
+        last_update = time.time()
+
+        first_update = None
+
+        merged = {}
+
+        for shard_first_update, table in self._detach():
+            if first_update is None or shard_first_update < first_update:
+                first_update = shard_first_update
+
+            for key, entry in table.items():
+                if key in merged:
+                    total = merged[key]
+
+                    for idx in range(1, self._entry_size):
+                        total[idx] += entry[idx]
+
+                else:
+                    merged[key] = entry
+
+        buckets = len(self._buckets) + 1
+
+        scopes = []
+
+        for entry in merged.values():
+            counters = dict(
+                (name, entry[idx]) for idx, name in self._indexed_counters)
+
+            for idx, name in self._indexed_histograms:
+                counters[name] = (
+                    entry[idx:idx + buckets], entry[idx + buckets])
+
+            scopes.append((dict(zip(self._scope, entry[0])), counters))
+
+        return first_update, last_update, scopes
+
+
+class SlowestCalls(ShardedTable):
+    """Track the slowest calls by key.
+
+    For each key (e.g. variation module and data file), up to `size`
+    subjects (e.g. OIDs) observed with the highest latency are kept
+    along with their worst latency.
+
+    Like :py:class:`MetricsCollector`, each thread observes calls into
+    a table of its own, detached by reader.
+    """
+    def __init__(self, size=10):
+        ShardedTable.__init__(self)
+        self._size = size
+
+    def observe(self, key, latency, subject):
+        shard = self._shard()
+
+        with shard.lock:
+            try:
+                slowest = shard.table[key]
+
+            except KeyError:
+                slowest = shard.table[key] = {}
+
+            if latency > slowest.get(subject, -1):
+                slowest[subject] = latency
+
+                # prune once in a while rather than on every observation
+                if len(slowest) > self._size * 2:
+                    shard.table[key] = dict(
+                        sorted(slowest.items(), key=lambda x: x[1],
+                               reverse=True)[:self._size])
+
+    def swap(self):
+        """Detach observed calls.
+
+        Returns
+        -------
+        : :py:class:`list`
+            (`key`, `slowest`) tuples, where `slowest` is a list of
+            (`subject`, `latency`) tuples, the slowest first
+        """
+        merged = {}
+
+        for _, table in self._detach():
+            for key, slowest in table.items():
+                total = merged.setdefault(key, {})
+
+                for subject, latency in slowest.items():
+                    if latency > total.get(subject, -1):
+                        total[subject] = latency
+
+        return [
+            (key, sorted(slowest.items(), key=lambda x: x[1],
+                         reverse=True)[:self._size])
+            for key, slowest in merged.items()]
+
+
+class MetricsFlusher(threading.Thread):
+    """Periodically invoke metrics flushing function in background"""
+
+    def __init__(self, flush, period):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._flush = flush
+        self._period = period
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._period):
+            self._run_flush()
+
+    def _run_flush(self):
+        try:
+            self._flush()
+
+        except Exception as exc:
+            log.error('Metrics flushing failure: %s' % exc)
+
+    def stop(self):
+        self._stopped.set()
+
+        if self.is_alive():
+            self.join()
+
+        self._run_flush()
@@ -7,12 +7,28 @@
 # Variation module support in simulation data
 #
 import os
+import threading
+import time
+
+try:
+    from collections.abc import MutableMapping
+
+except ImportError:  # Py2
+    from collections import MutableMapping
+
+try:
+    from importlib import util as importlib_util
+
+except ImportError:  # Py2
+    importlib_util = None
 
 from pyasn1.error import PyAsn1Error
 from pyasn1.type import univ
 from pysnmp.smi.error import MibOperationError
 
+from snmpsim import deferred
 from snmpsim import log
+from snmpsim.error import ExecutorTimeoutError
 from snmpsim.error import NoDataNotification
 from snmpsim.error import SnmpsimError
 from snmpsim.record import dump
@@ -70,26 +86,67 @@ class SnmprecRecordMixIn(object):
                     if context['dataFile'] not in record_contexts:
                         record_contexts[context['dataFile']] = {}
 
-                    variation_module['agentContext'] = agent_contexts[context['dataFile']]
+                    agent_context = agent_contexts[context['dataFile']]
 
                     record_contexts = record_contexts[context['dataFile']]
 
                     if oid not in record_contexts:
                         record_contexts[oid] = {}
 
-                    variation_module['recordContext'] = record_contexts[oid]
+                        # settings compiled at indexing time
+                        if 'recordIndex' in context:
+                            settings = context['recordIndex'].lookup_settings(
+                                str(oid))
+
+                            if settings is not None:
+                                record_contexts[oid]['settings'] = settings
+
+                    record_context = record_contexts[oid]
+
+                    if variation_module['executor']:
+                        oid, tag, value = self._submit_variation(
+                            variation_module, mod_name, agent_context,
+                            record_context, oid, tag, value, **context)
+
+                    elif ('variationBatch' in context and
+                            'variate_many' in variation_module):
+                        return oid, tag, context['variationBatch'].add(
+                            self, mod_name, agent_context, record_context,
+                            oid, tag, value, **context)
+
+                    else:
+                        variation_module['agentContext'] = agent_context
+                        variation_module['recordContext'] = record_context
+
+                        handler = variation_module['variate']
+
+                        started = time.time()
+
+                        # invoke variation module
+                        try:
+                            oid, tag, value = handler(
+                                oid, tag, value, **context)
 
-                    handler = variation_module['variate']
+                        except (NoDataNotification, MibOperationError):
+                            raise
 
-                    # invoke variation module
-                    oid, tag, value = handler(oid, tag, value, **context)
+                        except Exception:
+                            ReportingManager.update_metrics(
+                                variation=mod_name,
+                                data_file=context['dataFile'],
+                                variation_failure_count=1, **context)
+                            raise
 
-                    ReportingManager.update_metrics(
-                        variation=mod_name, variation_call_count=1, **context)
+                        ReportingManager.update_metrics(
+                            variation=mod_name, data_file=context['dataFile'],
+                            variation_call_count=1,
+                            variation_latency=time.time() - started,
+                            **context)
 
             else:
                 ReportingManager.update_metrics(
-                    variation=mod_name, variation_failure_count=1, **context)
+                    variation=mod_name, data_file=context.get('dataFile'),
+                    variation_failure_count=1, **context)
 
                 raise SnmpsimError(
                     'Variation module "%s" referenced but not '
@@ -104,12 +161,144 @@ class SnmprecRecordMixIn(object):
                     not context['exactMatch'] or context['setFlag']):
                 return context['origOid'], tag, context['errorStatus']
 
+        return self.evaluate_variation_result(
+            mod_name, oid, tag, value, **context)
+
+    def evaluate_variation_result(self, mod_name, oid, tag, value, **context):
+        if isinstance(value, deferred.Pending):
+            return oid, tag, self._hold_pending(
+                mod_name, oid, tag, value, **context)
+
         if not hasattr(value, 'tagSet'):  # not already a pyasn1 object
             return snmprec.SnmprecRecord.evaluate_value(
                        self, oid, tag, value, **context)
 
         return oid, tag, value
 
+    def _submit_variation(self, variation_module, mod_name, agent_context,
+                          record_context, oid, tag, value, **context):
+        handler = variation_module['variate']
+        contexts = variation_module['contexts']
+
+        def call_variation():
+            contexts.agentContext = agent_context
+            contexts.recordContext = record_context
+
+            try:
+                return handler(oid, tag, value, **context)
+
+            finally:
+                contexts.agentContext = contexts.recordContext = None
+
+        # no need to bother worker thread over non-existing instance
+        if (not context['nextFlag'] and not context['exactMatch'] and
+                not context['subtreeFlag']):
+            return context['origOid'], tag, context['errorStatus']
+
+        # module serving a subtree (record with empty type) picks the
+        # next OID by itself, while only values can be deferred, so call
+        # it right away
+        if context['nextFlag'] and (context['subtreeFlag'] or not tag):
+            started = time.time()
+
+            try:
+                result = call_variation()
+
+            except (NoDataNotification, MibOperationError):
+                raise
+
+            except Exception:
+                ReportingManager.update_metrics(
+                    variation=mod_name, data_file=context['dataFile'],
+                    variation_failure_count=1, **context)
+                raise
+
+            ReportingManager.update_metrics(
+                variation=mod_name, data_file=context['dataFile'],
+                variation_call_count=1,
+                variation_latency=time.time() - started, **context)
+
+            return result
+
+        started = time.time()
+
+        def report(pending):
+            if pending.exception() is None:
+                ReportingManager.update_metrics(
+                    variation=mod_name, data_file=context['dataFile'],
+                    variation_call_count=1,
+                    variation_latency=time.time() - started, **context)
+
+            elif isinstance(pending.exception(), ExecutorTimeoutError):
+                ReportingManager.update_metrics(
+                    variation=mod_name, data_file=context['dataFile'],
+                    variation_timeout_count=1, **context)
+
+            else:
+                ReportingManager.update_metrics(
+                    variation=mod_name, data_file=context['dataFile'],
+                    variation_failure_count=1, **context)
+
+        def evaluate_result(result):
+            # module may have changed the tag along with the value
+            _, tag, value = result
+
+            if hasattr(value, 'tagSet'):
+                return value
+
+            _, _, value = snmprec.SnmprecRecord.evaluate_value(
+                self, oid, tag, value, **context)
+
+            return value
+
+        pending = variation_module['executor'].submit(call_variation)
+
+        pending.add_done_callback(report)
+
+        # subtree modules answer exact queries for the requested OID
+        if not context['nextFlag']:
+            oid = context['origOid']
+
+        return oid, tag, pending.then(evaluate_result)
+
+    def _hold_pending(self, mod_name, oid, tag, value, **context):
+        response = deferred.current_response()
+
+        if response is None:
+            raise SnmpsimError(
+                'Variation module "%s" returned pending value for %s out '
+                'of SNMP request processing' % (mod_name, oid))
+
+        def evaluate_pending(result):
+            if hasattr(result, 'tagSet'):
+                return result
+
+            _, _, result = snmprec.SnmprecRecord.evaluate_value(
+                self, oid, tag, result, **context)
+
+            return result
+
+        def report_failure(pending):
+            if pending.exception() is not None:
+                ReportingManager.update_metrics(
+                    variation=mod_name, data_file=context['dataFile'],
+                    variation_failure_count=1, **context)
+
+        def report_timeout():
+            ReportingManager.update_metrics(
+                variation=mod_name, data_file=context['dataFile'],
+                variation_timeout_count=1, **context)
+
+        value = value.then(evaluate_pending)
+
+        # executor reports its calls by itself
+        if not context['variationModules'][mod_name][0]['executor']:
+            value.add_done_callback(report_failure)
+
+        response.hold(value, context['errorStatus'], expired=report_timeout)
+
+        return value
+
     def evaluate(self, line, **context):
         oid, tag, value = self.grammar.parse(line)
 
@@ -179,9 +368,339 @@ class CompressedSnmprecRecord(
 RECORD_TYPES[CompressedSnmprecRecord.ext] = CompressedSnmprecRecord()
 
 
-def load_variation_modules(search_path, modules_options):
+class BatchedValue(object):
+    """Var-bind value to be computed by `variate_many()` call.
+
+    Stands for the value of a record collected into
+    :py:class:`VariationBatch` until the batch is run.
+    """
+    def __init__(self, record, mod_name, context):
+        self._record = record
+        self._mod_name = mod_name
+        self._context = context
+        self._result = self._exception = None
+
+    def set_result(self, oid, tag, value):
+        try:
+            oid, _, value = self._record.evaluate_variation_result(
+                self._mod_name, oid, tag, value, **self._context)
+
+        except PyAsn1Error as exc:
+            self._exception = SnmpsimError(
+                'value evaluation for %s = %r failed: '
+                '%s\r\n' % (oid, value, exc))
+
+        except Exception as exc:
+            self._exception = exc
+
+        else:
+            self._result = oid, value
+
+    def set_exception(self, exception):
+        self._exception = exception
+
+    def result(self):
+        if self._exception is not None:
+            raise self._exception
+
+        if self._result is None:
+            raise SnmpsimError(
+                'variation module "%s" batch not run' % self._mod_name)
+
+        return self._result
+
+    def prettyPrint(self):
+        return '<batched>'
+
+
+class VariationBatch(object):
+    """Var-binds of a PDU routed to variation modules which implement
+    `variate_many()`.
+
+    Such records are collected here while the PDU var-binds are being
+    looked up, then each module gets called just once with all its
+    records by `run()`.
+
+    The `variate_many(records, **context)` handler is called with a list
+    of records, each being a tuple of `variate()` call parameters:
+    `oid`, `tag`, `value` and per-record `context` dict. The latter
+    carries record's context under the `recordContext` key, while the
+    `recordContext` global is set to `None` for the duration of the call.
+    Keyword parameters are those common to all var-binds of the PDU.
+
+    The handler is expected to return a list of `(oid, tag, value)`
+    tuples or exception objects, one per record and in the order of
+    records.
+    """
+    def __init__(self, variation_modules, **context):
+        self._variation_modules = variation_modules
+        self._context = context
+        self._records = {}
+        self._order = []
+
+    def add(self, record, mod_name, agent_context, record_context,
+            oid, tag, value, **context):
+        context.pop('variationBatch', None)
+        context['recordContext'] = record_context
+
+        batched = BatchedValue(record, mod_name, context)
+
+        if mod_name not in self._records:
+            self._records[mod_name] = agent_context, []
+            self._order.append(mod_name)
+
+        self._records[mod_name][1].append(
+            (batched, (oid, tag, value, context)))
+
+        return batched
+
+    def run(self):
+        """Call each module's `variate_many()` over its records"""
+        records, self._records = self._records, {}
+        order, self._order = self._order, []
+
+        for mod_name in order:
+            agent_context, entries = records[mod_name]
+
+            variation_module = self._variation_modules[mod_name][0]
+
+            variation_module['agentContext'] = agent_context
+            variation_module['recordContext'] = None
+
+            handler = variation_module['variate_many']
 
-    variation_modules = {}
+            started = time.time()
+
+            try:
+                results = handler(
+                    [params for _, params in entries], **self._context)
+
+                if len(results) != len(entries):
+                    raise SnmpsimError(
+                        'variation module "%s" returned %d results for %d '
+                        'records' % (mod_name, len(results), len(entries)))
+
+            except MibOperationError:
+                raise
+
+            except Exception as exc:
+                results = [exc] * len(entries)
+
+            failures = 0
+
+            for (batched, _), result in zip(entries, results):
+                if isinstance(result, Exception):
+                    batched.set_exception(result)
+                    failures += 1
+
+                else:
+                    batched.set_result(*result)
+
+            ReportingManager.update_metrics(
+                variation=mod_name, data_file=self._context.get('dataFile'),
+                variation_call_count=len(entries) - failures,
+                variation_failure_count=failures,
+                variation_latency=time.time() - started, **self._context)
+
+
+class ThreadContext(MutableMapping):
+    """Per-thread view of agent or record context.
+
+    Variation modules running in executor's worker threads see their
+    `agentContext` and `recordContext` globals through these proxies
+    so that concurrent calls do not step on each other.
+    """
+    def __init__(self, contexts, name):
+        self._contexts = contexts
+        self._name = name
+
+    @property
+    def _context(self):
+        return getattr(self._contexts, self._name)
+
+    def __getitem__(self, key):
+        return self._context[key]
+
+    def __setitem__(self, key, value):
+        self._context[key] = value
+
+    def __delitem__(self, key):
+        del self._context[key]
+
+    def __iter__(self):
+        return iter(self._context)
+
+    def __len__(self):
+        return len(self._context)
+
+
+def parse_executor_options(alias, params):
+    """Extract `executor=threads:<workers>[:<timeout>]` from module options.
+
+    Returns
+    -------
+    : :py:class:`tuple`
+        module options less executor specification, and
+        :py:class:`deferred.ThreadPoolExecutor` or `None`
+    """
+    options = []
+    executor = None
+
+    for option in params.split(','):
+        if not option.startswith('executor='):
+            options.append(option)
+            continue
+
+        spec = option[len('executor='):].split(':')
+
+        try:
+            if spec[0] != 'threads':
+                raise ValueError('unknown executor type %s' % spec[0])
+
+            workers = int(spec[1])
+            timeout = len(spec) > 2 and float(spec[2]) or EXECUTOR_TIMEOUT
+
+            if workers < 1 or timeout <= 0:
+                raise ValueError('out of range')
+
+        except (ValueError, IndexError) as exc:
+            raise SnmpsimError(
+                'Bad executor specification "%s" for variation module "%s" '
+                '(expected threads:<workers>[:<timeout>]): '
+                '%s' % (option, alias, exc))
+
+        executor = deferred.ThreadPoolExecutor(alias, workers, timeout)
+
+    return ','.join(options), executor
+
+
+# variation module call timeout in executor, seconds
+EXECUTOR_TIMEOUT = 5
+
+
+def import_variation_module(path, alias, ctx):
+    """Run variation module code in a namespace of its own.
+
+    The module gets imported as a fresh module object per `alias`, with
+    `ctx` items preset as its globals. Where importlib is available,
+    compiled module code is cached in `__pycache__` next to the module
+    (if writable), so it is not recompiled on every start.
+
+    Returns
+    -------
+    : :py:class:`dict`
+        module namespace
+    """
+    if importlib_util and hasattr(importlib_util, 'module_from_spec'):
+        spec = importlib_util.spec_from_file_location(
+            'snmpsim_variation_%s' % alias, path)
+
+        module = importlib_util.module_from_spec(spec)
+        module.__dict__.update(ctx)
+
+        spec.loader.exec_module(module)
+
+        return module.__dict__
+
+    with open(path) as fl:
+        exec(compile(fl.read(), path, 'exec'), ctx)
+
+    return ctx
+
+
+class VariationModules(dict):
+    """Variation modules by alias, loaded on demand.
+
+    Values are `(module namespace, agent contexts, record contexts)`
+    tuples.
+
+    Modules found in the search path are only imported when explicitly
+    configured or, by way of `require()`, once referenced by simulation
+    data being indexed. Modules loaded after
+    `initialize_variation_modules()` are initialized right away.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self._available = {}
+        self._failed = set()
+        self._mode = None
+
+    @property
+    def available(self):
+        return self._available
+
+    def discover(self, alias, path, params):
+        self._available[alias] = path, params
+
+    def load(self, alias):
+        path, params = self._available[alias]
+
+        try:
+            params, executor = parse_executor_options(alias, params)
+
+        except SnmpsimError as exc:
+            log.error('ignoring variation module "%s": %s' % (alias, exc))
+            self._failed.add(alias)
+            return
+
+        ctx = {
+            'path': path,
+            'alias': alias,
+            'args': params,
+            'moduleContext': {},
+            'executor': executor
+        }
+
+        if executor:
+            contexts = ctx['contexts'] = threading.local()
+
+            ctx['agentContext'] = ThreadContext(contexts, 'agentContext')
+            ctx['recordContext'] = ThreadContext(contexts, 'recordContext')
+
+        try:
+            ctx = import_variation_module(path, alias, ctx)
+
+        except Exception as exc:
+            log.error(
+                'Variation module "%s" execution failure: '
+                '%s' % (path, exc))
+            self._failed.add(alias)
+            return
+
+        # moduleContext, agentContexts, recordContexts
+        self[alias] = ctx, {}, {}
+
+        if self._mode:
+            initialize_variation_module(alias, ctx, self._mode)
+
+    def require(self, aliases):
+        """Load not yet loaded variation modules by alias"""
+        for alias in aliases:
+            if (alias in self or alias in self._failed or
+                    alias not in self._available):
+                continue
+
+            log.info('Loading variation module "%s" referenced by '
+                     'simulation data' % alias)
+
+            self.load(alias)
+
+    def initialize(self, mode):
+        self._mode = mode
+
+        for alias, (body, _, _) in list(self.items()):
+            initialize_variation_module(alias, body, mode)
+
+
+def load_variation_modules(search_path, modules_options):
+    """Find variation modules, load explicitly configured ones.
+
+    Returns
+    -------
+    : :py:class:`VariationModules`
+        configured modules, others to be loaded on demand
+    """
+    variation_modules = VariationModules()
     modules_options = modules_options.copy()
 
     for variation_modules_dir in search_path:
@@ -193,6 +712,8 @@ def load_variation_modules(search_path, modules_options):
             log.info('Directory "%s" does not exist' % variation_modules_dir)
             continue
 
+        found = 0
+
         for d_file in os.listdir(variation_modules_dir):
             if d_file[-3:] != '.py':
                 continue
@@ -204,44 +725,31 @@ def load_variation_modules(search_path, modules_options):
             if mod_name in modules_options:
                 while modules_options[mod_name]:
                     alias, params = modules_options[mod_name].pop()
-                    _to_load.append((alias, params))
+                    _to_load.append((alias, params, True))
 
                 del modules_options[mod_name]
 
             else:
-                _to_load.append((mod_name, ''))
+                _to_load.append((mod_name, '', False))
 
             mod = os.path.abspath(os.path.join(variation_modules_dir, d_file))
 
-            for alias, params in _to_load:
-                if alias in variation_modules:
+            for alias, params, configured in _to_load:
+                if alias in variation_modules.available:
                     log.error(
                         'ignoring duplicate variation module "%s" at '
                         '"%s"' % (alias, mod))
                     continue
 
-                ctx = {
-                    'path': mod,
-                    'alias': alias,
-                    'args': params,
-                    'moduleContext': {}
-                }
+                variation_modules.discover(alias, mod, params)
 
-                try:
-                    with open(mod) as fl:
-                        exec(compile(fl.read(), mod, 'exec'), ctx)
+                found += 1
 
-                except Exception as exc:
-                    log.error(
-                        'Variation module "%s" execution failure: '
-                        '%s' % (mod, exc))
-                    return 1
-
-                # moduleContext, agentContexts, recordContexts
-                variation_modules[alias] = ctx, {}, {}
+                if configured:
+                    variation_modules.load(alias)
 
         log.info('A total of %s modules found in '
-                 '%s' % (len(variation_modules), variation_modules_dir))
+                 '%s' % (found, variation_modules_dir))
 
     if modules_options:
         log.info('WARNING: unused options for variation modules: '
@@ -250,31 +758,51 @@ def load_variation_modules(search_path, modules_options):
     return variation_modules
 
 
-def initialize_variation_modules(variation_modules, mode):
-    log.info('Initializing variation modules...')
+def initialize_variation_module(name, body, mode):
+    for handler in ('init', 'variate', 'shutdown'):
+        if handler not in body:
+            log.error('missing "%s" handler at variation module '
+                      '"%s"' % (handler, name))
+            return 1
+
+    try:
+        body['init'](options=body['args'], mode=mode)
 
-    for name, modules_contexts in variation_modules.items():
+    except Exception as exc:
+        log.error(
+            'Variation module "%s" from "%s" load FAILED: '
+            '%s' % (body['alias'], body['path'], exc))
 
-        body = modules_contexts[0]
+    else:
+        log.info(
+            'Variation module "%s" from "%s" '
+            'loaded OK' % (body['alias'], body['path']))
 
-        for handler in ('init', 'variate', 'shutdown'):
-            if handler not in body:
-                log.error('missing "%s" handler at variation module '
-                          '"%s"' % (handler, name))
-                return 1
+        executor = body.get('executor')
 
-        try:
-            body['init'](options=body['args'], mode=mode)
+        if not executor:
+            return
 
-        except Exception as exc:
+        # module declares whether its calls may run concurrently
+        if not body['moduleContext'].get('threadSafe'):
             log.error(
-                'Variation module "%s" from "%s" load FAILED: '
-                '%s' % (body['alias'], body['path'], exc))
+                'Variation module "%s" is not thread-safe as configured, '
+                'ignoring its executor option' % body['alias'])
+            body['executor'] = None
+            return
 
-        else:
-            log.info(
-                'Variation module "%s" from "%s" '
-                'loaded OK' % (body['alias'], body['path']))
+        ReportingManager.add_probe(
+            'variation_executor_%s' % body['alias'], executor.stats)
+
+        log.info(
+            'Variation module "%s" calls are run by executor '
+            'of %s threads' % (body['alias'], executor.workers))
+
+
+def initialize_variation_modules(variation_modules, mode):
+    log.info('Initializing variation modules...')
+
+    variation_modules.initialize(mode)
 
 
 def parse_modules_options(options):
@@ -7,6 +7,7 @@
 import random
 import time
 
+from snmpsim import deferred
 from snmpsim import error
 from snmpsim import log
 from snmpsim.grammar.snmprec import SnmprecGrammar
@@ -18,94 +19,96 @@ def init(**context):
     random.seed()
 
 
-def variate(oid, tag, value, **context):
-    if not context['nextFlag'] and not context['exactMatch']:
-        return context['origOid'], tag, context['errorStatus']
+def compile(value, **context):
+    settings = dict(
+        [split(x, '=') for x in split(value, ',')])
 
-    if 'settings' not in recordContext:
-        recordContext['settings'] = dict(
-            [split(x, '=') for x in split(value, ',')])
+    if 'hexvalue' in settings:
+        settings['value'] = [
+            int(settings['hexvalue'][x:x + 2], 16)
+            for x in range(0, len(settings['hexvalue']), 2)]
 
-        if 'hexvalue' in recordContext['settings']:
-            recordContext['settings']['value'] = [
-                int(recordContext['settings']['hexvalue'][x:x + 2], 16)
-                for x in range(0, len(recordContext['settings']['hexvalue']), 2)]
+    if 'wait' in settings:
+        settings['wait'] = float(settings['wait'])
 
-        if 'wait' in recordContext['settings']:
-            recordContext['settings']['wait'] = float(
-                recordContext['settings']['wait'])
+    else:
+        settings['wait'] = 500.0
 
-        else:
-            recordContext['settings']['wait'] = 500.0
+    if 'deviation' in settings:
+        settings['deviation'] = float(settings['deviation'])
+
+    else:
+        settings['deviation'] = 0.0
 
-        if 'deviation' in recordContext['settings']:
-            recordContext['settings']['deviation'] = float(
-                recordContext['settings']['deviation'])
+    if 'vlist' in settings:
 
-        else:
-            recordContext['settings']['deviation'] = 0.0
+        vlist = {}
 
-        if 'vlist' in recordContext['settings']:
+        settings['vlist'] = split(settings['vlist'], ':')
 
-            vlist = {}
+        while settings['vlist']:
+            o, v, d = settings['vlist'][:3]
 
-            recordContext['settings']['vlist'] = split(
-                recordContext['settings']['vlist'], ':')
+            settings['vlist'] = settings['vlist'][3:]
 
-            while recordContext['settings']['vlist']:
-                o, v, d = recordContext['settings']['vlist'][:3]
+            d = int(d)
 
-                recordContext['settings']['vlist'] = recordContext['settings']['vlist'][3:]
+            type_tag, _ = SnmprecRecord.unpack_tag(context['tag'])
 
-                d = int(d)
+            v = SnmprecGrammar.TAG_MAP[type_tag](v)
 
-                type_tag, _ = SnmprecRecord.unpack_tag(tag)
+            if o not in vlist:
+                vlist[o] = {}
 
-                v = SnmprecGrammar.TAG_MAP[type_tag](v)
+            if o == 'eq':
+                vlist[o][v] = d
 
-                if o not in vlist:
-                    vlist[o] = {}
+            elif o in ('lt', 'gt'):
+                vlist[o] = v, d
 
-                if o == 'eq':
-                    vlist[o][v] = d
+            else:
+                log.info('delay: bad vlist syntax: '
+                        '%s' % settings['vlist'])
 
-                elif o in ('lt', 'gt'):
-                    vlist[o] = v, d
+        settings['vlist'] = vlist
 
-                else:
-                    log.info('delay: bad vlist syntax: '
-                            '%s' % recordContext['settings']['vlist'])
+    if 'tlist' in settings:
+        tlist = {}
 
-            recordContext['settings']['vlist'] = vlist
+        settings['tlist'] = split(settings['tlist'], ':')
 
-        if 'tlist' in recordContext['settings']:
-            tlist = {}
+        while settings['tlist']:
+            o, v, d = settings['tlist'][:3]
 
-            recordContext['settings']['tlist'] = split(
-                recordContext['settings']['tlist'], ':')
+            settings['tlist'] = settings['tlist'][3:]
 
-            while recordContext['settings']['tlist']:
-                o, v, d = recordContext['settings']['tlist'][:3]
+            v = int(v)
+            d = int(d)
 
-                recordContext['settings']['tlist'] = recordContext['settings']['tlist'][3:]
+            if o not in tlist:
+                tlist[o] = {}
 
-                v = int(v)
-                d = int(d)
+            if o == 'eq':
+                tlist[o][v] = d
 
-                if o not in tlist:
-                    tlist[o] = {}
+            elif o in ('lt', 'gt'):
+                tlist[o] = v, d
 
-                if o == 'eq':
-                    tlist[o][v] = d
+            else:
+                log.info('delay: bad tlist syntax: '
+                        '%s' % settings['tlist'])
 
-                elif o in ('lt', 'gt'):
-                    tlist[o] = v, d
+        settings['tlist'] = tlist
 
-                else:
-                    log.info('delay: bad tlist syntax: '
-                            '%s' % recordContext['settings']['tlist'])
+    return settings
 
-            recordContext['settings']['tlist'] = tlist
+
+def variate(oid, tag, value, **context):
+    if not context['nextFlag'] and not context['exactMatch']:
+        return context['origOid'], tag, context['errorStatus']
+
+    if 'settings' not in recordContext:
+        recordContext['settings'] = compile(value, tag=tag)
 
     if context['setFlag'] and 'vlist' in recordContext['settings']:
         if ('eq' in recordContext['settings']['vlist'] and
@@ -155,9 +158,16 @@ def variate(oid, tag, value, **context):
         log.info('delay: dropping response for %s' % oid)
         raise error.NoDataNotification()
 
-    log.info('delay: waiting %d milliseconds for %s' % (delay, oid))
+    log.info('delay: waiting %d milliseconds for %s', delay, oid)
+
+    response = deferred.current_response()
 
-    time.sleep(delay / 1000)  # ms
+    if response is None:
+        time.sleep(delay / 1000.0)  # ms
+
+    else:
+        # hold the response back without blocking other requests
+        response.delay(delay / 1000.0)  # ms
 
     if context['setFlag'] or 'value' not in recordContext['settings']:
         return oid, tag, context['origValue']
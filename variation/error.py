@@ -39,52 +39,58 @@ def init(**context):
     pass
 
 
-def variate(oid, tag, value, **context):
-    if not context['nextFlag'] and not context['exactMatch']:
-        return context['origOid'], tag, context['errorStatus']
+def compile(value, **context):
+    settings = dict(
+        [split(x, '=') for x in split(value, ',')])
 
-    if 'settings' not in recordContext:
-        recordContext['settings'] = dict(
-            [split(x, '=') for x in split(value, ',')])
+    if 'hexvalue' in settings:
+        settings['value'] = [
+            int(settings['hexvalue'][x:x + 2], 16)
+            for x in range(0, len(settings['hexvalue']), 2)]
 
-        if 'hexvalue' in recordContext['settings']:
-            recordContext['settings']['value'] = [
-                int(recordContext['settings']['hexvalue'][x:x + 2], 16)
-                for x in range(0, len(recordContext['settings']['hexvalue']), 2)]
+    if 'status' in settings:
+        settings['status'] = settings['status'].lower()
 
-        if 'status' in recordContext['settings']:
-            recordContext['settings']['status'] = recordContext['settings']['status'].lower()
+    if 'op' not in settings:
+        settings['op'] = 'any'
 
-        if 'op' not in recordContext['settings']:
-            recordContext['settings']['op'] = 'any'
+    if 'vlist' in settings:
+        vlist = {}
 
-        if 'vlist' in recordContext['settings']:
-            vlist = {}
+        settings['vlist'] = split(settings['vlist'], ':')
+
+        while settings['vlist']:
+            o, v, e = settings['vlist'][:3]
 
-            recordContext['settings']['vlist'] = split(recordContext['settings']['vlist'], ':')
+            settings['vlist'] = settings['vlist'][3:]
 
-            while recordContext['settings']['vlist']:
-                o, v, e = recordContext['settings']['vlist'][:3]
+            typeTag, _ = SnmprecRecord.unpack_tag(context['tag'])
 
-                recordContext['settings']['vlist'] = recordContext['settings']['vlist'][3:]
+            v = SnmprecGrammar.TAG_MAP[typeTag](v)
 
-                typeTag, _ = SnmprecRecord.unpack_tag(tag)
+            if o not in vlist:
+                vlist[o] = {}
 
-                v = SnmprecGrammar.TAG_MAP[typeTag](v)
+            if o == 'eq':
+                vlist[o][v] = e
 
-                if o not in vlist:
-                    vlist[o] = {}
+            elif o in ('lt', 'gt'):
+                vlist[o] = v, e
 
-                if o == 'eq':
-                    vlist[o][v] = e
+            else:
+                log.info('error: bad vlist syntax: %s' % settings['vlist'])
 
-                elif o in ('lt', 'gt'):
-                    vlist[o] = v, e
+        settings['vlist'] = vlist
 
-                else:
-                    log.info('error: bad vlist syntax: %s' % recordContext['settings']['vlist'])
+    return settings
 
-            recordContext['settings']['vlist'] = vlist
+
+def variate(oid, tag, value, **context):
+    if not context['nextFlag'] and not context['exactMatch']:
+        return context['origOid'], tag, context['errorStatus']
+
+    if 'settings' not in recordContext:
+        recordContext['settings'] = compile(value, tag=tag)
 
     e = None
 
@@ -11,7 +11,6 @@ import bisect
 import os
 import time
 
-from pyasn1.compat.octets import str2octs
 from pysnmp.proto import rfc1902
 
 from snmpsim import confdir
@@ -22,9 +21,7 @@ from snmpsim.record import mvc
 from snmpsim.record import sap
 from snmpsim.record import snmprec
 from snmpsim.record import walk
-from snmpsim.record.search.database import RecordIndex
 from snmpsim.record.search.file import get_record
-from snmpsim.record.search.file import search_record_by_oid
 from snmpsim.utils import split
 
 # data file types and parsers
@@ -38,6 +35,121 @@ RECORD_SET = {
 }
 
 
+class Timeline(object):
+    """Records of all snapshots in a directory merged by OID.
+
+    Snapshots are read into memory once. OIDs of all of them make up a
+    single sorted list, each snapshot is kept as a list of its records
+    aligned with that list (`None` where the snapshot lacks the OID).
+    Switching to another snapshot is then just picking another list.
+    """
+    def __init__(self, directory):
+        snapshots = []
+
+        for fl in os.listdir(directory):
+            for ext in RECORD_SET:
+                if not fl.endswith(ext):
+                    continue
+
+                try:
+                    ident = int(os.path.basename(fl)[:-len(ext) - 1])
+
+                except ValueError:
+                    continue
+
+                datafile = os.path.join(directory, fl)
+
+                snapshots.append(
+                    (ident, datafile, RECORD_SET[ext],
+                     self._read(datafile, RECORD_SET[ext])))
+
+        snapshots.sort(key=lambda x: x[0])
+
+        oids = set()
+
+        for _, _, _, records in snapshots:
+            oids.update(records)
+
+        self.oids = sorted(oids)
+        self.keys = [x[0] for x in snapshots]
+        self.files = [x[1] for x in snapshots]
+        self.parsers = [x[2] for x in snapshots]
+        self.records = [
+            [records.get(x) for x in self.oids]
+            for _, _, _, records in snapshots]
+
+        log.info('multiplex: %s snapshots of %s OIDs loaded from '
+                 '%s' % (len(self.keys), len(self.oids), directory))
+
+    @staticmethod
+    def _read(datafile, parser):
+        records = {}
+
+        text = parser.open(datafile)
+
+        try:
+            while True:
+                line, _, _ = get_record(text)
+
+                if not line:
+                    break
+
+                oid, _ = parser.evaluate(line, oidOnly=True)
+
+                records[tuple(oid)] = line
+
+        finally:
+            text.close()
+
+        return records
+
+    def lookup(self, fileno, oid, next_flag):
+        """Return (OID, value) of snapshot record or `None` if not found"""
+        records = self.records[fileno]
+
+        key = tuple(oid)
+
+        if next_flag:
+            idx = bisect.bisect_right(self.oids, key)
+
+            while idx < len(records) and records[idx] is None:
+                idx += 1
+
+        else:
+            idx = bisect.bisect_left(self.oids, key)
+
+            if idx < len(self.oids) and self.oids[idx] != key:
+                return
+
+        if idx >= len(records) or records[idx] is None:
+            return
+
+        record = records[idx]
+
+        if not isinstance(record, tuple):
+            # evaluate once, on first use
+            try:
+                record = records[idx] = self.parsers[fileno].evaluate(record)
+
+            except error.SnmpsimError:
+                return
+
+        return record
+
+
+def _get_timeline(directory):
+    """Return snapshots timeline shared by all records referring it"""
+    directory = os.path.realpath(directory)
+
+    try:
+        return moduleContext['timelines'][directory]
+
+    except KeyError:
+        timeline = moduleContext['timelines'][directory] = Timeline(directory)
+
+        return timeline
+
+
 def init(**context):
 
     if context['options']:
@@ -55,6 +167,11 @@ def init(**context):
 
     if context['mode'] == 'variating':
         moduleContext['booted'] = time.time()
+        moduleContext['timelines'] = {}
+
+        # load snapshots up front rather than on first request
+        if 'dir' in moduleContext:
+            _get_timeline(moduleContext['dir'])
 
     elif context['mode'] == 'recording':
         if 'dir' not in moduleContext:
@@ -107,22 +224,13 @@ def variate(oid, tag, value, **context):
         else:
             d = recordContext['settings']['dir']
 
-        recordContext['dirmap'] = {}
-        recordContext['parsermap'] = {}
+        timeline = _get_timeline(d)
 
-        for fl in os.listdir(d):
-            for ext in RECORD_SET:
-                if not fl.endswith(ext):
-                    continue
-                ident = int(os.path.basename(fl)[:-len(ext) - 1])
-                datafile = os.path.join(d, fl)
-                recordContext['dirmap'][ident] = datafile
-                recordContext['parsermap'][datafile] = RECORD_SET[ext]
-
-        recordContext['keys'] = list(recordContext['dirmap'])
+        if not timeline.files:
+            log.info('multiplex: no snapshots found at %s' % d)
+            return context['origOid'], tag, context['errorStatus']
 
-        recordContext['bounds'] = (
-            min(recordContext['keys']), max(recordContext['keys']))
+        recordContext['timeline'] = timeline
 
         if 'period' in recordContext['settings']:
             recordContext['settings']['period'] = float(
@@ -155,15 +263,17 @@ def variate(oid, tag, value, **context):
     if oid not in moduleContext:
         moduleContext[oid] = {}
 
+    timeline = recordContext['timeline']
+
     if context['setFlag']:
         if 'control' in (
                 recordContext['settings'] and
                 recordContext['settings']['control'] == context['origOid']):
 
             fileno = int(context['origValue'])
-            if fileno >= len(recordContext['keys']):
+            if fileno >= len(timeline.keys):
                 log.info('multiplex: .snmprec file number %s over limit of'
-                        ' %s' % (fileno, len(recordContext['keys'])))
+                        ' %s' % (fileno, len(timeline.keys)))
 
                 return context['origOid'], tag, context['errorStatus']
 
@@ -171,8 +281,7 @@ def variate(oid, tag, value, **context):
 
             log.info(
                 'multiplex: switched to file #%s '
-                '(%s)' % (recordContext['keys'][fileno],
-                          recordContext['dirmap'][recordContext['keys'][fileno]]))
+                '(%s)' % (timeline.keys[fileno], timeline.files[fileno]))
 
             return context['origOid'], tag, context['origValue']
 
@@ -194,74 +303,25 @@ def variate(oid, tag, value, **context):
         period = recordContext['settings']['period']
 
         uptime = time.time() - moduleContext['booted']
-        timeslot = uptime % (period * len(recordContext['dirmap']))
+        timeslot = uptime % (period * len(timeline.keys))
 
-        fileslot = int(timeslot / period) + recordContext['bounds'][0]
+        fileslot = int(timeslot / period) + timeline.keys[0]
 
-        fileno = bisect.bisect(recordContext['keys'], fileslot) - 1
+        fileno = bisect.bisect(timeline.keys, fileslot) - 1
 
         if ('fileno' not in moduleContext[oid] or
                 moduleContext[oid]['fileno'] < fileno or
                 recordContext['settings']['wrap']):
             moduleContext[oid]['fileno'] = fileno
 
-    datafile = recordContext['dirmap'][
-        recordContext['keys'][moduleContext[oid]['fileno']]]
-
-    parser = recordContext['parsermap'][datafile]
-
-    if ('datafile' not in moduleContext[oid] or
-            moduleContext[oid]['datafile'] != datafile):
-
-        if 'datafileobj' in moduleContext[oid]:
-            moduleContext[oid]['datafileobj'].close()
-
-        recordIndex = RecordIndex(datafile, parser).create()
-
-        moduleContext[oid]['datafileobj'] = recordIndex
+    record = timeline.lookup(
+        moduleContext[oid]['fileno'], context['origOid'],
+        context['nextFlag'])
 
-        moduleContext[oid]['datafile'] = datafile
-
-        log.info(
-            'multiplex: switching to data file %s for '
-            '%s' % (datafile, context['origOid']))
-
-    text, db = moduleContext[oid]['datafileobj'].get_handles()
-
-    textOid = str(rfc1902.OctetString(
-        '.'.join(['%s' % x for x in context['origOid']])))
-
-    try:
-        line = moduleContext[oid]['datafileobj'].lookup(textOid)
-
-    except KeyError:
-        offset = search_record_by_oid(context['origOid'], text, parser)
-        exactMatch = False
-
-    else:
-        offset, subtreeFlag, prevOffset = line.split(str2octs(','))
-        exactMatch = True
-
-    text.seek(int(offset))
-
-    line, _, _ = get_record(text)  # matched line
-
-    if context['nextFlag']:
-        if exactMatch:
-            line, _, _ = get_record(text)
-
-    else:
-        if not exactMatch:
-            return context['origOid'], tag, context['errorStatus']
-
-    if not line:
+    if record is None:
         return context['origOid'], tag, context['errorStatus']
 
-    try:
-        oid, value = parser.evaluate(line)
-
-    except error.SnmpsimError:
-        oid, value = context['origOid'], context['errorStatus']
+    oid, value = record
 
     return oid, tag, value
 
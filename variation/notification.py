@@ -7,17 +7,163 @@
 # Managed value variation module
 # Send SNMP Notification
 #
+import collections
+import time
+
 from pysnmp.hlapi.asyncore import *
 
+from snmpsim import deferred
 from snmpsim import error
 from snmpsim import log
 from snmpsim.grammar.snmprec import SnmprecGrammar
 from snmpsim.record.snmprec import SnmprecRecord
+from snmpsim.reporting.manager import ReportingManager
 from snmpsim.utils import split
 
 
+class NotificationSender(object):
+    """Send notifications off the SNMP request processing path.
+
+    Notifications are queued per target and sent out from the I/O loop
+    once SNMP request processing is over. Notification being queued
+    for a target while the same one is still waiting there is dropped.
+
+    Each target is allowed at most `rate` notifications per second
+    (token bucket of `burst` size), the rest of them wait in the queue
+    of up to `depth` notifications. Queue overflow drops the oldest
+    notification.
+    """
+    def __init__(self, rate=0, burst=10, depth=100):
+        self._rate = rate
+        self._burst = burst
+        self._depth = depth
+        self._queues = {}
+        self._buckets = {}
+        self._flush_at = None
+        self._sent = self._coalesced = self._dropped = 0
+
+    def enqueue(self, target_key, ntf_key, *args):
+        try:
+            queue = self._queues[target_key]
+
+        except KeyError:
+            queue = self._queues[target_key] = collections.OrderedDict()
+
+        if ntf_key in queue:
+            self._coalesced += 1
+            return
+
+        if len(queue) >= self._depth:
+            queue.popitem(last=False)
+            self._dropped += 1
+
+        queue[ntf_key] = args
+
+        self._schedule(0)
+
+    def _schedule(self, delay):
+        deadline = time.time() + delay
+
+        if self._flush_at is None or deadline < self._flush_at:
+            self._flush_at = deadline
+            deferred.TIMERS.call_at(deadline, self._flush, deadline)
+
+    def _take_token(self, target_key, now):
+        """Return seconds to wait for the next token, 0 if taken"""
+        if not self._rate:
+            return 0
+
+        tokens, updated = self._buckets.get(target_key, (self._burst, now))
+
+        tokens = min(self._burst, tokens + (now - updated) * self._rate)
+
+        if tokens < 1:
+            self._buckets[target_key] = tokens, now
+            return (1 - tokens) / self._rate
+
+        self._buckets[target_key] = tokens - 1, now
+
+        return 0
+
+    def _flush(self, deadline):
+        if deadline != self._flush_at:
+            return  # superseded by an earlier flush
+
+        self._flush_at = None
+
+        now = time.time()
+        delay = None
+
+        for target_key, queue in list(self._queues.items()):
+            while queue:
+                wait = self._take_token(target_key, now)
+
+                if wait:
+                    delay = min(delay or wait, wait)
+                    break
+
+                _, args = queue.popitem(last=False)
+
+                self._send(*args)
+
+            if not queue:
+                del self._queues[target_key]
+
+        if delay is not None:
+            self._schedule(delay)
+
+    def _send(self, snmpEngine, authData, target, ntfType,
+              notificationType, cbCtx):
+        try:
+            sendNotification(
+                snmpEngine, authData, target, ContextData(),
+                ntfType, notificationType, cbFun=_cbFun, cbCtx=cbCtx)
+
+        except Exception as exc:
+            log.info('notification: sending to %s failed: %s' % (target, exc))
+            return
+
+        self._sent += 1
+
+        log.info('notification: sending Notification to %s with credentials '
+                 '%s' % (target, authData))
+
+    def stats(self):
+        return {'queue_depth': sum(len(x) for x in self._queues.values()),
+                'sent_total': self._sent,
+                'coalesced_total': self._coalesced,
+                'dropped_total': self._dropped}
+
+    def close(self):
+        queued = self.stats()['queue_depth']
+
+        if queued:
+            log.info('notification: %s queued notifications '
+                     'discarded' % queued)
+
+        self._queues.clear()
+
+
 def init(**context):
-    pass
+    options = {}
+
+    if context['options']:
+        options.update(
+            dict([split(x, ':') for x in split(context['options'], ',')]))
+
+    try:
+        sender = NotificationSender(
+            rate=float(options.get('ratelimit', 0)),
+            burst=int(options.get('burst', 10)),
+            depth=int(options.get('queue', 100)))
+
+    except ValueError:
+        raise error.SnmpsimError(
+            'malformed notification ratelimit, burst or queue option')
+
+    moduleContext['sender'] = sender
+
+    ReportingManager.add_probe('variation_notification', sender.stats)
 
 
 TYPE_MAP = {
@@ -58,6 +204,166 @@ def _cbFun(sendRequestHandle, errorIndication, errorStatus,
                                 errorStatus))
 
 
+def _build_notification(oid, args, **context):
+    """Build credentials, target and notification to send or `None`"""
+    if args['version'] in ('1', '2c'):
+        authData = CommunityData(
+            args['community'], mpModel=args['version'] == '2c' and 1 or 0)
+
+    elif args['version'] == '3':
+        if args['authproto'] == 'md5':
+            authProtocol = usmHMACMD5AuthProtocol
+
+        elif args['authproto'] == 'sha':
+            authProtocol = usmHMACSHAAuthProtocol
+
+        elif args['authproto'] == 'none':
+            authProtocol = usmNoAuthProtocol
+
+        else:
+            log.info('notification: unknown auth proto '
+                    '%s' % args['authproto'])
+            return
+
+        if args['privproto'] == 'des':
+            privProtocol = usmDESPrivProtocol
+
+        elif args['privproto'] == 'aes':
+            privProtocol = usmAesCfb128Protocol
+
+        elif args['privproto'] == 'none':
+            privProtocol = usmNoPrivProtocol
+
+        else:
+            log.info('notification: unknown privacy proto '
+                    '%s' % args['privproto'])
+            return
+
+        authData = UsmUserData(
+            args['user'], args['authkey'], args['privkey'],
+            authProtocol=authProtocol,
+            privProtocol=privProtocol)
+
+    else:
+        log.info('notification: unknown SNMP version %s' % args['version'])
+        return
+
+    if 'host' not in args:
+        log.info('notification: target hostname not configured for '
+                'OID %s' % (oid,))
+        return
+
+    if args['proto'] == 'udp':
+        target = UdpTransportTarget((args['host'], int(args['port'])))
+
+    elif args['proto'] == 'udp6':
+        target = Udp6TransportTarget((args['host'], int(args['port'])))
+
+    else:
+        log.info('notification: unknown transport %s' % args['proto'])
+        return
+
+    localAddress = None
+
+    if 'bindaddr' in args:
+        localAddress = args['bindaddr']
+
+    else:
+        transportDomain = context['transportDomain'][:len(target.transportDomain)]
+        if transportDomain == target.transportDomain:
+            localAddress = context['snmpEngine'].transportDispatcher.getTransport(
+                context['transportDomain']).getLocalAddress()[0]
+
+        else:
+            log.info('notification: incompatible network transport types used by '
+                    'CommandResponder vs NotificationOriginator')
+
+            if 'bindaddr' in args:
+                localAddress = args['bindaddr']
+
+    if localAddress:
+        log.info('notification: binding to local address %s' % localAddress)
+        target.setLocalAddress((localAddress, 0))
+
+    # this will make target objects different based on their bind address 
+    target.transportDomain = target.transportDomain + context['transportDomain']
+
+    varBinds = []
+
+    if 'uptime' in args:
+        varBinds.append(
+            (ObjectIdentifier('1.3.6.1.2.1.1.3.0'),
+             TimeTicks(args['uptime'])))
+
+    if args['version'] == '1':
+        if 'agentaddress' in args:
+            varBinds.append(
+                (ObjectIdentifier('1.3.6.1.6.3.18.1.3.0'),
+                 IpAddress(args['agentaddress'])))
+
+        if 'enterprise' in args:
+            varBinds.append(
+                (ObjectIdentifier('1.3.6.1.6.3.1.1.4.3.0'),
+                 ObjectIdentifier(args['enterprise'])))
+
+    if 'varbinds' in args:
+        vbs = split(args['varbinds'], ':')
+        while vbs:
+            varBinds.append(
+                (ObjectIdentifier(vbs[0]), TYPE_MAP[vbs[1]](vbs[2])))
+            vbs = vbs[3:]
+
+    notificationType = NotificationType(
+        ObjectIdentity(args['trapoid'])).addVarBinds(*varBinds)
+
+    return authData, target, notificationType
+
+
+def compile(value, **context):
+    settings = dict([split(x, '=') for x in split(value, ',')])
+
+    for k, v in MODULE_OPTIONS:
+        settings.setdefault(k, v)
+
+    if 'hexvalue' in settings:
+        settings['value'] = [
+            int(settings['hexvalue'][x:x + 2], 16)
+            for x in range(0, len(settings['hexvalue']), 2)]
+
+    if 'vlist' in settings:
+        vlist = {}
+
+        settings['vlist'] = split(settings['vlist'], ':')
+
+        while settings['vlist']:
+
+            o, v = settings['vlist'][:2]
+
+            settings['vlist'] = settings['vlist'][2:]
+
+            typeTag, _ = SnmprecRecord.unpack_tag(context['tag'])
+
+            v = SnmprecGrammar.TAG_MAP[typeTag](v)
+
+            if o not in vlist:
+                vlist[o] = set()
+
+            if o == 'eq':
+                vlist[o].add(v)
+
+            elif o in ('lt', 'gt'):
+                vlist[o] = v
+
+            else:
+                log.info(
+                    'notification: bad vlist syntax: '
+                    '%s' % settings['vlist'])
+
+        settings['vlist'] = vlist
+
+    return settings
+
+
 def variate(oid, tag, value, **context):
 
     if 'snmpEngine' in context and context['snmpEngine']:
@@ -90,49 +396,7 @@ def variate(oid, tag, value, **context):
         return context['origOid'], tag, context['errorStatus']
 
     if 'settings' not in recordContext:
-
-        recordContext['settings'] = dict([split(x, '=') for x in split(value, ',')])
-
-        for k, v in MODULE_OPTIONS:
-            recordContext['settings'].setdefault(k, v)
-
-        if 'hexvalue' in recordContext['settings']:
-            recordContext['settings']['value'] = [
-                int(recordContext['settings']['hexvalue'][x:x + 2], 16)
-                for x in range(0, len(recordContext['settings']['hexvalue']), 2)]
-
-        if 'vlist' in recordContext['settings']:
-            vlist = {}
-
-            recordContext['settings']['vlist'] = split(
-                recordContext['settings']['vlist'], ':')
-
-            while recordContext['settings']['vlist']:
-
-                o, v = recordContext['settings']['vlist'][:2]
-
-                vlist = recordContext['settings']['vlist'][2:]
-                recordContext['settings']['vlist'] = vlist
-
-                typeTag, _ = SnmprecRecord.unpack_tag(tag)
-
-                v = SnmprecGrammar.TAG_MAP[typeTag](v)
-
-                if o not in vlist:
-                    vlist[o] = set()
-
-                if o == 'eq':
-                    vlist[o].add(v)
-
-                elif o in ('lt', 'gt'):
-                    vlist[o] = v
-
-                else:
-                    log.info(
-                        'notification: bad vlist syntax: '
-                        '%s' % recordContext['settings']['vlist'])
-
-            recordContext['settings']['vlist'] = vlist
+        recordContext['settings'] = compile(value, tag=tag)
 
     args = recordContext['settings']
 
@@ -162,124 +426,30 @@ def variate(oid, tag, value, **context):
                 args['op'] == 'set' and context['setFlag'] or
                 args['op'] in ('any', '*')):
 
-        if args['version'] in ('1', '2c'):
-            authData = CommunityData(
-                args['community'], mpModel=args['version'] == '2c' and 1 or 0)
+        try:
+            notifications = recordContext['notifications']
 
-        elif args['version'] == '3':
-            if args['authproto'] == 'md5':
-                authProtocol = usmHMACMD5AuthProtocol
+        except KeyError:
+            notifications = recordContext['notifications'] = {}
 
-            elif args['authproto'] == 'sha':
-                authProtocol = usmHMACSHAAuthProtocol
+        # building notification is expensive, do it once per transport
+        try:
+            notification = notifications[context['transportDomain']]
 
-            elif args['authproto'] == 'none':
-                authProtocol = usmNoAuthProtocol
+        except KeyError:
+            notification = _build_notification(oid, args, **context)
 
-            else:
-                log.info('notification: unknown auth proto '
-                        '%s' % args['authproto'])
+            if notification is None:
                 return context['origOid'], tag, context['errorStatus']
 
-            if args['privproto'] == 'des':
-                privProtocol = usmDESPrivProtocol
-
-            elif args['privproto'] == 'aes':
-                privProtocol = usmAesCfb128Protocol
-
-            elif args['privproto'] == 'none':
-                privProtocol = usmNoPrivProtocol
-
-            else:
-                log.info('notification: unknown privacy proto '
-                        '%s' % args['privproto'])
-                return context['origOid'], tag, context['errorStatus']
-
-            authData = UsmUserData(
-                args['user'], args['authkey'], args['privkey'],
-                authProtocol=authProtocol,
-                privProtocol=privProtocol)
-
-        else:
-            log.info('notification: unknown SNMP version %s' % args['version'])
-            return context['origOid'], tag, context['errorStatus']
+            notifications[context['transportDomain']] = notification
 
-        if 'host' not in args:
-            log.info('notification: target hostname not configured for '
-                    'OID %s' % (oid,))
-            return context['origOid'], tag, context['errorStatus']
+        authData, target, notificationType = notification
 
-        if args['proto'] == 'udp':
-            target = UdpTransportTarget((args['host'], int(args['port'])))
-
-        elif args['proto'] == 'udp6':
-            target = Udp6TransportTarget((args['host'], int(args['port'])))
-
-        else:
-            log.info('notification: unknown transport %s' % args['proto'])
-            return context['origOid'], tag, context['errorStatus']
-
-        localAddress = None
-
-        if 'bindaddr' in args:
-            localAddress = args['bindaddr']
-
-        else:
-            transportDomain = context['transportDomain'][:len(target.transportDomain)]
-            if transportDomain == target.transportDomain:
-                localAddress = snmpEngine.transportDispatcher.getTransport(
-                    context['transportDomain']).getLocalAddress()[0]
-
-            else:
-                log.info('notification: incompatible network transport types used by '
-                        'CommandResponder vs NotificationOriginator')
-
-                if 'bindaddr' in args:
-                    localAddress = args['bindaddr']
-
-        if localAddress:
-            log.info('notification: binding to local address %s' % localAddress)
-            target.setLocalAddress((localAddress, 0))
-
-        # this will make target objects different based on their bind address 
-        target.transportDomain = target.transportDomain + context['transportDomain']
-
-        varBinds = []
-
-        if 'uptime' in args:
-            varBinds.append(
-                (ObjectIdentifier('1.3.6.1.2.1.1.3.0'),
-                 TimeTicks(args['uptime'])))
-
-        if args['version'] == '1':
-            if 'agentaddress' in args:
-                varBinds.append(
-                    (ObjectIdentifier('1.3.6.1.6.3.18.1.3.0'),
-                     IpAddress(args['agentaddress'])))
-
-            if 'enterprise' in args:
-                varBinds.append(
-                    (ObjectIdentifier('1.3.6.1.6.3.1.1.4.3.0'),
-                     ObjectIdentifier(args['enterprise'])))
-
-        if 'varbinds' in args:
-            vbs = split(args['varbinds'], ':')
-            while vbs:
-                varBinds.append(
-                    (ObjectIdentifier(vbs[0]), TYPE_MAP[vbs[1]](vbs[2])))
-                vbs = vbs[3:]
-
-        notificationType = NotificationType(
-            ObjectIdentity(args['trapoid'])).addVarBinds(*varBinds)
-
-        sendNotification(
-            snmpEngine, authData, target, ContextData(),
-            args['ntftype'], notificationType,
-            cbFun=_cbFun, cbCtx=(oid, value)
-        )
-
-        log.info('notification: sending Notification to %s with credentials '
-                '%s' % (authData, target))
+        moduleContext['sender'].enqueue(
+            (target.transportDomain, target.transportAddr), str(oid),
+            snmpEngine, authData, target, args['ntftype'],
+            notificationType, (oid, value))
 
     if context['setFlag'] or 'value' not in args:
         return oid, tag, context['origValue']
@@ -289,4 +459,5 @@ def variate(oid, tag, value, **context):
 
 
 def shutdown(**context):
-    pass
+    if 'sender' in moduleContext:
+        moduleContext['sender'].close()
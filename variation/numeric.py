@@ -15,13 +15,22 @@
 #   70 - Counter64
 #
 import math
+import os
 import random
 import time
 
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
+
+from pyasn1.type import univ
 from pysnmp.proto import rfc1902
 
 from snmpsim import error
 from snmpsim import log
+from snmpsim import variation
 from snmpsim.utils import split
 
 BOOTED = time.time()
@@ -35,10 +44,241 @@ INTEGER_TYPES = set(
 )
 
 
+def _identity(x):
+    return x
+
+
+def compile(value, **context):
+    settings = dict([split(x, '=') for x in split(value, ',')])
+
+    for k in settings:
+        if k != 'function':
+            settings[k] = float(settings[k])
+
+    if 'min' not in settings:
+        settings['min'] = 0
+
+    if 'max' not in settings:
+        if context['tag'] == '70':
+            settings['max'] = 0xffffffffffffffff
+
+        else:
+            settings['max'] = 0xffffffff
+
+    if 'rate' not in settings:
+        settings['rate'] = 1
+
+    # function is referred by name to keep settings serializable
+    if 'function' in settings:
+        f = split(settings['function'], '%')
+
+        if not hasattr(math, f[0]):
+            raise error.SnmpsimError('unknown function %s' % f[0])
+
+        settings['function'] = f[0], f[1:]
+
+    else:
+        settings['function'] = None, ()
+
+    return settings
+
+
+class CounterBank(object):
+    """Current values of numeric records of a data file.
+
+    Values of all registered records are computed at once, in a single
+    vectorised step (if NumPy is available), no more often than once
+    per `tick` seconds. Records which value depends on the previously
+    reported one (*cumulative*) or on function arguments other than
+    time can not be registered.
+    """
+    def __init__(self, tick):
+        self._tick = tick
+        self._index = {}
+        self._rows = []
+        self._unbanked = set()
+        self._arrays = None
+        self._values = []
+        self._computed = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def register(self, oid, settings):
+        """Add record to the bank, return `False` if not possible"""
+        name, args = settings['function']
+
+        if ('cumulative' in settings or
+                list(args) not in ([], ['<time>']) or
+                numpy and name and not hasattr(numpy, name)):
+            self._unbanked.add(oid)
+            return False
+
+        self._index[oid] = len(self._rows)
+
+        self._rows.append(
+            (name, 'atime' not in settings and BOOTED or 0,
+             settings['rate'], settings.get('scale', 1),
+             settings.get('offset', 0), settings.get('deviation', 0),
+             settings.get('initial', settings['min']),
+             settings['min'], settings['max'], 'wrap' in settings))
+
+        self._arrays = self._computed = None
+
+        return True
+
+    def index(self, oid, settings):
+        """Return record row in the bank or `None` if not banked"""
+        if oid not in self._index and oid not in self._unbanked:
+            self.register(oid, settings)
+
+        return self._index.get(oid)
+
+    def value(self, row):
+        """Return current value of the record at `row`"""
+        now = time.time()
+
+        if self._computed is None or now - self._computed >= self._tick:
+            self._values = self._compute(now)
+            self._computed = now
+
+        return self._values[row]
+
+    def _compute(self, now):
+        if numpy:
+            return self._compute_vectorised(now)
+
+        values = []
+
+        for (name, booted, rate, scale, offset, deviation,
+             initial, minimum, maximum, wrap) in self._rows:
+            v = (now - booted) * rate
+
+            if name:
+                v = getattr(math, name)(v)
+
+            v = v * scale + offset
+
+            if deviation:
+                v += random.randrange(-deviation, deviation)
+
+            v += initial
+
+            if v < minimum:
+                v = minimum
+
+            elif v > maximum:
+                v = wrap and v % maximum + minimum or maximum
+
+            values.append(v)
+
+        return values
+
+    def _compute_vectorised(self, now):
+        if self._arrays is None:
+            columns = list(zip(*self._rows))
+
+            functions = {}
+
+            for row, name in enumerate(columns[0]):
+                if name:
+                    functions.setdefault(name, []).append(row)
+
+            self._arrays = (
+                [(getattr(numpy, name), numpy.array(rows))
+                 for name, rows in functions.items()],
+            ) + tuple(numpy.array(x, dtype=float) for x in columns[1:])
+
+        (functions, booted, rate, scale, offset, deviation,
+         initial, minimum, maximum, wrap) = self._arrays
+
+        v = (now - booted) * rate
+
+        for f, rows in functions:
+            v[rows] = f(v[rows])
+
+        v = v * scale + offset
+
+        if deviation.any():
+            v += numpy.floor(
+                numpy.random.random(len(v)) * 2 * deviation) - deviation
+
+        v += initial
+
+        v = numpy.maximum(v, minimum)
+
+        above = v > maximum
+        wrapped = above & (wrap != 0)
+
+        v[wrapped] = v[wrapped] % maximum[wrapped] + minimum[wrapped]
+
+        v = numpy.where(above & (wrap == 0), maximum, v)
+
+        return v.tolist()
+
+
+def _load_bank(data_file):
+    """Register all records of data file served by this module"""
+    bank = CounterBank(moduleContext['tick'])
+
+    for ext, record in variation.RECORD_TYPES.items():
+        if data_file.endswith(os.path.extsep + ext):
+            break
+
+    else:
+        return bank
+
+    try:
+        with record.open(data_file) as fl:
+            for line in fl:
+                try:
+                    oid, tag, value = record.grammar.parse(line)
+
+                except error.SnmpsimError:
+                    continue
+
+                if ':' not in tag:
+                    continue
+
+                tag, mod_name = tag.split(':', 1)
+
+                if mod_name != alias:
+                    continue
+
+                try:
+                    settings = compile(value, tag=tag)
+
+                except Exception:
+                    continue
+
+                bank.register(str(univ.ObjectIdentifier(oid)), settings)
+
+    except Exception as exc:
+        log.error('numeric: failed to read %s: %s' % (data_file, exc))
+
+    log.info('numeric: %s records of %s registered with counter '
+             'bank' % (len(bank), data_file))
+
+    return bank
+
+
 def init(**context):
     if context['mode'] == 'variating':
         random.seed()
 
+        options = {}
+
+        if context['options']:
+            options.update(
+                dict([split(x, ':') for x in split(context['options'], ',')]))
+
+        try:
+            moduleContext['bank'] = int(options.get('bank', 0))
+            moduleContext['tick'] = float(options.get('tick', 0.1))
+
+        except ValueError:
+            raise error.SnmpsimError('malformed numeric bank or tick option')
+
     if context['mode'] == 'recording':
         moduleContext['settings'] = {}
 
@@ -82,32 +322,24 @@ def variate(oid, tag, value, **context):
         return context['origOid'], tag, context['errorStatus']
 
     if 'settings' not in recordContext:
-        recordContext['settings'] = dict(
-            [split(x, '=') for x in split(value, ',')])
-
-        for k in recordContext['settings']:
-            if k != 'function':
-                recordContext['settings'][k] = float(recordContext['settings'][k])
+        recordContext['settings'] = compile(value, tag=tag)
 
-        if 'min' not in recordContext['settings']:
-            recordContext['settings']['min'] = 0
+    if moduleContext['bank']:
+        try:
+            bank = agentContext['bank']
 
-        if 'max' not in recordContext['settings']:
-            if tag == '70':
-                recordContext['settings']['max'] = 0xffffffffffffffff
+        except KeyError:
+            bank = agentContext['bank'] = _load_bank(context['dataFile'])
 
-            else:
-                recordContext['settings']['max'] = 0xffffffff
-
-        if 'rate' not in recordContext['settings']:
-            recordContext['settings']['rate'] = 1
+        try:
+            row = recordContext['row']
 
-        if 'function' in recordContext['settings']:
-            f = split(recordContext['settings']['function'], '%')
-            recordContext['settings']['function'] = getattr(math, f[0]), f[1:]
+        except KeyError:
+            row = recordContext['row'] = bank.index(
+                str(oid), recordContext['settings'])
 
-        else:
-            recordContext['settings']['function'] = lambda x: x, ()
+        if row is not None:
+            return oid, tag, bank.value(row)
 
     vold, told = recordContext['settings'].get(
         'initial', recordContext['settings']['min']), BOOTED
@@ -126,7 +358,14 @@ def variate(oid, tag, value, **context):
     else:
         t = tnow - BOOTED
 
-    f, args = recordContext['settings']['function']
+    try:
+        f = recordContext['function']
+
+    except KeyError:
+        name = recordContext['settings']['function'][0]
+        f = recordContext['function'] = name and getattr(math, name) or _identity
+
+    args = recordContext['settings']['function'][1]
 
     _args = []
 
@@ -18,12 +18,22 @@
 # For successful operation each managed OID must be present in both
 # data structures
 #
+# Optionally, Redis ZSET type containing all OIDs (with zero score) is
+# used for answering GETNEXT/GETBULK queries by the server-side script
+# in batching mode.
+#
+# With batch:1 option, all GET var-binds of a PDU are fetched by a
+# single server-side script call (see `variate_many()`), and
+# GETNEXT/GETBULK queries fetch readahead:<rows> subsequent var-binds
+# at once.
+#
 import random
 import time
 
 from pyasn1.compat import octets
 from pysnmp.smi.error import WrongValueError
 
+from snmpsim import deferred
 from snmpsim import error, log
 from snmpsim import utils
 from snmpsim.grammar.snmprec import SnmprecGrammar
@@ -84,11 +94,107 @@ def init(**context):
     elif context['mode'] == 'variating':
         moduleContext['booted'] = time.time()
 
+        if options.get('batch', '0') not in ('0', ''):
+            try:
+                readAhead = int(options.get('readahead', 16))
+
+            except ValueError:
+                raise error.SnmpsimError(
+                    'malformed redis readahead option '
+                    '%s' % options['readahead'])
+
+            moduleContext['readAhead'] = max(1, readAhead)
+            moduleContext['getScript'] = moduleContext[
+                'dbConn'].register_script(GET_SCRIPT)
+            moduleContext['nextScript'] = moduleContext[
+                'dbConn'].register_script(NEXT_SCRIPT)
+            moduleContext['batch'] = {}
+            moduleContext['prefetched'] = None, {}
+
+            log.info('redis: batching var-binds, GETNEXT read-ahead is %s '
+                     'var-binds' % moduleContext['readAhead'])
+
     moduleContext['ready'] = True
 
 
 unpackTag = SnmprecRecord().unpack_tag
 
+evaluateValue = SnmprecRecord().evaluate_value
+
+# Server-side scripts pick the key-space the same way as `variate()`
+# does. Their first argument is the number of seconds since simulator
+# start, or 0 if key-spaces cycling is disabled.
+
+KEYSPACE_SNIPPET = """
+local size = redis.call('llen', KEYS[1])
+local keySpace = false
+
+if size > 0 then
+    keySpace = redis.call('lindex', KEYS[1], tonumber(ARGV[1]) % size)
+end
+
+if not keySpace then
+    return {}
+end
+"""
+
+# Fetch values of all the given OIDs at once
+GET_SCRIPT = KEYSPACE_SNIPPET + """
+local keys = {}
+
+for i = 2, #ARGV do
+    keys[#keys + 1] = keySpace .. '-' .. ARGV[i]
+end
+
+local result = redis.call('mget', unpack(keys))
+
+table.insert(result, 1, keySpace)
+
+return result
+"""
+
+# Fetch up to the given number of OID-value pairs following the given OID
+NEXT_SCRIPT = KEYSPACE_SNIPPET + """
+local oidKey = keySpace .. '-' .. ARGV[2]
+local count = tonumber(ARGV[3])
+local sortedKey = keySpace .. '-oids_sorted'
+local oids
+
+if redis.call('exists', sortedKey) == 1 then
+    oids = redis.call(
+        'zrangebylex', sortedKey, '(' .. oidKey, '+', 'LIMIT', 0, count)
+
+else
+    local listKey = keySpace .. '-oids_ordering'
+    local low, high = 0, redis.call('llen', listKey) - 1
+
+    while low <= high do
+        local idx = math.floor((low + high) / 2)
+
+        if redis.call('lindex', listKey, idx) <= oidKey then
+            low = idx + 1
+        else
+            high = idx - 1
+        end
+    end
+
+    oids = redis.call('lrange', listKey, low, low + count - 1)
+end
+
+local result = {keySpace}
+
+if #oids > 0 then
+    local values = redis.call('mget', unpack(oids))
+
+    for i = 1, #oids do
+        result[#result + 1] = oids[i]
+        result[#result + 1] = values[i]
+    end
+end
+
+return result
+"""
+
 
 
 # It turned out, that `py-redis` package emits bytes when running
@@ -119,6 +225,142 @@ def evalsha(dbConn, *args):
     return ret
 
 
+def _script_args():
+    if recordContext['settings']['period']:
+        return int(time.time() - moduleContext['booted'])
+
+    return 0
+
+
+def _note_keyspace(keySpace):
+    if moduleContext.get('current-keyspace') != keySpace:
+        log.info('redis: now using keyspace %s' % keySpace)
+
+        moduleContext['current-keyspace'] = keySpace
+
+
+def _fetchBatch(batchKey):
+    """Resolve queued GET var-binds by one server-side script call"""
+    pendings = moduleContext['batch'].pop(batchKey, None)
+
+    if pendings:
+        _fetchValues(batchKey, pendings)
+
+
+def _fetchValues(batchKey, pendings):
+    keySpacesId, elapsed = batchKey
+
+    try:
+        result = moduleContext['getScript'](
+            keys=[keySpacesId],
+            args=[elapsed] + [dbOid for dbOid, _, _, _ in pendings])
+
+    except Exception as exc:
+        for _, _, pending, _ in pendings:
+            pending.set_exception(exc)
+
+        return
+
+    if result:
+        _note_keyspace(octets.octs2str(result[0]))
+
+    for idx, (dbOid, origOid, pending, errorStatus) in enumerate(pendings):
+        tagAndValue = idx + 1 < len(result) and result[idx + 1]
+
+        if not tagAndValue:
+            pending.set_result(errorStatus)
+            continue
+
+        textTag, textValue = octets.octs2str(tagAndValue).split('|', 1)
+
+        try:
+            pending.set_result(
+                evaluateValue(origOid, textTag, textValue)[2])
+
+        except Exception as exc:
+            pending.set_exception(exc)
+
+
+def _variateBatched(tag, **context):
+    keySpacesId = recordContext['settings']['key-spaces-id']
+
+    origOid = context['origOid']
+    dbOid = '.'.join(['%10s' % x for x in origOid])
+
+    response = deferred.current_response()
+
+    if context['nextFlag']:
+        # prefetched var-binds are only trusted within the same SNMP PDU
+        owner, prefetched = moduleContext['prefetched']
+
+        if response is None or owner is not response:
+            prefetched = {}
+
+        try:
+            textOid, tagAndValue = prefetched[(keySpacesId, dbOid)]
+
+        except KeyError:
+            result = moduleContext['nextScript'](
+                keys=[keySpacesId],
+                args=[_script_args(), dbOid, moduleContext['readAhead']])
+
+            if len(result) < 3:
+                return origOid, tag, context['errorStatus']
+
+            _note_keyspace(octets.octs2str(result[0]))
+
+            prevOid = dbOid
+
+            for idx in range(1, len(result), 2):
+                textOid = octets.octs2str(result[idx]).split('-', 1)[1]
+                tagAndValue = result[idx + 1]
+
+                prefetched[(keySpacesId, prevOid)] = textOid, tagAndValue
+
+                prevOid = textOid
+
+            textOid, tagAndValue = prefetched[(keySpacesId, dbOid)]
+
+            if response is not None:
+                moduleContext['prefetched'] = response, prefetched
+
+        if not tagAndValue:
+            return origOid, tag, context['errorStatus']
+
+        textOid = '.'.join([x.strip() for x in textOid.split('.')])
+        textTag, textValue = octets.octs2str(tagAndValue).split('|', 1)
+
+        return origOid.clone(textOid), textTag, textValue
+
+    batchKey = keySpacesId, _script_args()
+
+    if response is None:
+        # not within I/O loop, can't hold the response
+        pending = deferred.Pending()
+
+        _fetchValues(
+            batchKey, [(dbOid, origOid, pending, context['errorStatus'])])
+
+        return origOid, tag, pending.result()
+
+    # collect GET var-binds of the PDU to fetch them all at once
+    batch = moduleContext['batch']
+
+    if batchKey not in batch:
+        batch[batchKey] = []
+        deferred.TIMERS.call_later(0, _fetchBatch, batchKey)
+
+    pending = deferred.Pending()
+
+    batch[batchKey].append(
+        (dbOid, origOid, pending, context['errorStatus']))
+
+    if context['varsRemaining'] == 0:  # last OID in PDU
+        _fetchBatch(batchKey)
+
+    return origOid, tag, pending
+
+
 def variate(oid, tag, value, **context):
     if 'dbConn' in moduleContext:
         dbConn = moduleContext['dbConn']
@@ -149,6 +391,10 @@ def variate(oid, tag, value, **context):
 
     redisScript = recordContext['settings'].get('evalsha')
 
+    # custom scripts can't be called from server-side scripts
+    if 'batch' in moduleContext and not redisScript and not context['setFlag']:
+        return _variateBatched(tag, **context)
+
     keySpacesId = recordContext['settings']['key-spaces-id']
 
     if recordContext['settings']['period'] and dbConn.llen(keySpacesId):
@@ -199,7 +445,12 @@ def variate(oid, tag, value, **context):
         else:
             dbConn.linsert(
                 keySpace + '-oids_ordering', 'after',
-                getNextOid(dbConn, keySpace, dbOid), dbOid)
+                getNextOid(dbConn, keySpace, dbOid), keySpace + '-' + dbOid)
+
+            if dbConn.exists(keySpace + '-oids_sorted'):
+                dbConn.execute_command(
+                    'ZADD', keySpace + '-oids_sorted', 0,
+                    keySpace + '-' + dbOid)
 
         if redisScript:
             evalsha(dbConn, redisScript, 1, keySpace + '-' + dbOid,
@@ -232,7 +483,63 @@ def variate(oid, tag, value, **context):
             [x.strip() for x in textOid.split('-', 1)[1].split('.')])
         textTag, textValue = tagAndValue.split('|', 1)
 
-        return textOid, textTag, textValue
+        return origOid.clone(textOid), textTag, textValue
+
+
+def variate_many(records, **context):
+    """Fetch GET var-binds of a PDU by one server-side script call"""
+    global recordContext
+
+    results = []
+    fetches = {}
+    fetched = []
+
+    for oid, tag, value, recordCtx in records:
+        recordContext = recordCtx['recordContext']
+
+        if ('batch' not in moduleContext or 'ready' not in recordContext or
+                recordContext['settings'].get('evalsha') or
+                recordCtx['nextFlag'] or recordCtx['setFlag']):
+            try:
+                results.append(variate(oid, tag, value, **recordCtx))
+
+            except Exception as exc:
+                results.append(exc)
+
+            continue
+
+        origOid = recordCtx['origOid']
+        dbOid = '.'.join(['%10s' % x for x in origOid])
+
+        batchKey = recordContext['settings']['key-spaces-id'], _script_args()
+
+        pending = deferred.Pending()
+
+        if batchKey not in fetches:
+            fetches[batchKey] = []
+
+        fetches[batchKey].append(
+            (dbOid, origOid, pending, recordCtx['errorStatus']))
+
+        fetched.append(len(results))
+
+        results.append((origOid, tag, pending))
+
+    recordContext = None
+
+    for batchKey, pendings in fetches.items():
+        _fetchValues(batchKey, pendings)
+
+    for idx in fetched:
+        origOid, tag, pending = results[idx]
+
+        try:
+            results[idx] = origOid, tag, pending.result()
+
+        except Exception as exc:
+            results[idx] = exc
+
+    return results
 
 
 def getNextOid(dbConn, keySpace, dbOid, index=False):
@@ -318,6 +625,8 @@ def record(oid, tag, value, **context):
         textValue = str(context['origValue'])
 
     dbConn.lpush(keySpace + '-temp_oids_ordering', keySpace + '-' + dbOid)
+    dbConn.execute_command(
+        'ZADD', keySpace + '-oids_sorted', 0, keySpace + '-' + dbOid)
 
     if redisScript:
         evalsha(dbConn, 
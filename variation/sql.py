@@ -12,11 +12,38 @@
 # Expects to work a table of the following layout:
 # CREATE TABLE <tablename> (oid text, tag text, value text, maxaccess text)
 #
+# With pool:<connections> option, module runs in pooled mode: queries
+# are parameterized and built once per table, GET var-binds of a PDU
+# are fetched by a single query and GETNEXT prefetches readahead:<rows>
+# rows at once.
+#
+# With cache:<ttl> option, table rows are cached in memory for <ttl>
+# seconds. Sending SIGUSR1 to the process flushes the cache.
+#
+import bisect
+import time
+
+try:
+    import queue
+
+except ImportError:
+    import Queue as queue
+
+try:
+    import signal
+
+except ImportError:
+    signal = None
+
+from snmpsim import deferred
 from snmpsim import error
 from snmpsim import log
 from snmpsim.grammar.snmprec import SnmprecGrammar
+from snmpsim.record.snmprec import SnmprecRecord
 from snmpsim.utils import split
 
+RECORD = SnmprecRecord()
+
 ISOLATION_LEVELS = {
     '0': 'READ UNCOMMITTED',
     '1': 'READ COMMITTED',
@@ -25,6 +52,83 @@ ISOLATION_LEVELS = {
 }
 
 
+class TableCache(object):
+    """Rows of SQL table read from the database not long ago.
+
+    Row values are keyed by padded OID. The sorted list of all table
+    OIDs, used for answering GETNEXT queries, is loaded by a single
+    query along with all row values.
+    """
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._values = {}
+        self._oids = None
+        self._expires = 0
+
+    def get(self, sql_oid, now):
+        """Return cached (tag, value) or `None` if not known.
+
+        OIDs which are not in the table are cached as (`None`, `None`).
+        """
+        try:
+            expires, tag, value = self._values[sql_oid]
+
+        except KeyError:
+            if self._expires > now:  # whole table is loaded
+                return None, None
+
+            return
+
+        if expires > now:
+            return tag, value
+
+    def put(self, sql_oid, tag, value, now):
+        self._values[sql_oid] = now + self._ttl, tag, value
+
+    def get_next(self, sql_oid, now):
+        """Return OID next to `sql_oid` or `None` if table is not loaded"""
+        if self._expires <= now:
+            return
+
+        oids = self._oids
+
+        idx = bisect.bisect_right(oids, sql_oid)
+
+        if idx < len(oids):
+            return oids[idx]
+
+        return ''
+
+    def load(self, resultset, now):
+        """Replace cached rows with the whole table"""
+        expires = now + self._ttl
+
+        self._values = dict(
+            (str(row[0]), (expires, str(row[1]), str(row[2])))
+            for row in resultset)
+
+        self._oids = sorted(self._values)
+        self._expires = expires
+
+    def update(self, sql_oid, tag, value, now):
+        """Take a write to the table into account"""
+        if self._oids is not None and sql_oid not in self._values:
+            bisect.insort(self._oids, sql_oid)
+
+        self.put(sql_oid, tag, value, now)
+
+
+def _flush_cache(signum, frame):
+    """Drop cached table rows of every module alias, chain the signal"""
+    for context in _flush_cache.moduleContexts:
+        context['cache'] = {}
+
+    log.info('SQL cache flushed')
+
+    if callable(_flush_cache.previous):
+        _flush_cache.previous(signum, frame)
+
+
 def init(**context):
     options = {}
 
@@ -61,7 +165,6 @@ def init(**context):
     if not connectParams:
         raise error.SnmpsimError('database connect parameters not specified')
 
-    moduleContext['dbConn'] = dbConn = db.connect(**connectParams)
     moduleContext['dbTable'] = dbTable = options.get('dbtable', 'snmprec')
     moduleContext['isolationLevel'] = options.get('isolationlevel', '1')
 
@@ -70,6 +173,70 @@ def init(**context):
             'unknown SQL transaction isolation level '
             '%s' % moduleContext['isolationLevel'])
 
+    moduleContext['paramStyle'] = getattr(db, 'paramstyle', 'qmark')
+    moduleContext['queries'] = {}
+
+    if 'cache' in options and context.get('mode') != 'recording':
+        try:
+            moduleContext['cacheTtl'] = float(options['cache'])
+
+        except ValueError:
+            raise error.SnmpsimError(
+                'malformed SQL cache TTL %s' % options['cache'])
+
+        moduleContext['cache'] = {}
+
+        if signal and hasattr(signal, 'SIGUSR1'):
+            handler = signal.getsignal(signal.SIGUSR1)
+
+            # every alias is a module of its own, one handler serves all
+            if hasattr(handler, 'moduleContexts'):
+                handler.moduleContexts.append(moduleContext)
+
+            else:
+                _flush_cache.moduleContexts = [moduleContext]
+                _flush_cache.previous = handler
+
+                signal.signal(signal.SIGUSR1, _flush_cache)
+
+    if 'pool' in options and context.get('mode') != 'recording':
+        try:
+            poolSize = int(options['pool'])
+            readAhead = int(options.get('readahead', 16))
+
+        except ValueError:
+            raise error.SnmpsimError(
+                'malformed SQL pool size or readahead option')
+
+        if poolSize < 1 or readAhead < 1:
+            raise error.SnmpsimError(
+                'SQL pool size and readahead must be positive')
+
+        if options['dbtype'] == 'sqlite3':
+            # pooled connections are shared by executor threads
+            connectParams['check_same_thread'] = False
+
+        # each call takes a connection of its own
+        moduleContext['threadSafe'] = True
+
+        moduleContext['readAhead'] = readAhead
+        moduleContext['batch'] = {}
+        moduleContext['prefetched'] = None, {}
+
+        moduleContext['dbPool'] = dbPool = queue.Queue()
+
+        for _ in range(poolSize):
+            dbConn = db.connect(**connectParams)
+            _set_isolation_level(dbConn)
+            dbPool.put(dbConn)
+
+        log.info('SQL connection pool of %s connections '
+                 'created' % poolSize)
+
+        return
+
+    moduleContext['dbConn'] = dbConn = db.connect(**connectParams)
+
     if 'mode' in context and context['mode'] == 'recording':
         cursor = dbConn.cursor()
 
@@ -100,13 +267,7 @@ def init(**context):
         cursor.close()
 
 
-def variate(oid, tag, value, **context):
-    if 'dbConn' in moduleContext:
-        db_conn = moduleContext['dbConn']
-
-    else:
-        raise error.SnmpsimError('variation module not initialized')
-
+def _set_isolation_level(db_conn):
     cursor = db_conn.cursor()
 
     try:
@@ -116,8 +277,320 @@ def variate(oid, tag, value, **context):
         cursor.fetchall()
 
     except Exception:  # non-MySQL/Postgres
+        db_conn.rollback()
+
+    cursor.close()
+
+
+def _get_query(db_table, name, count=1):
+    """Build parameterized SQL query once, reuse afterwards"""
+    key = db_table, name, count
+
+    try:
+        return moduleContext['queries'][key]
+
+    except KeyError:
         pass
 
+    param_style = moduleContext['paramStyle']
+
+    if param_style == 'qmark':
+        params = ['?'] * count
+
+    elif param_style == 'numeric':
+        params = [':%d' % (x + 1) for x in range(count)]
+
+    elif param_style == 'named':
+        params = [':p%d' % x for x in range(count)]
+
+    else:  # format, pyformat
+        params = ['%s'] * count
+
+    if name == 'get':
+        query = ('select oid, tag, value from %s where oid in '
+                 '(%s)' % (db_table, ', '.join(params)))
+
+    elif name == 'scan':
+        query = 'select oid, tag, value from %s' % db_table
+
+    elif name in ('next', 'nextone'):
+        limit = name == 'next' and moduleContext['readAhead'] or 1
+        query = ('select oid, tag, value from %s where oid>%s order by oid '
+                 'limit %d' % (db_table, params[0], limit))
+
+    elif name == 'maxaccess':
+        query = ('select maxaccess from %s where oid=%s '
+                 'limit 1' % (db_table, params[0]))
+
+    elif name == 'update':
+        query = ('update %s set tag=%s,value=%s where '
+                 'oid=%s' % ((db_table,) + tuple(params)))
+
+    else:
+        query = ('insert into %s values (%s, %s, %s, '
+                 '\'read-write\')' % ((db_table,) + tuple(params)))
+
+    if param_style == 'named':
+        names = ['p%d' % x for x in range(count)]
+
+        def bind(*args):
+            return dict(zip(names, args))
+
+    else:
+        def bind(*args):
+            return args
+
+    moduleContext['queries'][key] = query, bind
+
+    return query, bind
+
+
+def _execute(db_conn, db_table, name, *args):
+    query, bind = _get_query(db_table, name, len(args))
+
+    cursor = db_conn.cursor()
+
+    try:
+        cursor.execute(query, bind(*args))
+
+        if name in ('update', 'insert'):
+            return
+
+        return cursor.fetchall()
+
+    finally:
+        cursor.close()
+
+
+def _run(name, db_table, *args):
+    db_pool = moduleContext.get('dbPool')
+
+    if db_pool is None:  # single connection, not in pooled mode
+        return _execute(moduleContext['dbConn'], db_table, name, *args)
+
+    db_conn = db_pool.get()
+
+    try:
+        resultset = _execute(db_conn, db_table, name, *args)
+
+        if name in ('update', 'insert'):
+            db_conn.commit()
+
+        return resultset
+
+    except Exception:
+        db_conn.rollback()
+        raise
+
+    finally:
+        db_pool.put(db_conn)
+
+
+def _to_oid(sql_oid):
+    return '.'.join([x.strip() for x in str(sql_oid).split('.')])
+
+
+def _fetch_batch(db_table):
+    """Resolve queued GET var-binds by one query"""
+    pendings = moduleContext['batch'].pop(db_table, None)
+
+    if not pendings:
+        return
+
+    try:
+        resultset = _run('get', db_table, *pendings)
+
+    except Exception as exc:
+        for pending, _, _ in pendings.values():
+            pending.set_exception(exc)
+
+        return
+
+    for row in resultset:
+        try:
+            pending, orig_oid, _ = pendings.pop(row[0])
+
+        except KeyError:
+            continue
+
+        try:
+            _, _, value = RECORD.evaluate_value(
+                orig_oid, str(row[1]), str(row[2]))
+
+        except Exception as exc:
+            pending.set_exception(exc)
+
+        else:
+            pending.set_result(value)
+
+    for pending, _, error_status in pendings.values():
+        pending.set_result(error_status)
+
+
+def _get_table_cache(db_table):
+    cache = moduleContext['cache']
+
+    try:
+        return cache[db_table]
+
+    except KeyError:
+        table_cache = cache[db_table] = TableCache(moduleContext['cacheTtl'])
+        return table_cache
+
+
+def _update_cache(db_table, sql_oid, text_tag, text_value):
+    if 'cache' in moduleContext:
+        _get_table_cache(db_table).update(
+            sql_oid, text_tag, text_value, time.time())
+
+
+def _variate_cached(orig_oid, tag, db_table, **context):
+    sql_oid = '.'.join(['%10s' % x for x in orig_oid])
+
+    table_cache = _get_table_cache(db_table)
+
+    now = time.time()
+
+    if context['nextFlag']:
+        next_oid = table_cache.get_next(sql_oid, now)
+
+        if next_oid is None:
+            table_cache.load(_run('scan', db_table), now)
+
+            next_oid = table_cache.get_next(sql_oid, now)
+
+        if not next_oid:
+            return orig_oid, tag, context['errorStatus']
+
+        orig_oid = orig_oid.clone(_to_oid(next_oid))
+        sql_oid = next_oid
+
+    row = table_cache.get(sql_oid, now)
+
+    if row is None:
+        resultset = _run('get', db_table, sql_oid)
+
+        if resultset:
+            row = str(resultset[0][1]), str(resultset[0][2])
+
+        else:
+            row = None, None
+
+        table_cache.put(sql_oid, row[0], row[1], now)
+
+    if row[0] is None:
+        return orig_oid, tag, context['errorStatus']
+
+    return orig_oid, row[0], row[1]
+
+
+def _variate_pooled(orig_oid, tag, db_table, **context):
+    sql_oid = '.'.join(['%10s' % x for x in orig_oid])
+
+    if context['setFlag']:
+        if 'hexvalue' in context:
+            text_tag = context['hextag']
+            text_value = context['hexvalue']
+
+        else:
+            text_tag = SnmprecGrammar().get_tag_by_type(context['origValue'])
+            text_value = str(context['origValue'])
+
+        resultset = _run('maxaccess', db_table, sql_oid)
+
+        if resultset:
+            if resultset[0][0] != 'read-write':
+                return orig_oid, tag, context['errorStatus']
+
+            _run('update', db_table, text_tag, text_value, sql_oid)
+
+        else:
+            _run('insert', db_table, sql_oid, text_tag, text_value)
+
+        _update_cache(db_table, sql_oid, text_tag, text_value)
+
+        return orig_oid, text_tag, context['origValue']
+
+    response = deferred.current_response()
+
+    if context['nextFlag'] and response is None:
+        # no SNMP PDU to share prefetched rows with
+        resultset = _run('nextone', db_table, sql_oid)
+
+        if not resultset:
+            return orig_oid, tag, context['errorStatus']
+
+        row = resultset[0]
+
+        return (orig_oid.clone(_to_oid(row[0])),
+                str(row[1]), str(row[2]))
+
+    if context['nextFlag']:
+        # prefetched rows are only trusted within the same SNMP PDU
+        owner, prefetched = moduleContext['prefetched']
+
+        if owner is not response:
+            prefetched = {}
+
+        row = prefetched.get((db_table, sql_oid))
+
+        if row is None:
+            resultset = _run('next', db_table, sql_oid)
+
+            if not resultset:
+                return orig_oid, tag, context['errorStatus']
+
+            prev_oid = sql_oid
+
+            for row in resultset:
+                prefetched[(db_table, prev_oid)] = row
+                prev_oid = row[0]
+
+            row = resultset[0]
+
+            moduleContext['prefetched'] = response, prefetched
+
+        return (orig_oid.clone(_to_oid(row[0])),
+                str(row[1]), str(row[2]))
+
+    if response is None:
+        # not within I/O loop (e.g. run by executor), can't hold the response
+        resultset = _run('get', db_table, sql_oid)
+
+        if resultset:
+            return orig_oid, str(resultset[0][1]), str(resultset[0][2])
+
+        return orig_oid, tag, context['errorStatus']
+
+    # collect GET var-binds of the PDU to fetch them all at once
+    batch = moduleContext['batch']
+
+    if db_table not in batch:
+        batch[db_table] = {}
+        deferred.TIMERS.call_later(0, _fetch_batch, db_table)
+
+    pendings = batch[db_table]
+
+    if sql_oid in pendings:
+        pending = pendings[sql_oid][0]
+
+    else:
+        pending = deferred.Pending()
+        pendings[sql_oid] = pending, orig_oid, context['errorStatus']
+
+    if context['varsRemaining'] == 0:  # last OID in PDU
+        _fetch_batch(db_table)
+
+    return orig_oid, tag, pending
+
+
+def variate(oid, tag, value, **context):
+    if 'dbConn' in moduleContext:
+        db_conn = moduleContext['dbConn']
+
+    elif 'dbPool' not in moduleContext:
+        raise error.SnmpsimError('variation module not initialized')
+
     if value:
         db_table = value.split(',').pop(0)
 
@@ -129,6 +602,23 @@ def variate(oid, tag, value, **context):
                 '%s' % (context['origOid'],))
         return context['origOid'], tag, context['errorStatus']
 
+    if 'cache' in moduleContext and not context['setFlag']:
+        return _variate_cached(context['origOid'], tag, db_table, **context)
+
+    if 'dbPool' in moduleContext:
+        return _variate_pooled(context['origOid'], tag, db_table, **context)
+
+    cursor = db_conn.cursor()
+
+    try:
+        cursor.execute(
+            'set session transaction isolation level '
+            '%s' % ISOLATION_LEVELS[moduleContext['isolationLevel']])
+        cursor.fetchall()
+
+    except Exception:  # non-MySQL/Postgres
+        pass
+
     orig_oid = context['origOid']
     sql_oid = '.'.join(['%10s' % x for x in str(orig_oid).split('.')])
 
@@ -162,6 +652,8 @@ def variate(oid, tag, value, **context):
                 'insert into %s values (\'%s\', \'%s\', \'%s\', '
                 '\'read-write\')' % (db_table, sql_oid, text_tag, text_value))
 
+        _update_cache(db_table, sql_oid, text_tag, text_value)
+
         if context['varsRemaining'] == 0:  # last OID in PDU
             db_conn.commit()
 
@@ -249,6 +741,11 @@ def record(oid, tag, value, **context):
 
 
 def shutdown(**context):
+    db_pool = moduleContext.get('dbPool')
+    if db_pool:
+        while not db_pool.empty():
+            db_pool.get().close()
+
     db_conn = moduleContext.get('dbConn')
     if db_conn:
         if 'mode' in context and context['mode'] == 'recording':
@@ -7,14 +7,27 @@
 # Managed value variation module
 # Get/set managed value by invoking an external program
 #
+# With coprocess:1 option, external program is started once and kept
+# running. It receives newline-delimited JSON requests on stdin and
+# writes JSON responses, one per line, to its stdout.
+#
+import itertools
+import json
 import subprocess
 import sys
+import threading
+import time
 
 from pysnmp.proto import rfc1902
 
+from snmpsim import deferred
+from snmpsim import error
 from snmpsim import log
+from snmpsim.record.snmprec import SnmprecRecord
 from snmpsim.utils import split
 
+RECORD = SnmprecRecord()
+
 
 def init(**context):
     moduleContext['settings'] = {}
@@ -30,6 +43,226 @@ def init(**context):
         moduleContext['settings']['shell'] = int(
             moduleContext['settings']['shell'])
 
+    settings = moduleContext['settings']
+
+    try:
+        settings['coprocess'] = int(settings.get('coprocess', 0))
+        settings['ttl'] = float(settings.get('ttl', 0))
+        settings['timeout'] = float(settings.get('timeout', 10))
+
+    except ValueError:
+        raise error.SnmpsimError(
+            'malformed subprocess coprocess, ttl or timeout option')
+
+    moduleContext['coprocesses'] = {}
+    moduleContext['cache'] = {}
+    moduleContext['inflight'] = {}
+    moduleContext['lock'] = threading.Lock()
+
+    # calls may be run by executor threads
+    moduleContext['threadSafe'] = True
+
+
+class CoProcess(object):
+    """External program serving many requests over its stdin/stdout.
+
+    Requests are written out as soon as they come, responses are
+    matched to requests by `id`, in whatever order they arrive.
+    Responses are read by a background thread and handed over to
+    per-request callbacks. Terminated program is restarted on the
+    next request.
+    """
+    def __init__(self, args, shell):
+        self._args = args
+        self._shell = shell
+        self._process = None
+        self._callbacks = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _start(self):
+        log.info('subprocess: starting co-process "%s"' % ' '.join(self._args))
+
+        self._process = process = subprocess.Popen(
+            self._args, shell=self._shell,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        reader = threading.Thread(target=self._read, args=(process,))
+        reader.daemon = True
+        reader.start()
+
+    def _read(self, process):
+        for line in iter(process.stdout.readline, b''):
+            try:
+                response = json.loads(line.decode('utf-8'))
+                request_id = response['id']
+
+            except (ValueError, TypeError, KeyError):
+                log.error('subprocess: malformed co-process response '
+                          '%r' % line)
+                continue
+
+            with self._lock:
+                cb_fun = self._callbacks.pop(request_id, None)
+
+            if cb_fun:
+                cb_fun(response)
+
+        log.error('subprocess: co-process "%s" terminated' % ' '.join(
+            self._args))
+
+        with self._lock:
+            if self._process is process:
+                self._process = None
+
+            callbacks, self._callbacks = self._callbacks, {}
+
+        for cb_fun in callbacks.values():
+            cb_fun({'error': 'co-process terminated'})
+
+    def request(self, fields, cb_fun):
+        """Send request, `cb_fun(response)` is called from reader thread"""
+        with self._lock:
+            if self._process is None:
+                self._start()
+
+            request_id = next(self._ids)
+
+            self._callbacks[request_id] = cb_fun
+
+            fields['id'] = request_id
+
+            try:
+                self._process.stdin.write(
+                    json.dumps(fields).encode('utf-8') + b'\n')
+                self._process.stdin.flush()
+
+            except (IOError, OSError):
+                self._callbacks.pop(request_id, None)
+                raise
+
+        return request_id
+
+    def cancel(self, request_id):
+        with self._lock:
+            self._callbacks.pop(request_id, None)
+
+    def close(self):
+        with self._lock:
+            process, self._process = self._process, None
+
+        if process:
+            process.stdin.close()
+
+            try:
+                process.wait(timeout=moduleContext['settings']['timeout'])
+
+            except TypeError:  # Py2
+                process.wait()
+
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def _evaluate_response(oid, tag, response):
+    if 'error' in response:
+        raise error.SnmpsimError(
+            'co-process failed to serve %s: %s' % (oid, response['error']))
+
+    _, _, value = RECORD.evaluate_value(
+        oid, response.get('tag', tag), response.get('value', ''))
+
+    return value
+
+
+def _call_coprocess(oid, tag, command, fields, **context):
+    settings = moduleContext['settings']
+
+    with moduleContext['lock']:
+        try:
+            coprocess = moduleContext['coprocesses'][command]
+
+        except KeyError:
+            coprocess = moduleContext['coprocesses'][command] = CoProcess(
+                split(command, ' '), settings['shell'])
+
+    key = command, fields['oid']
+
+    cacheable = settings['ttl'] and not context['setFlag']
+
+    if cacheable:
+        expires, value = moduleContext['cache'].get(key, (0, None))
+
+        if expires > time.time():
+            return value
+
+    response = deferred.current_response()
+
+    if response is None:
+        # not within I/O loop, wait for the response right here
+        done = threading.Event()
+        result = []
+
+        def cb_fun(response):
+            result.append(response)
+            done.set()
+
+        request_id = coprocess.request(fields, cb_fun)
+
+        if not done.wait(settings['timeout']):
+            coprocess.cancel(request_id)
+            raise error.SnmpsimError(
+                'co-process timed out serving %s' % fields['origOid'])
+
+        value = _evaluate_response(oid, tag, result[0])
+
+        if cacheable:
+            moduleContext['cache'][key] = time.time() + settings['ttl'], value
+
+        return value
+
+    inflight = moduleContext['inflight']
+
+    # same OID might be queried many times in a row
+    if cacheable and key in inflight:
+        return inflight[key]
+
+    pending = deferred.Pending()
+
+    def resolve(response):
+        inflight.pop(key, None)
+
+        try:
+            value = _evaluate_response(oid, tag, response)
+
+        except Exception as exc:
+            pending.set_exception(exc)
+            return
+
+        if cacheable:
+            moduleContext['cache'][key] = time.time() + settings['ttl'], value
+
+        pending.set_result(value)
+
+    def cb_fun(response):
+        deferred.TIMERS.call_soon_threadsafe(resolve, response)
+
+    request_id = coprocess.request(fields, cb_fun)
+
+    def expire():
+        if not pending.done():
+            coprocess.cancel(request_id)
+            resolve({'error': 'timed out'})
+
+    timer = deferred.TIMERS.call_later(settings['timeout'], expire)
+
+    pending.add_done_callback(lambda x: timer.cancel())
+
+    if cacheable:
+        inflight[key] = pending
+
+    return pending
+
 
 def variate(oid, tag, value, **context):
     # in --v2c-arch some of the items are not defined
@@ -56,6 +289,33 @@ def variate(oid, tag, value, **context):
     if 'contextName' in context:
         context_name = str(context['contextName'])
 
+    if moduleContext['settings']['coprocess']:
+        fields = {
+            'transportDomain': transport_domain,
+            'transportAddress': transport_address,
+            'securityModel': security_model,
+            'securityName': security_name,
+            'securityLevel': security_level,
+            'contextName': context_name,
+            'dataFile': context['dataFile'],
+            'oid': str(oid),
+            'tag': tag,
+            'origOid': str(context['origOid']),
+            'origTag': sum([x for x in context['origValue'].tagSet[0]]),
+            'origValue': str(context['origValue']),
+            'setFlag': bool(context['setFlag']),
+            'nextFlag': bool(context['nextFlag']),
+            'subtreeFlag': bool(context['subtreeFlag'])
+        }
+
+        try:
+            return oid, tag, _call_coprocess(
+                oid, tag, value, fields, **context)
+
+        except (IOError, OSError, error.SnmpsimError) as exc:
+            log.info('subprocess: co-process call failed: %s' % exc)
+            return context['origOid'], tag, context['errorStatus']
+
     args = [
         (x
         .replace('@TRANSPORTDOMAIN@', transport_domain)
@@ -99,4 +359,5 @@ def variate(oid, tag, value, **context):
 
 
 def shutdown(**context):
-    pass
+    for coprocess in moduleContext.get('coprocesses', {}).values():
+        coprocess.close()
@@ -8,15 +8,22 @@
 #
 # Managed value variation module: simulate a writable Agent
 #
+import os
 import shelve
+import shutil
+import threading
 
 from pysnmp.smi import error
 
+from snmpsim import deferred
 from snmpsim import log
+from snmpsim.error import SnmpsimError
 from snmpsim.grammar.snmprec import SnmprecGrammar
 from snmpsim.record.snmprec import SnmprecRecord
 from snmpsim.utils import split
 
+RECORD = SnmprecRecord()
+
 ERROR_TYPES = {
     'generror': error.GenError,
     'noaccess': error.NoAccessError,
@@ -36,6 +43,197 @@ ERROR_TYPES = {
 }
 
 
+class JournaledCache(object):
+    """Values cache persisted by way of append-only journal.
+
+    Values are kept in memory and appended to the journal file in
+    *.snmprec* format. The journal is flushed to disk every
+    `sync_period` seconds.
+
+    Every `compact_period` seconds the journal is rotated and values
+    changed since the previous compaction are written into the shelf
+    by a background thread. Once the shelf is safely updated, rotated
+    journal is removed.
+
+    On start up, values are restored from the shelf and the journals
+    left behind.
+    """
+    def __init__(self, path, sync_period, compact_period):
+        self._path = path
+        self._journal_path = path + '.journal'
+        self._rotated_path = path + '.journal.old'
+        self._sync_period = sync_period
+        self._compact_period = compact_period
+        self._values = {}
+        self._dirty = {}
+        self._unsynced = False
+        self._closed = False
+        self._compactor = None
+        self._lock = threading.Lock()
+
+        self._restore()
+
+        self._journal = open(self._journal_path, 'ab')
+
+        deferred.TIMERS.call_later(self._sync_period, self._sync_periodically)
+        deferred.TIMERS.call_later(
+            self._compact_period, self._compact_periodically)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        line = RECORD.format(key, value)
+
+        with self._lock:
+            self._journal.write(line)
+            self._values[key] = self._dirty[key] = value
+            self._unsynced = True
+
+    def _restore(self):
+        shelf = shelve.open(self._path)
+
+        try:
+            self._values.update(shelf)
+
+        finally:
+            shelf.close()
+
+        for path in self._rotated_path, self._journal_path:
+            if not os.path.exists(path):
+                continue
+
+            with open(path, 'rb') as journal:
+                for line in journal:
+                    try:
+                        oid, value = RECORD.evaluate(line)
+
+                    except SnmpsimError as exc:
+                        # possibly torn write on crash
+                        log.error('writecache: skipping broken journal '
+                                  'record at %s: %s' % (path, exc))
+                        continue
+
+                    self._values[str(oid)] = self._dirty[str(oid)] = value
+
+        log.info('writecache: restored %s values from '
+                 '%s' % (len(self._values), self._path))
+
+    def sync(self):
+        """Flush journal to disk"""
+        with self._lock:
+            if self._unsynced:
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                self._unsynced = False
+
+    def _sync_periodically(self):
+        if self._closed:
+            return
+
+        try:
+            self.sync()
+
+        except (IOError, OSError) as exc:
+            log.error('writecache: journal %s sync failed: '
+                      '%s' % (self._journal_path, exc))
+
+        deferred.TIMERS.call_later(self._sync_period, self._sync_periodically)
+
+    def _rotate(self):
+        """Start new journal, return changes logged in the old one"""
+        with self._lock:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal.close()
+            self._unsynced = False
+
+            if os.path.exists(self._rotated_path):
+                # previous compaction failed, its journal is still needed
+                with open(self._rotated_path, 'ab') as rotated:
+                    with open(self._journal_path, 'rb') as journal:
+                        shutil.copyfileobj(journal, rotated)
+
+                    rotated.flush()
+                    os.fsync(rotated.fileno())
+
+                os.remove(self._journal_path)
+
+            else:
+                os.rename(self._journal_path, self._rotated_path)
+
+            self._journal = open(self._journal_path, 'ab')
+
+            changes, self._dirty = self._dirty, {}
+
+        return changes
+
+    def _compact(self, changes):
+        try:
+            shelf = shelve.open(self._path)
+
+            try:
+                shelf.update(changes)
+
+            finally:
+                shelf.close()
+
+            os.remove(self._rotated_path)
+
+        except Exception as exc:
+            log.error('writecache: compacting journal into %s failed: '
+                      '%s' % (self._path, exc))
+
+            # retry on next compaction, newer changes take precedence
+            with self._lock:
+                for key, value in changes.items():
+                    self._dirty.setdefault(key, value)
+
+            return
+
+        log.info('writecache: compacted %s values into '
+                 '%s' % (len(changes), self._path))
+
+    def _compact_periodically(self):
+        if self._closed:
+            return
+
+        if self._dirty and not (
+                self._compactor and self._compactor.is_alive()):
+            try:
+                changes = self._rotate()
+
+            except (IOError, OSError) as exc:
+                log.error('writecache: journal %s rotation failed: '
+                          '%s' % (self._journal_path, exc))
+
+            else:
+                self._compactor = threading.Thread(
+                    target=self._compact, args=(changes,))
+                self._compactor.daemon = True
+                self._compactor.start()
+
+        deferred.TIMERS.call_later(
+            self._compact_period, self._compact_periodically)
+
+    def close(self):
+        self._closed = True
+
+        if self._compactor:
+            self._compactor.join()
+
+        if self._dirty:
+            self._compact(self._rotate())
+
+        self._journal.close()
+
+        if not os.path.exists(self._rotated_path):
+            os.remove(self._journal_path)
+
+
 def init(**context):
     moduleContext['settings'] = {}
 
@@ -44,55 +242,77 @@ def init(**context):
             dict([split(x, ':')
                   for x in split(context['options'], ',')]))
 
-    if 'file' in moduleContext['settings']:
-        moduleContext['cache'] = shelve.open(moduleContext['settings']['file'])
+    settings = moduleContext['settings']
+
+    if int(settings.get('journal', 0)):
+        if 'file' not in settings:
+            raise SnmpsimError('writecache journal requires file option')
+
+        try:
+            sync_period = float(settings.get('sync', 1))
+            compact_period = float(settings.get('compact', 60))
+
+        except ValueError:
+            raise SnmpsimError(
+                'malformed writecache sync or compact option')
+
+        moduleContext['cache'] = JournaledCache(
+            settings['file'], sync_period, compact_period)
+
+    elif 'file' in settings:
+        moduleContext['cache'] = shelve.open(settings['file'])
 
     else:
         moduleContext['cache'] = {}
 
 
-def variate(oid, tag, value, **context):
-    if not context['nextFlag'] and not context['exactMatch']:
-        return context['origOid'], tag, context['errorStatus']
+def compile(value, **context):
+    settings = dict([split(x, '=') for x in split(value, ',')])
 
-    if 'settings' not in recordContext:
-        recordContext['settings'] = dict([split(x, '=') for x in split(value, ',')])
+    if 'vlist' in settings:
 
-        if 'vlist' in recordContext['settings']:
+        vlist = {}
 
-            vlist = {}
+        settings['vlist'] = split(settings['vlist'], ':')
 
-            recordContext['settings']['vlist'] = split(
-                recordContext['settings']['vlist'], ':')
+        while settings['vlist']:
+            o, v, e = settings['vlist'][:3]
 
-            while recordContext['settings']['vlist']:
-                o, v, e = recordContext['settings']['vlist'][:3]
+            vl = settings['vlist'][3:]
+            settings['vlist'] = vl
 
-                vl = recordContext['settings']['vlist'][3:]
-                recordContext['settings']['vlist'] = vl
+            type_tag, _ = SnmprecRecord.unpack_tag(context['tag'])
 
-                type_tag, _ = SnmprecRecord.unpack_tag(tag)
+            v = SnmprecGrammar.TAG_MAP[type_tag](v)
 
-                v = SnmprecGrammar.TAG_MAP[type_tag](v)
+            if o not in vlist:
+                vlist[o] = {}
 
-                if o not in vlist:
-                    vlist[o] = {}
+            if o == 'eq':
+                vlist[o][v] = e
 
-                if o == 'eq':
-                    vlist[o][v] = e
+            elif o in ('lt', 'gt'):
+                vlist[o] = v, e
 
-                elif o in ('lt', 'gt'):
-                    vlist[o] = v, e
+            else:
+                log.info('writecache: bad vlist syntax: '
+                        '%s' % settings['vlist'])
+
+        settings['vlist'] = vlist
+
+    if 'status' in settings:
+        st = settings['status'].lower()
+        settings['status'] = st
+
+    return settings
 
-                else:
-                    log.info('writecache: bad vlist syntax: '
-                            '%s' % recordContext['settings']['vlist'])
 
-            recordContext['settings']['vlist'] = vlist
+def variate(oid, tag, value, **context):
+    if not context['nextFlag'] and not context['exactMatch']:
+        return context['origOid'], tag, context['errorStatus']
 
-        if 'status' in recordContext['settings']:
-            st = recordContext['settings']['status'].lower()
-            recordContext['settings']['status'] = st
+    if 'settings' not in recordContext:
+        recordContext['settings'] = compile(value, tag=tag)
 
     if oid not in moduleContext:
         moduleContext[oid] = {}